@@ -0,0 +1,277 @@
+"""
+Recursive aggregates of each directory: the number and total size of the
+photos in its whole subtree, the range of their creation dates and when
+the newest of them was modified. They're stored in the dirs table, so
+listing a directory never needs a recursive query.
+
+The aggregates are maintained incrementally as the indexer and sync write
+rows. Photos added to a dir are recorded as deltas, which are summed up the
+parent_user_path chain and applied with one UPDATE per dir. Changes a delta
+can't express (a photo removed or replaced, a dir rewritten by the indexer)
+mark the dir as invalid instead: it's recomputed from its own photos and
+the stored aggregates of its subdirectories, which only reads one level of
+the tree, and the difference is then propagated to its ancestors as a
+delta. Dirs are processed deepest first, so subdirectories are always up to
+date when their parent is recomputed.
+
+The aggregates of a dir only ever count its own photos and the aggregates
+stored in its subdirectories' rows. Photos whose dir has no row yet (the
+indexer writes a dir after its photos) aren't counted by its ancestors
+until the row is written, which recomputes the dir, even if a run is
+interrupted in between.
+"""
+import os
+
+DIRS_TABLE = 'dirs'
+PHOTOS_TABLE = 'photos'
+USER_ROOT = '/'
+
+OWN_PHOTOS_STATEMENT = """
+    SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created_time),
+           MAX(created_time), MAX(modified_time)
+    FROM {} WHERE user_path = %s
+    """.format(PHOTOS_TABLE)
+
+SUBDIRS_STATEMENT = """
+    SELECT COUNT(*), COALESCE(SUM(total_photos), 0),
+           COALESCE(SUM(total_size), 0), MIN(min_created_time),
+           MAX(max_created_time), MAX(max_modified_time)
+    FROM {} WHERE parent_user_path = %s
+    """.format(DIRS_TABLE)
+
+EXISTING_DIRS_STATEMENT = """
+    SELECT user_path FROM {} WHERE user_path IN ({{}})
+    """.format(DIRS_TABLE)
+# Max number of dirs per EXISTING_DIRS_STATEMENT
+EXISTING_DIRS_CHUNK_SIZE = 500
+
+GET_AGGREGATE_STATEMENT = """
+    SELECT total_photos, total_size, min_created_time, max_created_time,
+           max_modified_time
+    FROM {} WHERE user_path = %s
+    """.format(DIRS_TABLE)
+
+SET_AGGREGATE_STATEMENT = """
+    UPDATE {} SET num_photos = %s, num_subdirs = %s, total_photos = %s,
+        total_size = %s, min_created_time = %s, max_created_time = %s,
+        max_modified_time = %s
+    WHERE user_path = %s
+    """.format(DIRS_TABLE)
+
+# The COALESCEs keep the current value when the delta has none, and take
+# the delta's when there is no current value
+ADD_AGGREGATE_STATEMENT = """
+    UPDATE {} SET num_photos = num_photos + %s,
+        total_photos = total_photos + %s, total_size = total_size + %s,
+        min_created_time = LEAST(COALESCE(min_created_time, %s),
+                                 COALESCE(%s, min_created_time)),
+        max_created_time = GREATEST(COALESCE(max_created_time, %s),
+                                    COALESCE(%s, max_created_time)),
+        max_modified_time = GREATEST(COALESCE(max_modified_time, %s),
+                                     COALESCE(%s, max_modified_time))
+    WHERE user_path = %s
+    """.format(DIRS_TABLE)
+
+
+class Delta(object):
+    """
+    Photos added to a subtree: how many, their total size, and the extremes
+    of their dates, None if unknown
+    """
+
+    def __init__(self, photos=0, size=0, min_created=None, max_created=None,
+                 max_modified=None):
+        self.photos = photos
+        self.size = size
+        self.min_created = min_created
+        self.max_created = max_created
+        self.max_modified = max_modified
+
+    def add(self, other):
+        self.photos += other.photos
+        self.size += other.size
+        self.min_created = _min(self.min_created, other.min_created)
+        self.max_created = _max(self.max_created, other.max_created)
+        self.max_modified = _max(self.max_modified, other.max_modified)
+
+    def is_empty(self):
+        return not self.photos and not self.size and self.max_modified is None
+
+
+class AggregateChanges(object):
+    """
+    Changes to the aggregates, recorded as rows are written and applied with
+    apply() once they have all been sent to the database
+    """
+
+    def __init__(self):
+        # user path -> Delta of the photos added directly in the dir
+        self.deltas = {}
+        # user paths of the dirs to recompute
+        self.invalid = set()
+
+    def add_photo(self, photo):
+        """
+        Records a photo added to its dir
+        :param photo: a record_types.Photo
+        """
+        delta = Delta(1, photo.size, _to_timestamp(photo.created_time),
+                      _to_timestamp(photo.created_time),
+                      _to_timestamp(photo.modified_time))
+        self.deltas.setdefault(photo.user_path, Delta()).add(delta)
+
+    def invalidate(self, user_path):
+        """
+        Records that photos or subdirectories of a dir were removed or
+        replaced, so its aggregates must be recomputed
+        """
+        self.invalid.add(user_path)
+
+    def clear(self):
+        self.deltas.clear()
+        self.invalid.clear()
+
+    def __bool__(self):
+        return bool(self.deltas or self.invalid)
+
+    def apply(self, db):
+        """
+        Updates the aggregates of the changed dirs and their ancestors.
+        :param db: a cursor, on a connection where all the changes have been
+            written
+        :return: the set of user paths of the dirs whose aggregates were
+            updated
+        """
+        invalid = set(self.invalid)
+        user_paths = set()
+        for user_path in list(self.deltas) + list(invalid):
+            while user_path is not None and user_path not in user_paths:
+                user_paths.add(user_path)
+                user_path = get_parent_dir(user_path)
+
+        existing = get_existing_dirs(db, user_paths - invalid)
+        # user path -> Delta coming from the subdirectories
+        carried = {}
+        updated = set()
+        for user_path in sorted(user_paths, key=_depth, reverse=True):
+            parent = get_parent_dir(user_path)
+            if user_path in invalid:
+                up, shrunk = recompute(db, user_path)
+                if up is not None:
+                    updated.add(user_path)
+                if shrunk and parent is not None:
+                    # An extreme date may have come from this subtree
+                    invalid.add(parent)
+            else:
+                own = self.deltas.get(user_path, Delta())
+                up = Delta()
+                up.add(own)
+                up.add(carried.get(user_path, Delta()))
+                if up.is_empty():
+                    continue
+                if user_path not in existing:
+                    # Nothing stores these photos yet, so they must not be
+                    # counted above either
+                    continue
+                db.execute(ADD_AGGREGATE_STATEMENT, (
+                    own.photos, up.photos, up.size,
+                    up.min_created, up.min_created,
+                    up.max_created, up.max_created,
+                    up.max_modified, up.max_modified, user_path))
+                updated.add(user_path)
+            if parent is not None and up is not None:
+                carried.setdefault(parent, Delta()).add(up)
+        self.clear()
+        return updated
+
+
+def get_existing_dirs(db, user_paths):
+    """
+    :return: the set of the given user paths that have a row in the dirs
+        table
+    """
+    user_paths = sorted(user_paths)
+    existing = set()
+    for i in range(0, len(user_paths), EXISTING_DIRS_CHUNK_SIZE):
+        chunk = user_paths[i:i + EXISTING_DIRS_CHUNK_SIZE]
+        db.execute(EXISTING_DIRS_STATEMENT.format(
+            ', '.join(['%s'] * len(chunk))), chunk)
+        existing.update(user_path for user_path, in db.fetchall())
+    return existing
+
+
+def recompute(db, user_path):
+    """
+    Recomputes the aggregates of a dir from its own photos and the
+    aggregates of its subdirectories.
+    :return: (delta, shrunk): the Delta to add to its parent, None if the
+        dir doesn't exist, and whether any of its extreme dates moved inward,
+        which deltas can't express
+    """
+    db.execute(GET_AGGREGATE_STATEMENT, (user_path,))
+    old = db.fetchone()
+    if old is None:
+        return None, False
+    old_photos, old_size, old_min, old_max, old_modified = old
+
+    db.execute(OWN_PHOTOS_STATEMENT, (user_path,))
+    num_photos, size, min_created, max_created, max_modified = db.fetchone()
+    db.execute(SUBDIRS_STATEMENT, (user_path,))
+    (num_subdirs, sub_photos, sub_size, sub_min, sub_max,
+     sub_modified) = db.fetchone()
+    new = Delta(num_photos + sub_photos, int(size) + int(sub_size),
+                _min(_to_timestamp(min_created), _to_timestamp(sub_min)),
+                _max(_to_timestamp(max_created), _to_timestamp(sub_max)),
+                _max(_to_timestamp(max_modified), _to_timestamp(sub_modified)))
+    db.execute(SET_AGGREGATE_STATEMENT, (
+        num_photos, num_subdirs, new.photos, new.size, new.min_created,
+        new.max_created, new.max_modified, user_path))
+
+    old_min, old_max, old_modified = (
+        _to_timestamp(old_min), _to_timestamp(old_max),
+        _to_timestamp(old_modified))
+    shrunk = ((old_min is not None and old_min != new.min_created) or
+              (old_max is not None and old_max != new.max_created) or
+              (old_modified is not None and
+               old_modified != new.max_modified))
+    return Delta(new.photos - old_photos, new.size - int(old_size),
+                 new.min_created, new.max_created, new.max_modified), shrunk
+
+
+def get_parent_dir(user_path):
+    if user_path == USER_ROOT:
+        return None
+    else:
+        return os.path.dirname(user_path)
+
+
+def _depth(user_path):
+    if user_path == USER_ROOT:
+        return 0
+    return user_path.count('/')
+
+
+def _to_timestamp(value):
+    """
+    Dates are written as SQL timestamp strings but read back as datetimes.
+    Compares them as strings, in the same format.
+    """
+    if value is None:
+        return None
+    return str(value)
+
+
+def _min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
@@ -0,0 +1,213 @@
+"""
+Databases the index can be stored in: a MySQL server, or an embedded SQLite
+file, which avoids a network round trip per query and needs no server.
+
+The statements in db_utils are written for MySQL, with %s placeholders.
+SQLite connections translate each distinct statement once (see
+translate_statement) and sqlite3 keeps the compiled statements in its
+per-connection cache, so they're only prepared once too.
+
+SQLite databases are opened in WAL mode, so the web app reads the last
+committed state while the indexer or sync is writing. The web app opens
+them read-only. They aren't opened as immutable, since the indexer and
+sync update the file in place.
+"""
+import datetime
+import functools
+import os
+import re
+import sqlite3
+import urllib.parse
+
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    MySQLdb = None
+
+MYSQL_BACKEND = 'mysql'
+SQLITE_BACKEND = 'sqlite'
+BACKENDS = (MYSQL_BACKEND, SQLITE_BACKEND)
+DEFAULT_BACKEND = MYSQL_BACKEND
+
+SQLITE_SCHEMA_FILE = os.path.join(os.path.dirname(__file__),
+                                  'create_tables_sqlite.sql')
+# For upserts without a conflict target, like MySQL's ON DUPLICATE KEY
+# UPDATE, row values in IN lists and up to 32766 parameters per statement
+MIN_SQLITE_VERSION = (3, 35, 0)
+# Seconds a connection waits for another one's write lock
+SQLITE_TIMEOUT_SECONDS = 30
+# Compiled statements kept per connection
+SQLITE_CACHED_STATEMENTS = 256
+
+# Errors either backend may raise
+if MySQLdb is None:
+    ERRORS = (sqlite3.Error,)
+    OPERATIONAL_ERRORS = (sqlite3.OperationalError,)
+else:
+    ERRORS = (sqlite3.Error, MySQLdb.Error)
+    OPERATIONAL_ERRORS = (sqlite3.OperationalError, MySQLdb.OperationalError)
+
+
+class MySQLBackend(object):
+    def __init__(self, host, user, password, db_name):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.db_name = db_name
+
+    def connect(self, read_only=False):
+        """
+        Opens a new connection to the database
+        :param read_only: ignored, the web app should use a MySQL user that
+            can only read
+        """
+        if MySQLdb is None:
+            raise ImportError('The mysql backend needs the mysqlclient '
+                              'package')
+        return MySQLdb.connect(host=self.host, user=self.user,
+                               passwd=self.password, db=self.db_name)
+
+
+class SQLiteBackend(object):
+    def __init__(self, path):
+        """
+        :param path: the SQLite file holding the index
+        """
+        self.path = path
+
+    def connect(self, read_only=False):
+        """
+        Opens a new connection to the database, which can be shared between
+        threads as long as they don't use it at the same time. Creates the
+        tables if needed, unless read_only.
+        :param read_only: if True, the connection can't write, and the file
+            must already exist
+        """
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise RuntimeError('The sqlite backend needs SQLite {} or later, '
+                               'not {}'.format(
+                                   '.'.join(map(str, MIN_SQLITE_VERSION)),
+                                   sqlite3.sqlite_version))
+        if read_only:
+            target, uri = 'file:{}?mode=ro'.format(
+                urllib.parse.quote(os.path.abspath(self.path))), True
+        else:
+            target, uri = self.path, False
+        conn = sqlite3.connect(target, uri=uri,
+                               timeout=SQLITE_TIMEOUT_SECONDS,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False,
+                               cached_statements=SQLITE_CACHED_STATEMENTS)
+        # Like MySQL, but case sensitive, which also lets LIKE 'prefix%'
+        # use the indexes
+        conn.execute('PRAGMA case_sensitive_like = ON')
+        if read_only:
+            conn.execute('PRAGMA query_only = ON')
+        else:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            with open(SQLITE_SCHEMA_FILE) as f:
+                conn.executescript(f.read())
+        return SQLiteConnection(conn)
+
+
+class SQLiteConnection(object):
+    """
+    A sqlite3 connection that can be used like a MySQLdb one
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, cursorclass=None):
+        """
+        :param cursorclass: ignored, SQLite cursors never buffer the rows
+        """
+        return SQLiteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def ping(self):
+        self.conn.execute('SELECT 1')
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteCursor(object):
+    """
+    A sqlite3 cursor running statements written for MySQL
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, statement, args=None):
+        self.cursor.execute(translate_statement(statement),
+                            tuple(args or ()))
+
+    def executemany(self, statement, rows):
+        self.cursor.executemany(translate_statement(statement),
+                                [tuple(row) for row in rows])
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+def streaming_cursor(conn):
+    """
+    Gets a cursor that streams the rows of a large result instead of
+    loading them all in memory first
+    """
+    if isinstance(conn, SQLiteConnection):
+        return conn.cursor()
+    return conn.cursor(MySQLdb.cursors.SSCursor)
+
+
+@functools.lru_cache(maxsize=1024)
+def translate_statement(statement):
+    """
+    Translates a statement written for MySQL into SQLite's dialect. Only
+    covers what the statements in db_utils use.
+
+    For example:
+    >>> translate_statement('UPDATE t SET a = LEAST(a, %s) WHERE b = %s')
+    'UPDATE t SET a = MIN(a, ?) WHERE b = ?'
+    >>> translate_statement('INSERT INTO t (a) VALUES (%s) '
+    ...                     'ON DUPLICATE KEY UPDATE a = VALUES(a)')
+    'INSERT INTO t (a) VALUES (?) ON CONFLICT DO UPDATE SET a = excluded.a'
+    """
+    statement = statement.replace('%s', '?')
+    statement = re.sub(r'\bLEAST\(', 'MIN(', statement)
+    statement = re.sub(r'\bGREATEST\(', 'MAX(', statement)
+    insert, upsert, updates = statement.partition('ON DUPLICATE KEY UPDATE')
+    if upsert:
+        statement = '{}ON CONFLICT DO UPDATE SET{}'.format(
+            insert, re.sub(r'\bVALUES\((\w+)\)', r'excluded.\1', updates))
+    return statement
+
+
+def _convert_datetime(value):
+    return datetime.datetime.fromisoformat(value.decode('utf-8'))
+
+
+# DATETIME columns are read back as datetimes, as with MySQLdb
+sqlite3.register_converter('DATETIME', _convert_datetime)
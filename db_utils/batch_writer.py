@@ -0,0 +1,210 @@
+"""
+Buffered writer for the photos and dirs tables.
+
+Rows are accumulated per table and written with a single executemany (for
+REPLACE statements) or a single multi-row DELETE once a batch is full, and
+the transaction is committed every commit_every rows. Order is preserved
+within a table: switching from one statement to another on the same table
+flushes the pending batch first.
+
+Each commit also applies the changes to the recursive aggregates of the
+dirs recorded since the last one, in the same transaction as the rows, so
+an interrupted run never leaves committed photos out of the aggregates.
+An on_commit hook then runs after every commit, periodic ones included, to
+publish what was just committed (see indexer.publish_changes).
+"""
+import db_utils.aggregates as aggregates
+import db_utils.profiling as profiling
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_COMMIT_EVERY = 5000
+
+DELETE_OP = 'delete'
+DELETE_SUBTREE_OP = 'delete_subtree'
+REPLACE_OP = 'replace'
+
+DELETE_STATEMENT = """
+    DELETE FROM {} WHERE {} IN ({})
+    """
+
+# Both conditions are ranges of the index on the column, usually the
+# primary key
+LIKE_ESCAPE = '!'
+DELETE_SUBTREE_STATEMENT = """
+    DELETE FROM {} WHERE {} IN ({}) OR {}
+    """
+
+
+class BatchWriter(object):
+    def __init__(self, conn, batch_size=DEFAULT_BATCH_SIZE,
+                 commit_every=DEFAULT_COMMIT_EVERY, verbose=False,
+                 on_commit=None):
+        """
+        :param conn: an open DB-API connection
+        :param batch_size: max number of rows sent in one statement
+        :param commit_every: commit after at least this many rows have been
+            written since the last commit. 0 means only commit on close.
+        :param verbose: whether the indexer prints every row it writes
+        :param on_commit: if not None, called with the writer after each
+            commit
+        """
+        self.conn = conn
+        self.db = conn.cursor()
+        self.batch_size = max(1, batch_size)
+        self.commit_every = commit_every
+        self.verbose = verbose
+        self.on_commit = on_commit
+        # table -> (op, rows), where op is (REPLACE_OP, statement),
+        # (DELETE_OP, key_columns) or (DELETE_SUBTREE_OP, column)
+        self.pending = {}
+        self.uncommitted = 0
+        self.rows_written = 0
+        # User paths of the dirs whose contents (subdirs or photos) were
+        # written, so their snapshots can be rebuilt
+        self.touched_dirs = set()
+        # Changes to the recursive aggregates of the dirs, applied once the
+        # rows are written
+        self.aggregates = aggregates.AggregateChanges()
+
+    def replace(self, table, statement, row):
+        """
+        Queues a row for a REPLACE INTO (or INSERT ... ON DUPLICATE KEY
+        UPDATE) statement with one %s per column.
+        """
+        self._add(table, (REPLACE_OP, statement), tuple(row))
+
+    def delete(self, table, key_columns, key):
+        """
+        Queues the deletion of the rows of table whose key_columns equal key.
+        """
+        self._add(table, (DELETE_OP, tuple(key_columns)), tuple(key))
+
+    def delete_subtree(self, table, column, user_path):
+        """
+        Queues the deletion of the rows of table whose column is user_path or
+        a user path below it. The subtrees queued together are deleted with
+        a single statement.
+        """
+        self._add(table, (DELETE_SUBTREE_OP, column), (user_path,))
+
+    def _add(self, table, op, row):
+        pending = self.pending.get(table)
+        if pending is not None and pending[0] != op:
+            self._flush_table(table)
+            pending = None
+        if pending is None:
+            pending = self.pending[table] = (op, [])
+        pending[1].append(row)
+        if len(pending[1]) >= self.batch_size:
+            self._flush_table(table)
+            if self.commit_every and self.uncommitted >= self.commit_every:
+                self.commit()
+
+    def _flush_table(self, table):
+        (kind, arg), rows = self.pending.pop(table)
+        with profiling.stats.timer('db_write'):
+            if kind == REPLACE_OP:
+                self.db.executemany(arg, rows)
+            elif kind == DELETE_SUBTREE_OP:
+                self.db.execute(*build_subtree_delete(
+                    table, arg, [user_path for user_path, in rows]))
+            else:
+                self.db.execute(*build_delete(table, arg, rows))
+        profiling.stats.count('rows_written', len(rows))
+        self.uncommitted += len(rows)
+        self.rows_written += len(rows)
+
+    def flush(self):
+        """
+        Sends all queued rows to the database, without committing.
+        """
+        for table in list(self.pending):
+            if table in self.pending:
+                self._flush_table(table)
+
+    def commit(self):
+        """
+        Sends all queued rows, updates the aggregates accordingly and
+        commits
+        """
+        self.flush()
+        with profiling.stats.timer('aggregates'):
+            updated = self.aggregates.apply(self.db)
+        # Every ancestor of a changed dir has new aggregates, which are shown
+        # in its own listing and its parent's
+        for user_path in updated:
+            self.touched_dirs.add(user_path)
+            parent = aggregates.get_parent_dir(user_path)
+            if parent is not None:
+                self.touched_dirs.add(parent)
+        with profiling.stats.timer('db_commit'):
+            self.conn.commit()
+        self.uncommitted = 0
+        if self.on_commit is not None:
+            self.on_commit(self)
+
+    def close(self):
+        """
+        Writes and commits everything still queued and closes the cursor.
+        The connection itself is left open.
+        """
+        try:
+            self.commit()
+        finally:
+            self.db.close()
+
+
+def build_delete(table, key_columns, keys):
+    """
+    Builds a single DELETE statement removing all of the given keys, e.g.
+    DELETE FROM photos WHERE (user_path, filename) IN ((%s, %s), (%s, %s))
+    Returns (query, args).
+    """
+    placeholders = ', '.join(['%s'] * len(key_columns))
+    if len(key_columns) == 1:
+        column_list = key_columns[0]
+        values = ', '.join([placeholders] * len(keys))
+    else:
+        column_list = '({})'.format(', '.join(key_columns))
+        values = ', '.join(['({})'.format(placeholders)] * len(keys))
+    query = DELETE_STATEMENT.format(table, column_list, values)
+    args = [value for key in keys for value in key]
+    return query, args
+
+
+def build_subtree_delete(table, column, user_paths):
+    """
+    Builds a single DELETE statement removing the rows in the subtrees at
+    the given user paths, e.g.
+    DELETE FROM dirs WHERE user_path IN (%s, %s)
+        OR user_path LIKE %s OR user_path LIKE %s
+    Returns (query, args).
+    """
+    placeholders = ', '.join(['%s'] * len(user_paths))
+    like = ' OR '.join(["{} LIKE %s ESCAPE '{}'".format(column, LIKE_ESCAPE)]
+                       * len(user_paths))
+    query = DELETE_SUBTREE_STATEMENT.format(table, column, placeholders,
+                                            like)
+    args = (list(user_paths) +
+            [subtree_like_pattern(user_path) for user_path in user_paths])
+    return query, args
+
+
+def subtree_like_pattern(user_path):
+    """
+    Gets a LIKE pattern matching the user paths strictly below user_path,
+    without matching siblings that share a prefix (/2017b for /2017). It's
+    served by a range scan of an index on the user paths. The pattern must
+    be used with ESCAPE '!', which means the same in MySQL and SQLite,
+    unlike the backslash.
+
+    For example:
+    >>> subtree_like_pattern('/2017/50%_off!')
+    '/2017/50!%!_off!!/%'
+    >>> subtree_like_pattern('/')
+    '/%'
+    """
+    prefix = user_path.rstrip('/') + '/'
+    for special in (LIKE_ESCAPE, '%', '_'):
+        prefix = prefix.replace(special, LIKE_ESCAPE + special)
+    return prefix + '%'
@@ -0,0 +1,51 @@
+"""
+HTTP content encodings supported for JSON responses: gzip always, brotli
+if the brotli module is installed.
+"""
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_ENCODING = 'gzip'
+BROTLI_ENCODING = 'br'
+# Content-Encoding -> file extension used for pre-compressed files
+EXTENSIONS = {
+    GZIP_ENCODING: '.gz',
+    BROTLI_ENCODING: '.br',
+}
+
+GZIP_LEVEL = 6
+# Compressing anything smaller doesn't pay off
+MIN_SIZE = 512
+
+
+def available_encodings():
+    """
+    Gets the supported Content-Encodings, in order of preference
+    """
+    if brotli is not None:
+        return [BROTLI_ENCODING, GZIP_ENCODING]
+    return [GZIP_ENCODING]
+
+
+def negotiate(accept_encodings):
+    """
+    Picks the preferred encoding accepted by the client.
+    :param accept_encodings: the request's werkzeug Accept object for the
+        Accept-Encoding header
+    :return: a Content-Encoding, or None for no encoding
+    """
+    for encoding in available_encodings():
+        if accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=GZIP_LEVEL):
+    if encoding == BROTLI_ENCODING:
+        return brotli.compress(data)
+    # mtime=0 so that identical contents give identical bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
@@ -0,0 +1,179 @@
+"""
+Bounded, thread-safe pool of database connections for the web app, so
+requests don't pay for a new connection (TCP + auth handshake) each time.
+
+Connections idle for more than max_idle seconds are closed, connections
+idle for more than health_check_interval seconds are pinged before being
+handed out, and broken connections are replaced by new ones.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 4
+DEFAULT_MAX_IDLE_SECONDS = 300
+DEFAULT_TIMEOUT_SECONDS = 10
+DEFAULT_HEALTH_CHECK_INTERVAL_SECONDS = 30
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, connect, max_size=DEFAULT_MAX_SIZE,
+                 max_idle=DEFAULT_MAX_IDLE_SECONDS,
+                 timeout=DEFAULT_TIMEOUT_SECONDS,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL_SECONDS):
+        """
+        :param connect: callable returning a new DB-API connection
+        :param max_size: max number of open connections, idle or in use
+        :param max_idle: close connections idle for longer than this
+        :param timeout: max seconds acquire() waits for a free connection
+        :param health_check_interval: ping connections idle for longer than
+            this before handing them out
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.idle = collections.deque()  # (conn, last_released)
+        self.size = 0
+        self.cond = threading.Condition()
+        self.metrics = collections.Counter()
+
+    def acquire(self):
+        """
+        Returns a healthy connection, waiting up to timeout seconds for one
+        to be released if max_size connections are already in use.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            conn, last_released = self._reserve(deadline)
+            if conn is None:
+                return self._new_connection()
+            if (time.time() - last_released > self.health_check_interval and
+                    not self._is_healthy(conn)):
+                self.metrics['closed_broken'] += 1
+                self._discard(conn)
+                continue
+            self.metrics['reused'] += 1
+            return conn
+
+    def _reserve(self, deadline):
+        """
+        Takes an idle connection, or reserves room for a new one, in which
+        case (None, None) is returned.
+        """
+        with self.cond:
+            while True:
+                self._evict_idle()
+                if self.idle:
+                    # Most recently used first, so that extra connections
+                    # go idle and get evicted
+                    return self.idle.pop()
+                if self.size < self.max_size:
+                    self.size += 1
+                    return None, None
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.metrics['timeouts'] += 1
+                    raise PoolTimeout('No database connection available '
+                                      'after {}s'.format(self.timeout))
+                self.metrics['waits'] += 1
+                self.cond.wait(remaining)
+
+    def _new_connection(self):
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            self.metrics['connect_errors'] += 1
+            raise
+        self.metrics['created'] += 1
+        return conn
+
+    def release(self, conn, broken=False):
+        """
+        Returns a connection to the pool. Any open transaction is rolled
+        back, so the next user doesn't see an old snapshot.
+        :param broken: if True, the connection is closed instead
+        """
+        if not broken:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self.metrics['closed_broken'] += 1
+            self._discard(conn)
+            return
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, broken=True)
+            raise
+        else:
+            self.release(conn)
+
+    def _evict_idle(self):
+        """Must be called with self.cond held"""
+        oldest_allowed = time.time() - self.max_idle
+        while self.idle and self.idle[0][1] < oldest_allowed:
+            conn, _ = self.idle.popleft()
+            self.size -= 1
+            self.metrics['closed_idle'] += 1
+            _close_quietly(conn)
+
+    def _discard(self, conn):
+        _close_quietly(conn)
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.ping()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        with self.cond:
+            while self.idle:
+                conn, _ = self.idle.popleft()
+                self.size -= 1
+                _close_quietly(conn)
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.metrics)
+            stats.update({
+                'size': self.size,
+                'idle': len(self.idle),
+                'in_use': self.size - len(self.idle),
+                'max_size': self.max_size,
+            })
+        return stats
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
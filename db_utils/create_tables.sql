@@ -4,11 +4,6 @@ DROP TABLE IF EXISTS dirs;
 CREATE TABLE photos (
     user_path VARCHAR(254),
     filename VARCHAR(254),
-    url VARCHAR(512),
-    thumb_20_url VARCHAR(512),
-    thumb_100_url VARCHAR(512),
-    thumb_250_url VARCHAR(512),
-    thumb_500_url VARCHAR(512),
     created_time DATETIME,
     width INT,
     height INT,
@@ -26,17 +21,11 @@ CREATE TABLE photos (
     exif_gps_alt_ft VARCHAR(8),
     PRIMARY KEY (user_path, filename)
 );
-CREATE INDEX photos_by_user_path ON photos(`user_path`);
 
 CREATE TABLE dirs (
     user_path VARCHAR(254),
     parent_user_path VARCHAR(254),
     name VARCHAR(254),
-    url VARCHAR(254),
-    thumb_20_url VARCHAR(512),
-    thumb_100_url VARCHAR(512),
-    thumb_250_url VARCHAR(512),
-    thumb_500_url VARCHAR(512),
     width INT,
     height INT,
     aspect_ratio FLOAT,
@@ -44,6 +33,14 @@ CREATE TABLE dirs (
     modified_time DATETIME,
     num_subdirs INT,
     num_photos INT,
+    -- Recursive aggregates of the photos in the subtree of the dir, kept up
+    -- to date by the indexer and sync (see db_utils/aggregates.py)
+    total_photos INT NOT NULL DEFAULT 0,
+    total_size BIGINT NOT NULL DEFAULT 0,
+    min_created_time DATETIME,
+    max_created_time DATETIME,
+    max_modified_time DATETIME,
     PRIMARY KEY (user_path)
 );
-CREATE INDEX dirs_by_user_path ON dirs(`user_path`);
+-- Lists the subdirectories of a dir in name order
+CREATE INDEX dirs_by_parent_user_path ON dirs(`parent_user_path`, `name`);
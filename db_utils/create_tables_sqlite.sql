@@ -0,0 +1,47 @@
+-- The tables of create_tables.sql, for the sqlite backend (see
+-- db_utils/backends.py). Run each time the indexer or sync opens the
+-- database, so only creates what's missing.
+CREATE TABLE IF NOT EXISTS photos (
+    user_path VARCHAR(254),
+    filename VARCHAR(254),
+    created_time DATETIME,
+    width INT,
+    height INT,
+    aspect_ratio FLOAT,
+    size BIGINT,
+    modified_time DATETIME,
+    exif_fstop VARCHAR(12),
+    exif_focal_length VARCHAR(12),
+    exif_iso VARCHAR(12),
+    exif_shutter_speed VARCHAR(12),
+    exif_camera VARCHAR(64),
+    exif_lens VARCHAR(64),
+    exif_gps_lat VARCHAR(64),
+    exif_gps_lon VARCHAR(64),
+    exif_gps_alt_ft VARCHAR(8),
+    PRIMARY KEY (user_path, filename)
+);
+
+CREATE TABLE IF NOT EXISTS dirs (
+    user_path VARCHAR(254),
+    parent_user_path VARCHAR(254),
+    name VARCHAR(254),
+    width INT,
+    height INT,
+    aspect_ratio FLOAT,
+    created_time DATETIME,
+    modified_time DATETIME,
+    num_subdirs INT,
+    num_photos INT,
+    -- Recursive aggregates of the photos in the subtree of the dir, kept up
+    -- to date by the indexer and sync (see db_utils/aggregates.py)
+    total_photos INT NOT NULL DEFAULT 0,
+    total_size BIGINT NOT NULL DEFAULT 0,
+    min_created_time DATETIME,
+    max_created_time DATETIME,
+    max_modified_time DATETIME,
+    PRIMARY KEY (user_path)
+);
+-- Lists the subdirectories of a dir in name order
+CREATE INDEX IF NOT EXISTS dirs_by_parent_user_path
+    ON dirs(parent_user_path, name);
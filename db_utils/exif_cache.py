@@ -0,0 +1,148 @@
+"""
+Persistent cache of the record_types.Exif tuple of each photo, so that
+re-indexing files that haven't changed doesn't need to read them at all.
+
+Entries are stored in a local SQLite file and keyed by the photo's path on
+disk. An entry is only used if the size and mtime recorded with it still
+match the file. Entries that haven't been used for the longest time are
+evicted once the cache holds more than max_entries photos.
+
+The cache records the CACHE_VERSION it was written with, and is emptied
+when opened with another one, so entries written before the indexer
+extracted more from the photos aren't used.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import db_utils.record_types as record_types
+
+CACHE_SUFFIX = 'exif_cache.sqlite'
+DEFAULT_MAX_ENTRIES = 1000000
+# Bump whenever what indexer.get_exif returns changes. Caches written
+# before versions were recorded are version 0.
+CACHE_VERSION = 1
+
+CREATE_TABLE_STATEMENT = """
+    CREATE TABLE IF NOT EXISTS exif (
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        exif TEXT,
+        last_used INTEGER
+    )
+    """
+
+CREATE_INDEX_STATEMENT = """
+    CREATE INDEX IF NOT EXISTS exif_by_last_used ON exif(last_used)
+    """
+
+GET_STATEMENT = """
+    SELECT size, mtime_ns, exif FROM exif WHERE path = ?
+    """
+
+PUT_STATEMENT = """
+    INSERT OR REPLACE INTO exif (path, size, mtime_ns, exif, last_used)
+    VALUES (?, ?, ?, ?, ?)
+    """
+
+TOUCH_STATEMENT = """
+    UPDATE exif SET last_used = ? WHERE path = ?
+    """
+
+CLEAR_STATEMENT = """
+    DELETE FROM exif
+    """
+
+EVICT_STATEMENT = """
+    DELETE FROM exif WHERE path IN (
+        SELECT path FROM exif ORDER BY last_used ASC LIMIT ?)
+    """
+
+
+def default_cache_path(root):
+    """
+    Gets the default location of the cache for a photos root, which is a
+    hidden file next to (not inside) the root, e.g.
+    "/photos/.albums.exif_cache.sqlite" for the root "/photos/albums"
+    """
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), '.{}.{}'.format(
+        os.path.basename(root), CACHE_SUFFIX))
+
+
+class ExifCache(object):
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES,
+                 refresh=False):
+        """
+        :param filename: the SQLite file holding the cache
+        :param max_entries: max number of photos kept in the cache
+        :param refresh: if True, never return cached entries, only store
+            freshly read ones
+        """
+        self.filename = filename
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.now = int(time.time())
+        self.hits = 0
+        self.misses = 0
+        self.used = []
+        # The cache is shared by the walk (which may run in the worker
+        # pool's feeder thread) and the writer.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute(CREATE_TABLE_STATEMENT)
+        self.conn.execute(CREATE_INDEX_STATEMENT)
+        version, = self.conn.execute('PRAGMA user_version').fetchone()
+        if version != CACHE_VERSION:
+            self.conn.execute(CLEAR_STATEMENT)
+            self.conn.execute('PRAGMA user_version = {:d}'.format(
+                CACHE_VERSION))
+            self.conn.commit()
+
+    def get(self, path, stat):
+        """
+        Returns the cached Exif for path, or None if there is no entry or
+        the file changed since it was cached.
+        :param stat: an os.stat_result for path
+        """
+        if self.refresh:
+            self.misses += 1
+            return None
+        with self.lock:
+            row = self.conn.execute(GET_STATEMENT, (path,)).fetchone()
+            if (row is None or row[0] != stat.st_size or
+                    row[1] != stat.st_mtime_ns):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used.append((self.now, path))
+        return record_types.Exif(*json.loads(row[2]))
+
+    def put(self, path, stat, exif):
+        with self.lock:
+            self.conn.execute(PUT_STATEMENT, (
+                path, stat.st_size, stat.st_mtime_ns, json.dumps(exif),
+                self.now))
+
+    def commit(self):
+        """
+        Records which entries were used, evicts the least recently used
+        entries above max_entries and writes the cache to disk.
+        """
+        with self.lock:
+            self.conn.executemany(TOUCH_STATEMENT, self.used)
+            self.used = []
+            count, = self.conn.execute(
+                'SELECT COUNT(*) FROM exif').fetchone()
+            if count > self.max_entries:
+                self.conn.execute(EVICT_STATEMENT,
+                                  (count - self.max_entries,))
+            self.conn.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+        print("EXIF cache: {} hits, {} misses".format(self.hits, self.misses))
@@ -0,0 +1,46 @@
+"""
+Index generation counter.
+
+The indexer and sync bump the generation after committing changes to the
+database, and the web app keys its caches on it, so cached results are
+dropped as soon as the index changes. The counter lives in a small file
+next to the photos root, so checking it costs a file read rather than a
+database query.
+"""
+import os
+
+GENERATION_SUFFIX = 'index_generation'
+
+
+def default_generation_path(root):
+    """
+    Gets the default location of the generation file for a photos root,
+    which is a hidden file next to (not inside) the root, e.g.
+    "/photos/.albums.index_generation" for the root "/photos/albums"
+    """
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), '.{}.{}'.format(
+        os.path.basename(root), GENERATION_SUFFIX))
+
+
+def read_generation(filename):
+    """
+    Returns the current generation, or 0 if it was never bumped
+    """
+    try:
+        with open(filename) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def bump_generation(filename):
+    """
+    Atomically increments the generation. Returns the new generation.
+    """
+    generation = read_generation(filename) + 1
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write('{}\n'.format(generation))
+    os.replace(tmp_filename, filename)
+    return generation
@@ -0,0 +1,237 @@
+"""
+Fast reader for the handful of image header fields the indexer needs.
+
+Reads at most the first HEADER_READ_SIZE bytes of a JPEG, PNG or TIFF file
+in a single read and pulls the image dimensions (from the JPEG SOF marker,
+the PNG IHDR chunk or TIFF IFD0) and the EXIF/GPS tags used to build a
+record_types.Exif out of the EXIF block (JPEG APP1 segment, PNG eXIf chunk
+or the TIFF file itself).
+
+Tags are returned under the same names exifread uses, e.g. 'EXIF FNumber',
+with ASCII values as str and numeric values as lists, rationals being
+fractions.Fraction. Anything unexpected (unknown format, truncated header,
+offsets pointing past the bytes read) makes read_header return None, and
+the caller should fall back to a full parse.
+"""
+import fractions
+import struct
+
+HEADER_READ_SIZE = 2 ** 18  # 256 KB
+
+JPEG_SOI = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TIFF_LITTLE_ENDIAN = b'II*\x00'
+TIFF_BIG_ENDIAN = b'MM\x00*'
+EXIF_HEADER = b'Exif\x00\x00'
+
+JPEG_APP1 = 0xE1
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+# Start of frame markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                              0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+# Markers that aren't followed by a length
+JPEG_STANDALONE_MARKERS = frozenset([0x01] + list(range(0xD0, 0xD8)))
+
+# The offsets of the EXIF and GPS IFDs, read along with the other IFD0 tags
+EXIF_IFD_POINTER = 'Image ExifOffset'
+GPS_IFD_POINTER = 'Image GPSInfo'
+
+IFD0_TAGS = {
+    0x0100: 'Image ImageWidth',
+    0x0101: 'Image ImageLength',
+    0x010F: 'Image Make',
+    0x0110: 'Image Model',
+    0x8769: EXIF_IFD_POINTER,
+    0x8825: GPS_IFD_POINTER,
+}
+
+EXIF_TAGS = {
+    0x829A: 'EXIF ExposureTime',
+    0x829D: 'EXIF FNumber',
+    0x8827: 'EXIF ISOSpeedRatings',
+    0x9003: 'EXIF DateTimeOriginal',
+    0x920A: 'EXIF FocalLength',
+    0xA002: 'EXIF ExifImageWidth',
+    0xA003: 'EXIF ExifImageLength',
+    0xA434: 'EXIF LensModel',
+}
+
+GPS_TAGS = {
+    0x0001: 'GPS GPSLatitudeRef',
+    0x0002: 'GPS GPSLatitude',
+    0x0003: 'GPS GPSLongitudeRef',
+    0x0004: 'GPS GPSLongitude',
+    0x0005: 'GPS GPSAltitudeRef',
+    0x0006: 'GPS GPSAltitude',
+}
+
+# TIFF field type -> (struct format of one value, size of one value)
+TIFF_TYPES = {
+    1: ('B', 1),  # BYTE
+    2: ('s', 1),  # ASCII
+    3: ('H', 2),  # SHORT
+    4: ('L', 4),  # LONG
+    5: ('LL', 8),  # RATIONAL
+    7: ('B', 1),  # UNDEFINED
+    9: ('l', 4),  # SLONG
+    10: ('ll', 8),  # SRATIONAL
+}
+
+
+class HeaderError(ValueError):
+    pass
+
+
+def read_header(path, read_size=HEADER_READ_SIZE):
+    """
+    Reads the dimensions and EXIF tags of an image from its first read_size
+    bytes.
+    :return: (width, height, tags), or None if they couldn't be read from
+        the header alone.
+    """
+    with open(path, 'rb') as f:
+        data = f.read(read_size)
+    return read_header_bytes(data)
+
+
+def read_header_bytes(data):
+    """
+    Same as read_header, for the contents of a file already read into memory
+    (or at least its start).
+    """
+    try:
+        return parse_header(data)
+    except (HeaderError, struct.error, IndexError, KeyError):
+        return None
+
+
+def parse_header(data):
+    if data.startswith(JPEG_SOI):
+        return _parse_jpeg(data)
+    elif data.startswith(PNG_SIGNATURE):
+        return _parse_png(data)
+    elif data.startswith(TIFF_LITTLE_ENDIAN) or data.startswith(
+            TIFF_BIG_ENDIAN):
+        tags = parse_tiff(data)
+        return (tags.pop('Image ImageWidth')[0],
+                tags.pop('Image ImageLength')[0], tags)
+    else:
+        raise HeaderError('Unsupported image format')
+
+
+def _parse_jpeg(data):
+    tags = {}
+    pos = len(JPEG_SOI)
+    while True:
+        if data[pos] != 0xFF:
+            raise HeaderError('Expected a JPEG marker at {}'.format(pos))
+        # Any number of 0xFF fill bytes may precede a marker
+        while data[pos] == 0xFF:
+            pos += 1
+        marker = data[pos]
+        pos += 1
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (JPEG_SOS, JPEG_EOI):
+            raise HeaderError('No SOF marker before the image data')
+        length, = struct.unpack_from('>H', data, pos)
+        segment = data[pos + 2:pos + length]
+        if len(segment) != length - 2:
+            raise HeaderError('JPEG segment is truncated')
+        if marker == JPEG_APP1 and segment.startswith(EXIF_HEADER):
+            tags = parse_tiff(segment[len(EXIF_HEADER):])
+        elif marker in JPEG_SOF_MARKERS:
+            # The APP segments holding EXIF always come before the frame
+            height, width = struct.unpack_from('>HH', segment, 1)
+            return width, height, tags
+        pos += length
+
+
+def _parse_png(data):
+    width, height = None, None
+    tags = {}
+    pos = len(PNG_SIGNATURE)
+    while True:
+        length, chunk_type = struct.unpack_from('>L4s', data, pos)
+        chunk = data[pos + 8:pos + 8 + length]
+        if len(chunk) != length:
+            raise HeaderError('PNG chunk is truncated')
+        if chunk_type == b'IHDR':
+            width, height = struct.unpack_from('>LL', chunk)
+        elif chunk_type == b'eXIf':
+            tags = parse_tiff(chunk)
+        elif chunk_type in (b'IDAT', b'IEND'):
+            # eXIf must come before the image data
+            if width is None:
+                raise HeaderError('PNG has no IHDR chunk')
+            return width, height, tags
+        pos += length + 12  # length, type and CRC
+
+
+def parse_tiff(data):
+    """
+    Parses the tags of interest out of a TIFF structure, i.e. a TIFF file
+    or the contents of an EXIF block.
+    """
+    if data.startswith(TIFF_LITTLE_ENDIAN):
+        order = '<'
+    elif data.startswith(TIFF_BIG_ENDIAN):
+        order = '>'
+    else:
+        raise HeaderError('Bad TIFF header')
+    ifd0_offset, = struct.unpack_from(order + 'L', data, 4)
+    tags = _parse_ifd(data, order, ifd0_offset, IFD0_TAGS)
+    exif_pointer = tags.pop(EXIF_IFD_POINTER, None)
+    gps_pointer = tags.pop(GPS_IFD_POINTER, None)
+    if exif_pointer is not None:
+        tags.update(_parse_ifd(data, order, exif_pointer[0], EXIF_TAGS))
+    if gps_pointer is not None:
+        tags.update(_parse_ifd(data, order, gps_pointer[0], GPS_TAGS))
+    return tags
+
+
+def _parse_ifd(data, order, offset, names):
+    """
+    Reads the entries of the IFD at offset whose tags are keys of names.
+    Other entries (maker notes, thumbnails...) aren't decoded at all.
+    :return: dict of names[tag] -> values
+    """
+    num_entries, = struct.unpack_from(order + 'H', data, offset)
+    entries = {}
+    for i in range(num_entries):
+        entry_offset = offset + 2 + 12 * i
+        tag, field_type, count = struct.unpack_from(
+            order + 'HHL', data, entry_offset)
+        if tag not in names or field_type not in TIFF_TYPES:
+            continue
+        value_format, value_size = TIFF_TYPES[field_type]
+        value_offset = entry_offset + 8
+        if value_size * count > 4:
+            value_offset, = struct.unpack_from(order + 'L', data, value_offset)
+        if value_offset + value_size * count > len(data):
+            raise HeaderError('IFD value is past the end of the header')
+        entries[names[tag]] = _read_values(
+            data, order, field_type, value_format, value_size, value_offset,
+            count)
+    return entries
+
+
+def _read_values(data, order, field_type, value_format, value_size, offset,
+                 count):
+    if field_type == 2:
+        # Like exifread, drop anything after the first null
+        raw = data[offset:offset + count].split(b'\x00', 1)[0]
+        return raw.decode('utf-8', 'replace')
+    values = []
+    for i in range(count):
+        value = struct.unpack_from(order + value_format, data,
+                                   offset + i * value_size)
+        if len(value) == 2:
+            # Some cameras write 0/0 for unknown values
+            numerator, denominator = value
+            values.append(fractions.Fraction(numerator, denominator)
+                          if denominator else None)
+        else:
+            values.append(value[0])
+    return values
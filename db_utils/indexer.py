@@ -2,59 +2,92 @@
 
 import argparse
 import datetime
+import fractions
+import functools
 import getpass
+import io
 import mock
+import multiprocessing
 import os
 
 import exifread
-import MySQLdb
 from PIL import Image as PILImage
 
+import db_utils.backends as backends
+import db_utils.batch_writer as batch_writer
+import db_utils.exif_cache as exif_cache_lib
+import db_utils.generation as generation
+import db_utils.image_header as image_header
+import db_utils.profiling as profiling
 import db_utils.record_types as record_types
+import db_utils.snapshots as snapshots
+import db_utils.thumbnails as thumbnails
+import db_utils.urls as urls
 
 DIRS_TABLE = 'dirs'
-ICON_FILE = '_icon.jpg'
+ICON_FILE = urls.ICON_FILE
 MD5_CHUNK_SIZE = 2 ** 22  # 4 MB
 PHOTOS_TABLE = 'photos'
 SUPPORTED_TYPES = frozenset(('.jpg', '.png', '.tif'))
-THUMBS_DIR = '_thumbnail'
+THUMBS_DIR = urls.THUMBS_DIR
 THUMB_PREFIX = 'thumb_'
-THUMB_SIZES = ('20', '100', '250', '500')
+THUMB_SIZES = urls.THUMB_SIZES
 UNDEFINED_INT = -1
 UNDEFINED_STR = 'Unavailable'
-PHOTO_URL_ROOT = '/photo'
-DIR_URL_ROOT = '/photos'
 USER_ROOT = '/'
 DEFAULT_ASPECT_RATIO = 4.0 / 3.0
 SQL_TIMESTAMP_FMT = '%Y-%m-%d %H:%M:%S'
+FEET_PER_METER = 3.28084
 
 EXCLUDE_DIRS = frozenset((THUMBS_DIR,))
 
+# Tasks handed to the worker pool by walk_path_parallel
+DIR_TASK = 'dir'
+PHOTO_TASK = 'photo'
+PARALLEL_CHUNK_SIZE = 16
+
 INDEX_PHOTO_STATEMENT = """REPLACE INTO {}
-    (user_path, filename, url, thumb_20_url, thumb_100_url,
-     thumb_250_url, thumb_500_url, created_time, width, height, aspect_ratio,
+    (user_path, filename, created_time, width, height, aspect_ratio,
      size, modified_time, exif_fstop, exif_focal_length, exif_iso,
      exif_shutter_speed, exif_camera, exif_lens, exif_gps_lat, exif_gps_lon,
      exif_gps_alt_ft)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-            %s, %s, %s, %s, %s, %s, %s)
+            %s, %s)
     """
 
-INDEX_DIR_STATEMENT = """REPLACE INTO {}
-    (user_path, parent_user_path, name, url, thumb_20_url, thumb_100_url,
-     thumb_250_url, thumb_500_url, width, height, aspect_ratio, created_time,
-     modified_time, num_subdirs, num_photos)
+# Rewriting a dir keeps its recursive aggregates, see db_utils.aggregates
+INDEX_DIR_STATEMENT = """INSERT INTO {}
+    (user_path, parent_user_path, name, width, height, aspect_ratio,
+     created_time, modified_time, num_subdirs, num_photos, total_photos,
+     total_size, min_created_time, max_created_time, max_modified_time)
     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE parent_user_path = VALUES(parent_user_path),
+        name = VALUES(name), width = VALUES(width), height = VALUES(height),
+        aspect_ratio = VALUES(aspect_ratio),
+        created_time = VALUES(created_time),
+        modified_time = VALUES(modified_time),
+        num_subdirs = VALUES(num_subdirs), num_photos = VALUES(num_photos)
     """
 
 
+# The subtree conditions of these statements are ranges of the primary key,
+# see batch_writer.subtree_like_pattern
 GET_DIRS_FOR_SYNC_STATEMENT = """
-    SELECT user_path FROM {} WHERE user_path like "{}%"
+    SELECT user_path FROM {}
+    WHERE user_path = %s OR user_path LIKE %s ESCAPE '!'
     """
 
 GET_PHOTOS_FOR_SYNC_STATEMENT = """
-    SELECT filename, modified_time FROM {} WHERE user_path = "{}"
+    SELECT user_path, filename, modified_time, size FROM {}
+    WHERE user_path = %s OR user_path LIKE %s ESCAPE '!'
+    """
+
+GET_PHOTOS_IN_DIRS_STATEMENT = """
+    SELECT user_path, filename, modified_time, size FROM {}
+    WHERE user_path IN ({})
     """
+# Max number of dirs per GET_PHOTOS_IN_DIRS_STATEMENT
+PHOTOS_IN_DIRS_CHUNK_SIZE = 500
 
 DELETE_DIR_STATEMENT = """
     DELETE FROM {} WHERE user_path = "{}" 
@@ -68,6 +101,10 @@ DELETE_ALL_PHOTOS_STATEMENT = """
     DELETE FROM {} WHERE user_path = "{}"
     """
 
+DELETE_SUBTREE_STATEMENT = """
+    DELETE FROM {} WHERE user_path = "{}" OR user_path LIKE "{}" ESCAPE '!'
+    """
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -75,22 +112,330 @@ def parse_args():
                         required=True)
     parser.add_argument('--root', help='The root of all photos. Will be '
                         'excluded from the path', required=True)
-    parser.add_argument('--db-host', help='mysql host', required=True)
-    parser.add_argument('--db-user', help='mysql user', required=True)
-    parser.add_argument('--db-name', help='mysql database name', required=True)
+    add_db_args(parser)
     parser.add_argument('--force', action='store_true',
                         help="If specified, don't check for an "
-                        'existing entry in the database, always index')
+                        'existing entry in the database or the EXIF cache, '
+                        'always index')
     parser.add_argument('--for-real', action='store_true',
                         help="Serious this time")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to read photo '
+                        'metadata. Rows are still written by a single '
+                        'process, in the same order as with one worker')
+    add_writer_args(parser)
+    add_exif_cache_args(parser)
+    add_snapshot_args(parser)
+    add_thumbnail_args(parser)
+    add_profiling_args(parser)
+    parser.add_argument('--count-first', action='store_true',
+                        help='Count the photos before indexing them, to '
+                        'show an ETA. Walks the whole tree one more time')
     return parser.parse_args()
 
 
-def walk_path(db, path, root, for_real):
-    for dirpath, dirnames, filenames in os.walk(path, topdown=True,
-                                                followlinks=True):
+def add_db_args(parser):
+    parser.add_argument('--db-backend', choices=backends.BACKENDS,
+                        default=backends.DEFAULT_BACKEND,
+                        help='Database the index is stored in')
+    parser.add_argument('--db-path', help='SQLite file holding the index, '
+                        'for the sqlite backend. Created if needed')
+    parser.add_argument('--db-host', help='mysql host')
+    parser.add_argument('--db-user', help='mysql user')
+    parser.add_argument('--db-name', help='mysql database name')
+
+
+def open_db(args):
+    """
+    Opens a connection to the database given on the command line, asking
+    for the password of the mysql user
+    """
+    if args.db_backend == backends.SQLITE_BACKEND:
+        if not args.db_path:
+            raise ValueError('--db-path is required for the sqlite backend')
+        return backends.SQLiteBackend(args.db_path).connect()
+    if not (args.db_host and args.db_user and args.db_name):
+        raise ValueError('--db-host, --db-user and --db-name are required '
+                         'for the mysql backend')
+    passwd = getpass.getpass(
+        'mysql password for user {}: '.format(args.db_user))
+    return backends.MySQLBackend(args.db_host, args.db_user, passwd,
+                                 args.db_name).connect()
+
+
+def add_writer_args(parser):
+    parser.add_argument('--batch-size', type=int,
+                        default=batch_writer.DEFAULT_BATCH_SIZE,
+                        help='Number of rows written per statement')
+    parser.add_argument('--commit-every', type=int,
+                        default=batch_writer.DEFAULT_COMMIT_EVERY,
+                        help='Commit after this many rows have been written. '
+                        '0 commits only once, at the end')
+    parser.add_argument('--generation-file',
+                        help='File holding the index generation, bumped '
+                        'after changes are committed so the web app drops '
+                        'its cached results. Defaults to a hidden file next '
+                        'to --root')
+
+
+def open_writer(conn, args, snapshot_store=None):
+    """
+    Creates the writer configured by add_writer_args. After each of its
+    commits, the snapshots of the dirs that changed are rebuilt in
+    snapshot_store and the index generation is bumped, unless this is a
+    dry run.
+    """
+    generation_file = get_generation_file(args) if args.for_real else None
+    return batch_writer.BatchWriter(
+        conn, batch_size=args.batch_size, commit_every=args.commit_every,
+        verbose=args.verbose,
+        on_commit=functools.partial(publish_changes,
+                                    snapshot_store=snapshot_store,
+                                    generation_file=generation_file))
+
+
+def add_profiling_args(parser):
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print every row written. Dry runs always do')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the run with cProfile and save the '
+                        'pstats data to FILE. Worker processes are not '
+                        'profiled')
+    parser.add_argument('--slowest', type=int,
+                        default=profiling.DEFAULT_SLOWEST,
+                        help='Number of slowest files listed at the end')
+    parser.add_argument('--progress-interval', type=float,
+                        default=profiling.PROGRESS_INTERVAL_SECONDS,
+                        help='Seconds between progress lines. 0 disables '
+                        'them')
+
+
+def start_profiling(args, total=None):
+    """
+    Sets up the stats of this run from the profiling args
+    :param total: the number of photos expected, for the ETA
+    """
+    profiling.stats.slowest = args.slowest
+    if args.progress_interval > 0:
+        profiling.stats.start_progress(total, args.progress_interval)
+
+
+def print_stats():
+    profiling.stats.print_progress(force=True)
+    for line in profiling.stats.report():
+        print(line)
+
+
+def get_generation_file(args):
+    return args.generation_file or generation.default_generation_path(
+        args.root)
+
+
+def add_exif_cache_args(parser):
+    parser.add_argument('--exif-cache', help='Path of the EXIF cache file. '
+                        'Defaults to a hidden file next to --root')
+    parser.add_argument('--exif-cache-size', type=int,
+                        default=exif_cache_lib.DEFAULT_MAX_ENTRIES,
+                        help='Max number of photos kept in the EXIF cache')
+    parser.add_argument('--no-exif-cache', action='store_true',
+                        help="Don't read or write the EXIF cache")
+
+
+def open_exif_cache(args):
+    """
+    Opens the EXIF cache configured by add_exif_cache_args, or returns None
+    if it's disabled. With --force the cache is only written, never read.
+    """
+    if args.no_exif_cache:
+        return None
+    filename = args.exif_cache or exif_cache_lib.default_cache_path(args.root)
+    return exif_cache_lib.ExifCache(filename, max_entries=args.exif_cache_size,
+                                    refresh=args.force)
+
+
+def add_snapshot_args(parser):
+    parser.add_argument('--snapshot-dir',
+                        help='Directory where the JSON served for each dir '
+                        'is written. Defaults to a hidden directory next to '
+                        '--root')
+    parser.add_argument('--no-snapshots', action='store_true',
+                        help="Don't write the JSON snapshots of the dirs "
+                        'that changed')
+
+
+def open_snapshot_store(args):
+    """
+    Opens the snapshot store configured by add_snapshot_args, or returns
+    None if it's disabled or this is a dry run.
+    """
+    if args.no_snapshots or not args.for_real:
+        return None
+    return snapshots.SnapshotStore(
+        args.snapshot_dir or snapshots.default_snapshot_dir(args.root),
+        thumb_formats=args.thumbnail_formats)
+
+
+def add_thumbnail_args(parser):
+    parser.add_argument('--thumbnails', action='store_true',
+                        help='Also write the missing or outdated thumbnails '
+                        'of the photos that are indexed, reading each photo '
+                        'only once for both. Ignored on a dry run')
+    parser.add_argument('--thumbnail-formats', type=thumbnails.parse_formats,
+                        default=[],
+                        help='Comma-separated extra formats to write the '
+                        'thumbnails in besides JPEG, among {}. Also '
+                        'advertised in the snapshots'.format(
+                            ', '.join(thumbnails.FORMATS)))
+
+
+def get_thumb_formats(args):
+    """
+    Gets the thumb_formats to pass to index_photo for add_thumbnail_args
+    """
+    if args.thumbnails and args.for_real:
+        return args.thumbnail_formats
+    return None
+
+
+def publish_changes(writer, snapshot_store=None, generation_file=None):
+    """
+    Rebuilds the snapshots of the dirs that changed since the last call and
+    bumps the index generation, so the web app stops serving what they held
+    before. Meant to run after each commit of the writer (see open_writer),
+    periodic ones included, so a long run never leaves committed rows
+    behind stale snapshots.
+    """
+    if not writer.touched_dirs:
+        return
+    if snapshot_store is not None:
+        with profiling.stats.timer('snapshots'):
+            snapshots.write_snapshots(writer.conn, snapshot_store,
+                                      writer.touched_dirs)
+    writer.touched_dirs.clear()
+    if generation_file is not None:
+        generation.bump_generation(generation_file)
+
+
+def walk_path(writer, path, root, for_real, workers=1, exif_cache=None,
+              thumb_formats=None):
+    if workers > 1:
+        walk_path_parallel(writer, path, root, for_real, workers,
+                           exif_cache=exif_cache, thumb_formats=thumb_formats)
+        return
+    for dirpath, dirnames, filenames in walk_dirs(path):
+        index_dir(writer, root, dirpath, dirnames, filenames, for_real,
+                  exif_cache=exif_cache, thumb_formats=thumb_formats)
+
+
+def walk_dirs(path):
+    """
+    Walks the photo tree below path, skipping thumbnail directories.
+    Yields (dirpath, dirnames, filenames) like os.walk.
+    """
+    walk = os.walk(path, topdown=True, followlinks=True)
+    while True:
+        # Only time the listing, not what the caller does with each dir
+        with profiling.stats.timer('walk'):
+            entry = next(walk, None)
+        if entry is None:
+            return
+        dirpath, dirnames, filenames = entry
         dirnames[:] = [d for d in dirnames if d not in EXCLUDE_DIRS]
-        index_dir(db, root, dirpath, dirnames, filenames, for_real)
+        yield dirpath, dirnames, filenames
+
+
+def count_photos(path):
+    """
+    Counts the photos below path, to show an ETA
+    """
+    count = 0
+    with profiling.stats.timer('count'):
+        for dirpath, dirnames, filenames in os.walk(path, topdown=True,
+                                                    followlinks=True):
+            dirnames[:] = [d for d in dirnames if d not in EXCLUDE_DIRS]
+            count += len([f for f in filenames if is_photo_file(f)])
+    return count
+
+
+def walk_path_parallel(writer, path, root, for_real, workers,
+                       exif_cache=None, thumb_formats=None):
+    """
+    Same as walk_path, but reads photo metadata in a pool of worker
+    processes. The walk produces one task per photo followed by one task
+    for the directory itself, exactly the order index_dir uses, and the
+    results are consumed in that order by this (single) writer process, so
+    the rows written are identical to the serial path.
+
+    The EXIF cache is only accessed from this process: photos with an up to
+    date cache entry are sent to the workers with their Exif already filled
+    in, and freshly read Exif is sent back to be cached. The same goes for
+    the dimensions of the thumbnails written by the workers, which are
+    recorded once their whole dir is done.
+    """
+    tasks = _generate_index_tasks(path, root, exif_cache, thumb_formats)
+    # dirpath -> filename -> thumbnail dimensions
+    thumb_dims = {}
+    with multiprocessing.Pool(processes=workers,
+                              initializer=_init_index_worker) as pool:
+        for kind, record, stats in pool.imap(_run_index_task, tasks,
+                                             chunksize=PARALLEL_CHUNK_SIZE):
+            profiling.stats.merge(stats)
+            if kind == DIR_TASK:
+                print("Indexing {}".format(record.user_path))
+                write_dir(writer, record, for_real)
+                for dirpath, dims in thumb_dims.items():
+                    thumbnails.record_dimensions(dirpath, dims)
+                thumb_dims.clear()
+            else:
+                photo, path, stat, new_exif, dims = record
+                if new_exif is not None and exif_cache is not None:
+                    exif_cache.put(path, stat, new_exif)
+                if dims:
+                    thumb_dims.setdefault(os.path.dirname(path), {})[
+                        photo.filename] = dims
+                write_photo(writer, photo, for_real)
+
+
+def _generate_index_tasks(path, root, exif_cache, thumb_formats=None):
+    for dirpath, dirnames, filenames in walk_dirs(path):
+        user_path = get_user_path(dirpath, root)
+        for filename in filenames:
+            if not is_photo_file(filename):
+                continue
+            photo_path = os.path.join(dirpath, filename)
+            stat = exif = None
+            if exif_cache is not None:
+                stat = os.stat(photo_path)
+                exif = exif_cache.get(photo_path, stat)
+            yield PHOTO_TASK, (user_path, photo_path, filename, stat, exif,
+                               thumb_formats)
+        yield DIR_TASK, (root, dirpath, list(dirnames), list(filenames))
+
+
+def _init_index_worker():
+    """
+    Runs in each worker process when it starts. Only the writer process
+    prints progress, from the stats the workers send back.
+    """
+    profiling.stats.progress_start = None
+
+
+def _run_index_task(task):
+    """
+    Runs in a worker process. Returns (kind, record, stats), stats being
+    what the task added to the worker's profiling stats.
+    """
+    kind, args = task
+    if kind == DIR_TASK:
+        return kind, build_dir(*args), profiling.stats.take()
+    user_path, path, filename, stat, exif, thumb_formats = args
+    with profiling.stats.file_timer(path):
+        if stat is None:
+            stat = os.stat(path)
+        new_exif, dims = read_photo(path, stat, exif,
+                                    thumb_formats=thumb_formats)
+    photo = build_photo(user_path, filename, exif or new_exif, stat)
+    return kind, (photo, path, stat, new_exif, dims), profiling.stats.take()
 
 
 def get_user_path(path, root):
@@ -101,14 +446,23 @@ def get_user_path(path, root):
         is located
     :param root: path on the local disk that is the root of all
         photos and dirs
+
+    For example:
+    >>> get_user_path('/photos/2017/shots', '/photos')
+    '/2017/shots'
+    >>> get_user_path('/photos/', '/photos')
+    '/'
     """
-    user_path = path.lstrip(root)
-    if not user_path.startswith('/'):
-        user_path = "/{}".format(user_path)
-    return user_path
+    relative = os.path.relpath(path, root)
+    if relative == os.curdir:
+        return USER_ROOT
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        raise ValueError('{} is not below {}'.format(path, root))
+    return '/' + relative
 
 
-def index_dir(db, root, dirpath, dirnames, filenames, for_real):
+def index_dir(writer, root, dirpath, dirnames, filenames, for_real,
+              exif_cache=None, thumb_formats=None):
     """
     Reference of variable names used here for the example path
     "/photos/albums/2017/2017 08-19 Yosemite"
@@ -123,24 +477,36 @@ def index_dir(db, root, dirpath, dirnames, filenames, for_real):
     print("Indexing {}".format(user_path))
 
     # Index all non-thumbnail photos
+    thumb_dims = {}
     for filename in filenames:
-        index_photo(db, user_path, dirpath, filename, for_real)
+        dims = index_photo(writer, user_path, dirpath, filename, for_real,
+                           exif_cache=exif_cache, thumb_formats=thumb_formats)
+        if dims:
+            thumb_dims[filename] = dims
+    if thumb_dims:
+        thumbnails.record_dimensions(dirpath, thumb_dims)
 
     # Index the directory itself
+    write_dir(writer, build_dir(root, dirpath, dirnames, filenames), for_real)
+
+
+def build_dir(root, dirpath, dirnames, filenames):
+    """
+    Builds the Dir record for a directory. Doesn't touch the database, so
+    it can run in a worker process.
+    """
+    user_path = get_user_path(dirpath, root)
     num_subdirs = len([d for d in dirnames if not d.endswith(THUMBS_DIR)])
-    thumb_urls = get_dir_thumb_urls(user_path)
-    width, height, aspect_ratio = get_dir_thumbnail_dimensions(dirpath)
-    # num_photos is not a recursive sum (though maybe it should be)
+    with profiling.stats.timer('dir_thumbnail_dimensions'):
+        width, height, aspect_ratio = get_dir_thumbnail_dimensions(dirpath)
+    # Both counts are replaced by those of the rows in the database when the
+    # aggregates are applied. The recursive sums start at 0 and are only
+    # computed there too.
     num_photos = len([f for f in filenames if f != ICON_FILE])
     dir_obj = record_types.Dir(
         user_path=user_path,
         parent_user_path=get_parent_dir(user_path),
         name=os.path.basename(dirpath),
-        url=get_dir_url(user_path),
-        thumb_20_url=thumb_urls[0],
-        thumb_100_url=thumb_urls[1],
-        thumb_250_url=thumb_urls[2],
-        thumb_500_url=thumb_urls[3],
         width=width,
         height=height,
         aspect_ratio=aspect_ratio,
@@ -148,44 +514,103 @@ def index_dir(db, root, dirpath, dirnames, filenames, for_real):
         modified_time=_epoch_to_sql_timestamp(os.path.getmtime(dirpath)),
         num_subdirs=num_subdirs,
         num_photos=num_photos,
+        total_photos=0,
+        total_size=0,
+        min_created_time=None,
+        max_created_time=None,
+        max_modified_time=None,
     )
+    return dir_obj
+
+
+def write_dir(writer, dir_obj, for_real):
     query = INDEX_DIR_STATEMENT.format(DIRS_TABLE)
-    dr = "DRY RUN: " if not for_real else ""
-    print("{}{}".format(dr, query % dir_obj))
+    print_statement(writer, for_real, query, dir_obj)
+    profiling.stats.count('dirs')
     if for_real:
-        db.execute(query, dir_obj)
+        touch_dir(writer, dir_obj.user_path)
+        invalidate_aggregates(writer, dir_obj.user_path)
+        writer.replace(DIRS_TABLE, query, dir_obj)
 
 
-def index_photo(db, user_path, dirpath, filename, for_real):
-    # Don't index icons
-    if filename == ICON_FILE:
-        return
-    # Don't index unsupported types
-    if not is_image_supported(filename):
-        return
+def index_photo(writer, user_path, dirpath, filename, for_real,
+                exif_cache=None, stat=None, thumb_formats=None):
+    """
+    :param stat: os.stat_result of the photo, if the caller already has it
+    :param thumb_formats: if not None, also write the missing or outdated
+        thumbnails of the photo, in JPEG and in these extra
+        thumbnails.FORMATS
+    :return: dict of size -> (width, height) of the thumbnails written, to
+        be recorded with thumbnails.record_dimensions
+    """
+    # Don't index icons or unsupported types
+    if not is_photo_file(filename):
+        return {}
 
     # The "path" includes the root and points to the actual file on disk.
     # The "user_path" is what appears to the user and the breadcrumb hierarchy.
     path = os.path.join(dirpath, filename)
-
-    exif = get_exif(path)
-    thumb_urls = get_photo_thumb_urls(user_path, filename)
-
+    with profiling.stats.file_timer(path):
+        if stat is None:
+            stat = os.stat(path)
+        # Use the cached Exif if it's up to date
+        exif = None
+        if exif_cache is not None:
+            exif = exif_cache.get(path, stat)
+        new_exif, thumb_dims = read_photo(path, stat, exif,
+                                          thumb_formats=thumb_formats)
+    if new_exif is not None and exif_cache is not None:
+        exif_cache.put(path, stat, new_exif)
+    write_photo(writer, build_photo(user_path, filename, exif or new_exif,
+                                    stat), for_real)
+    return thumb_dims
+
+
+def read_photo(path, stat, exif=None, thumb_formats=None):
+    """
+    Reads the Exif of a photo, unless it's already known, and writes its
+    missing or outdated thumbnails if thumb_formats isn't None (see
+    index_photo). When both are needed the file is only read once.
+    :param exif: the Exif of the photo, if already known
+    :return: (new_exif, thumb_dims), new_exif being the Exif read, or None
+        if exif was given, and thumb_dims the dict of size -> (width, height)
+        of the thumbnails written
+    """
+    dirpath, filename = os.path.split(path)
+    sizes = []
+    if thumb_formats is not None:
+        sizes = thumbnails.get_outdated_sizes(dirpath, filename,
+                                              stat.st_mtime,
+                                              formats=thumb_formats)
+    if not sizes:
+        return (get_exif(path) if exif is None else None), {}
+
+    with profiling.stats.timer('read_file'):
+        with open(path, 'rb') as f:
+            data = f.read()
+    new_exif = get_exif(path, data=data) if exif is None else None
+    with profiling.stats.timer('thumbnails'):
+        with PILImage.open(io.BytesIO(data)) as image:
+            thumb_dims = thumbnails.render_thumbnails(
+                image, dirpath, filename, sizes, thumb_formats)
+    return new_exif, thumb_dims
+
+
+def build_photo(user_path, filename, exif, stat):
+    """
+    Builds the Photo record for a file from its Exif and os.stat_result.
+    Doesn't touch the disk or the database.
+    """
     # Format the modified time as a sql datetime
-    modified_dt = _epoch_to_sql_timestamp(os.path.getmtime(path))
+    modified_dt = _epoch_to_sql_timestamp(stat.st_mtime)
     photo = record_types.Photo(
         user_path=user_path,
         filename=filename,
-        url=get_image_url(user_path, filename),
-        thumb_20_url=thumb_urls[0],
-        thumb_100_url=thumb_urls[1],
-        thumb_250_url=thumb_urls[2],
-        thumb_500_url=thumb_urls[3],
         created_time=exif.created,
         width=exif.width,
         height=exif.height,
         aspect_ratio=(exif.width / exif.height),
-        size=os.path.getsize(path),
+        size=stat.st_size,
         modified_time=modified_dt,
         exif_fstop=exif.fstop,
         exif_focal_length=exif.focal_length,
@@ -197,76 +622,111 @@ def index_photo(db, user_path, dirpath, filename, for_real):
         exif_gps_lon=exif.gps_lon,
         exif_gps_alt_ft=exif.gps_alt_ft,
     )
-    query = INDEX_PHOTO_STATEMENT.format(PHOTOS_TABLE)
-    dr = "DRY RUN: " if not for_real else ""
-    print("{}{}".format(dr, query % photo))
-    if for_real:
-        db.execute(query, photo)
+    return photo
 
 
-def delete_dir(db, user_path, for_real):
-    query = DELETE_DIR_STATEMENT.format(DIRS_TABLE, user_path)
-    dr = "DRY RUN: " if not for_real else ""
-    print("{}{}".format(dr, query))
+def write_photo(writer, photo, for_real):
+    query = INDEX_PHOTO_STATEMENT.format(PHOTOS_TABLE)
+    print_statement(writer, for_real, query, photo)
     if for_real:
-        db.execute(query)
+        # Recorded before queueing the row, which may fill a batch and
+        # trigger a commit, so the commit includes the row's aggregates
+        writer.touched_dirs.add(photo.user_path)
+        writer.aggregates.add_photo(photo)
+        writer.replace(PHOTOS_TABLE, query, photo)
 
 
-def delete_photo(db, user_path, filename, for_real):
-    query = DELETE_PHOTO_STATEMENT.format(PHOTOS_TABLE, user_path, filename)
-    dr = "DRY RUN: " if not for_real else ""
-    print("{}{}".format(dr, query))
+def delete_dir(writer, user_path, for_real):
+    print_statement(writer, for_real, DELETE_DIR_STATEMENT.format(
+        DIRS_TABLE, user_path))
     if for_real:
-        db.execute(query)
+        touch_dir(writer, user_path)
+        invalidate_aggregates(writer, user_path)
+        writer.delete(DIRS_TABLE, ('user_path',), (user_path,))
 
 
-def delete_photos_in_dir(db, user_path, for_real):
-    query = DELETE_ALL_PHOTOS_STATEMENT.format(PHOTOS_TABLE, user_path)
-    dr = "DRY RUN: " if not for_real else ""
-    print("{}{}".format(dr, query))
+def delete_photo(writer, user_path, filename, for_real):
+    print_statement(writer, for_real, DELETE_PHOTO_STATEMENT.format(
+        PHOTOS_TABLE, user_path, filename))
     if for_real:
-        db.execute(query)
+        writer.touched_dirs.add(user_path)
+        writer.aggregates.invalidate(user_path)
+        writer.delete(PHOTOS_TABLE, ('user_path', 'filename'),
+                      (user_path, filename))
 
 
-def is_image_supported(filename):
-    extension = os.path.splitext(filename)[1].lower()
-    return extension in SUPPORTED_TYPES
+def delete_photos_in_dir(writer, user_path, for_real):
+    print_statement(writer, for_real, DELETE_ALL_PHOTOS_STATEMENT.format(
+        PHOTOS_TABLE, user_path))
+    if for_real:
+        writer.touched_dirs.add(user_path)
+        writer.aggregates.invalidate(user_path)
+        writer.delete(PHOTOS_TABLE, ('user_path',), (user_path,))
 
 
-def get_image_url(user_path, filename):
+def delete_subtree(writer, user_path, for_real, removed_dirs=()):
     """
-    Gets the URL for a full-sized image
+    Deletes a dir, all the dirs below it and all their photos, with one
+    statement per table however many dirs there are.
+    :param removed_dirs: the user paths of the dirs below it, whose
+        snapshots are deleted too
     """
-    return os.path.join(PHOTO_URL_ROOT, user_path.lstrip('/'), filename)
+    pattern = batch_writer.subtree_like_pattern(user_path)
+    for table in (DIRS_TABLE, PHOTOS_TABLE):
+        print_statement(writer, for_real, DELETE_SUBTREE_STATEMENT.format(
+            table, user_path, pattern))
+    if for_real:
+        touch_dir(writer, user_path)
+        writer.touched_dirs.update(removed_dirs)
+        invalidate_aggregates(writer, user_path)
+        writer.delete_subtree(DIRS_TABLE, 'user_path', user_path)
+        writer.delete_subtree(PHOTOS_TABLE, 'user_path', user_path)
 
 
-def get_dir_url(user_path):
+def print_statement(writer, for_real, query, args=None):
     """
-    Gets the URL for a directory
+    Prints a statement written to the database, with its args filled in.
+    Only dry runs and verbose writers print them, since formatting and
+    printing every row slows down large runs.
     """
-    return os.path.join(DIR_URL_ROOT, user_path.lstrip('/'))
+    if for_real and not writer.verbose:
+        return
+    dr = "DRY RUN: " if not for_real else ""
+    print("{}{}".format(dr, query if args is None else query % args))
 
 
-def get_photo_thumb_urls(user_path, filename):
-    res = []
-    for size in THUMB_SIZES:
-        res.append(get_thumb_url(user_path, filename, size))
-    return res
+def touch_dir(writer, user_path):
+    """
+    Records that the row of a dir was written, which changes both its own
+    snapshot and the listing of its parent
+    """
+    writer.touched_dirs.add(user_path)
+    parent = get_parent_dir(user_path)
+    if parent is not None:
+        writer.touched_dirs.add(parent)
 
 
-def get_dir_thumb_urls(user_path):
-    res = []
-    for size in THUMB_SIZES:
-        res.append(get_thumb_url(user_path, ICON_FILE, size))
-    return res
+def invalidate_aggregates(writer, user_path):
+    """
+    Records that the row of a dir was written or deleted, so that both its
+    aggregates and those of its parent (e.g. num_subdirs) are recomputed
+    """
+    writer.aggregates.invalidate(user_path)
+    parent = get_parent_dir(user_path)
+    if parent is not None:
+        writer.aggregates.invalidate(parent)
 
 
-def get_thumb_url(user_path, filename, size):
+def is_photo_file(filename):
     """
-    Gets a URL for the thumbnail of a given photo filename and size
+    Whether a file in a photo directory should be indexed as a photo
     """
-    return os.path.join(PHOTO_URL_ROOT, user_path.lstrip('/'), THUMBS_DIR,
-                        str(size), filename)
+    return filename != ICON_FILE and is_image_supported(filename)
+
+
+def is_image_supported(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return extension in SUPPORTED_TYPES
 
 
 def get_dir_thumb_file(dirpath, size):
@@ -281,9 +741,16 @@ def get_dir_thumbnail_dimensions(dirpath):
     """
     In order to show a directory thumbnail image in the image grid properly,
     we need to know the dimensions and aspect ratio of the thumbnail.
+
+    They're normally recorded when the thumbnail is written. Only icons
+    written before dimensions were recorded are read.
     """
     # Use the largest thumbnail size to calculate the aspect ratio.
     size = int(THUMB_SIZES[-1])
+    dims = thumbnails.read_dimensions(dirpath).get(ICON_FILE, {}).get(size)
+    if dims is not None:
+        width, height = dims
+        return width, height, (width / height)
     thumb_file = get_dir_thumb_file(dirpath, size)
     if os.path.exists(thumb_file):
         exif = get_exif(thumb_file)
@@ -300,48 +767,84 @@ def get_parent_dir(user_path):
 
 
 def get_size_from_pillow(path):
-    image = PILImage.open(path)
-    return image.size
+    """
+    :param path: a filename or a file object
+    """
+    with profiling.stats.timer('pillow_size'):
+        image = PILImage.open(path)
+        return image.size
 
 
 def _exif_val(tags, key, default=None, index=None):
     try:
         if index is None:
-            return tags[key].values
+            return tags[key]
         else:
-            return tags[key].values[index]
-    except KeyError:
+            return tags[key][index]
+    except (KeyError, IndexError):
         return default
 
 
-def get_exif(path):
-    """Returns an Exif namedtuple of exif data in an image"""
-    with open(path, 'rb') as f:
-        tags = exifread.process_file(f)
+def _to_fraction(value):
+    """
+    Converts an exifread Ratio, a Fraction or an int to a Fraction.
+    Returns None for undefined values such as 0/0.
+    """
+    if value is None:
+        return None
+    if hasattr(value, 'den'):
+        if not value.den:
+            return None
+        return fractions.Fraction(value.num, value.den)
+    return fractions.Fraction(value)
+
+
+def get_exif(path, data=None):
+    """Returns an Exif namedtuple of exif data in an image
+
+    Most files are handled by image_header, which only reads the start of
+    the file. Anything it can't handle goes through exifread instead.
+    :param data: the contents of the file at path, if already read
+    """
+    with profiling.stats.timer('read_header'):
+        if data is not None:
+            header = image_header.read_header_bytes(data)
+        else:
+            header = image_header.read_header(path)
+    if header is not None:
+        width, height, tags = header
+    else:
+        with _open_image(path, data) as f, profiling.stats.timer('exifread'):
+            # details=False skips decoding maker notes and thumbnails
+            exif_tags = exifread.process_file(f, details=False)
+        tags = {key: tag.values for key, tag in exif_tags.items()}
+        width, height = None, None
 
     # We need at least width and height to be able to render the image grid
     # correctly. If width and height aren't present in EXIF, then fall back
-    # to using the Pillow library instead.
+    # to the size of the image itself, which for odd files means asking the
+    # Pillow library.
     if 'EXIF ExifImageWidth' in tags and 'EXIF ExifImageLength' in tags:
         width = _exif_val(tags, 'EXIF ExifImageWidth', UNDEFINED_INT, 0)
         height = _exif_val(tags, 'EXIF ExifImageLength', UNDEFINED_STR, 0)
-    else:
-        width, height = get_size_from_pillow(path)
+    elif width is None:
+        with _open_image(path, data) as f:
+            width, height = get_size_from_pillow(f)
     created = _exif_val(tags, 'EXIF DateTimeOriginal', UNDEFINED_STR)
     camera_make = _exif_val(tags, 'Image Make', UNDEFINED_STR)
     camera_model = _exif_val(tags, 'Image Model', UNDEFINED_STR)
     lens = _exif_val(tags, 'EXIF LensModel', UNDEFINED_STR)
-    speed = str(_exif_val(tags, 'EXIF ExposureTime', UNDEFINED_STR, 0))
-    focal_length = _exif_val(tags, 'EXIF FocalLength', UNDEFINED_STR, 0)
-    fstop = _exif_val(tags, 'EXIF FNumber', UNDEFINED_STR, 0)  # Ratio object
+    speed = _to_fraction(_exif_val(tags, 'EXIF ExposureTime', None, 0))
+    focal_length = _to_fraction(_exif_val(tags, 'EXIF FocalLength', None, 0))
+    fstop = _to_fraction(_exif_val(tags, 'EXIF FNumber', None, 0))
     iso = str(_exif_val(tags, 'EXIF ISOSpeedRatings', UNDEFINED_STR, 0))
-    # TODO: GPS
 
-    # Format fstop and camera
-    if fstop != UNDEFINED_STR:
-        fstop_formatted = '{:.1f}'.format(fstop.num / fstop.den)
+    # Format fstop, shutter speed and camera
+    if fstop is not None:
+        fstop_formatted = '{:.1f}'.format(float(fstop))
     else:
         fstop_formatted = UNDEFINED_STR
+    speed_formatted = str(speed) if speed is not None else UNDEFINED_STR
     if camera_make != UNDEFINED_STR and camera_model != UNDEFINED_STR:
         camera_formatted = '{} {}'.format(camera_make, camera_model)
     else:
@@ -351,19 +854,71 @@ def get_exif(path):
     created_dt = _convert_exif_timestamp(created)
 
     # Format focal length
-    if focal_length != UNDEFINED_STR:
-        focal_length_fmt = '{:d}'.format(focal_length.num // focal_length.den)
+    if focal_length is not None:
+        focal_length_fmt = '{:d}'.format(
+            focal_length.numerator // focal_length.denominator)
     else:
         focal_length_fmt = UNDEFINED_STR
 
+    # Format GPS coordinates as decimal degrees, altitude in feet
+    gps_lat = _gps_degrees(_exif_val(tags, 'GPS GPSLatitude'),
+                           _exif_val(tags, 'GPS GPSLatitudeRef'), 'S')
+    gps_lon = _gps_degrees(_exif_val(tags, 'GPS GPSLongitude'),
+                           _exif_val(tags, 'GPS GPSLongitudeRef'), 'W')
+    gps_alt_ft = _gps_altitude_ft(
+        _exif_val(tags, 'GPS GPSAltitude', None, 0),
+        _exif_val(tags, 'GPS GPSAltitudeRef', 0, 0))
+
     return record_types.Exif(
         width=width, height=height, created=created_dt, fstop=fstop_formatted,
-        focal_length=focal_length_fmt, iso=iso, shutter_speed=speed,
-        camera=camera_formatted, lens=lens, gps_lat=None, gps_lon=None,
-        gps_alt_ft=None
+        focal_length=focal_length_fmt, iso=iso, shutter_speed=speed_formatted,
+        camera=camera_formatted, lens=lens, gps_lat=gps_lat, gps_lon=gps_lon,
+        gps_alt_ft=gps_alt_ft
     )
 
 
+def _open_image(path, data=None):
+    if data is not None:
+        return io.BytesIO(data)
+    return open(path, 'rb')
+
+
+def _gps_degrees(values, ref, negative_ref):
+    """
+    Converts EXIF GPS (degrees, minutes, seconds) to decimal degrees.
+
+    For example:
+    >>> _gps_degrees([37, 44, fractions.Fraction(753, 25)], 'S', 'S')
+    '-37.741700'
+    """
+    if not values or len(values) != 3:
+        return None
+    parts = [_to_fraction(v) for v in values]
+    if None in parts:
+        return None
+    degrees = parts[0] + parts[1] / 60 + parts[2] / 3600
+    if ref == negative_ref:
+        degrees = -degrees
+    return '{:.6f}'.format(float(degrees))
+
+
+def _gps_altitude_ft(altitude, ref):
+    """
+    Converts an EXIF GPS altitude in meters to feet. A ref of 1 means below
+    sea level.
+
+    For example:
+    >>> _gps_altitude_ft(fractions.Fraction(1200), 0)
+    '3937'
+    """
+    meters = _to_fraction(altitude)
+    if meters is None:
+        return None
+    if ref == 1:
+        meters = -meters
+    return '{:.0f}'.format(float(meters) * FEET_PER_METER)
+
+
 def _convert_exif_timestamp(exif_time):
     """Converts timestamp format in exif to a sql datetime
 
@@ -394,40 +949,91 @@ def _epoch_to_sql_timestamp(epoch_time):
 
 
 def get_dirs_for_sync(db, user_path):
-    db.execute(GET_DIRS_FOR_SYNC_STATEMENT.format(DIRS_TABLE, user_path))
-    return [path for path, in db.fetchall()]
+    """
+    Gets the user paths of user_path and all the dirs below it
+    """
+    with profiling.stats.timer('db_read'):
+        db.execute(GET_DIRS_FOR_SYNC_STATEMENT.format(DIRS_TABLE),
+                   (user_path, batch_writer.subtree_like_pattern(user_path)))
+        return [path for path, in db.fetchall()]
 
 
-def get_photos_for_sync(db, user_path):
-    db.execute(GET_PHOTOS_FOR_SYNC_STATEMENT.format(PHOTOS_TABLE, user_path))
-    photo_times = {}
-    for filename, modified_time in db.fetchall():
-        photo_times[filename] = modified_time.timestamp()
-    return photo_times
+def get_photos_for_sync(conn, user_path):
+    """
+    Loads every photo in the subtree at user_path with a single query,
+    streamed from the server rather than buffered.
+    :return: dict of (user_path, filename) -> (modified_time, size)
+    """
+    db = backends.streaming_cursor(conn)
+    try:
+        with profiling.stats.timer('db_read'):
+            db.execute(GET_PHOTOS_FOR_SYNC_STATEMENT.format(PHOTOS_TABLE),
+                       (user_path,
+                        batch_writer.subtree_like_pattern(user_path)))
+            return {(photo_user_path, filename): (modified_time, size)
+                    for photo_user_path, filename, modified_time, size in db}
+    finally:
+        db.close()
 
 
-def mock_execute(query, obj):
-    print(query % obj)
+def get_photos_in_dirs(conn, user_paths):
+    """
+    Same as get_photos_for_sync, but only loads the photos directly in the
+    given dirs.
+    """
+    user_paths = sorted(user_paths)
+    photos = {}
+    db = conn.cursor()
+    try:
+        for i in range(0, len(user_paths), PHOTOS_IN_DIRS_CHUNK_SIZE):
+            chunk = user_paths[i:i + PHOTOS_IN_DIRS_CHUNK_SIZE]
+            query = GET_PHOTOS_IN_DIRS_STATEMENT.format(
+                PHOTOS_TABLE, ', '.join(['%s'] * len(chunk)))
+            with profiling.stats.timer('db_read'):
+                db.execute(query, chunk)
+                rows = db.fetchall()
+            for photo_user_path, filename, modified_time, size in rows:
+                photos[(photo_user_path, filename)] = (modified_time, size)
+    finally:
+        db.close()
+    return photos
+
+
+def is_photo_changed(stat, modified_time, size):
+    """
+    Whether a photo on disk differs from its row in the database, given the
+    modified_time (a datetime, only precise to the second) and size of the
+    row.
+    """
+    local_time = datetime.datetime.fromtimestamp(int(stat.st_mtime))
+    return stat.st_size != size or local_time != modified_time
 
 
 def main():
     args = parse_args()
     if args.for_real:
-        passwd = getpass.getpass(
-            'mysql password for user {}: '.format(args.db_user))
-        conn = MySQLdb.connect(host=args.db_host, user=args.db_user,
-                               passwd=passwd, db=args.db_name)
-        db = conn.cursor()
+        conn = open_db(args)
     else:
-        db = mock.Mock()
         conn = mock.Mock()
-        db.execute = mock_execute
+    snapshot_store = open_snapshot_store(args)
+    writer = open_writer(conn, args, snapshot_store)
+    exif_cache = open_exif_cache(args)
+    total = None
+    if args.count_first and args.progress_interval > 0:
+        total = count_photos(args.path)
+    start_profiling(args, total)
     try:
-        walk_path(db, args.path, args.root, args.for_real)
+        with profiling.profile(args.profile):
+            walk_path(writer, args.path, args.root, args.for_real,
+                      workers=args.workers, exif_cache=exif_cache,
+                      thumb_formats=get_thumb_formats(args))
+            writer.commit()
     finally:
-        conn.commit()
-        db.close()
+        writer.close()
         conn.close()
+        if exif_cache is not None:
+            exif_cache.close()
+        print_stats()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,126 @@
+"""
+Minimal Linux inotify binding (via ctypes, no extra dependencies) and a
+recursive directory watcher built on it.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+# Event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Changes to the entries of a watched dir. Writes only matter once the file
+# is closed, and rsync writes to a temporary file and renames it anyway.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+READ_SIZE = 2 ** 16
+
+
+class Inotify(object):
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._check(self._libc.inotify_init1(IN_CLOEXEC))
+
+    def _check(self, result, path=None):
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return result
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watches path. Returns the watch descriptor.
+        """
+        return self._check(self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask), path)
+
+    def read_events(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for events.
+        :return: list of (wd, mask, cookie, name) tuples, empty if the
+            timeout expired
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, READ_SIZE)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TreeWatcher(object):
+    """
+    Watches every directory below a path, including directories created
+    later, except those named in exclude.
+    """
+
+    def __init__(self, path, exclude=frozenset()):
+        self.path = path
+        self.exclude = exclude
+        self.inotify = Inotify()
+        self.paths = {}  # wd -> dirpath
+        self.watch_tree(path)
+
+    def watch_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+            dirnames[:] = [d for d in dirnames if d not in self.exclude]
+            try:
+                self.paths[self.inotify.add_watch(dirpath)] = dirpath
+            except OSError:
+                # Removed before we got to it
+                pass
+
+    def read_changed_dirs(self, timeout=None):
+        """
+        Waits up to timeout seconds for changes.
+        :return: the set of dirs whose entries changed. If events were lost
+            because the kernel queue overflowed, that's the root path.
+        """
+        changed = set()
+        for wd, mask, cookie, name in self.inotify.read_events(timeout):
+            if mask & IN_Q_OVERFLOW:
+                changed.add(self.path)
+                continue
+            if mask & IN_IGNORED:
+                # The dir was removed, so the kernel removed the watch
+                self.paths.pop(wd, None)
+                continue
+            dirpath = self.paths.get(wd)
+            if dirpath is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Also reported as a change of the parent dir
+                continue
+            if name in self.exclude:
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(os.path.join(dirpath, name))
+            changed.add(dirpath)
+        return changed
+
+    def close(self):
+        self.inotify.close()
@@ -0,0 +1,130 @@
+"""
+Renders missing thumbnails when they're first requested, for the web app.
+
+A request for a thumbnail that doesn't exist yet renders all the thumbnails
+of its photo with db_utils.thumbnails, which writes them atomically next to
+the other thumbnails, so later requests find them on disk. Concurrent
+requests for the thumbnails of the same photo wait for a single render, and
+at most max_renders photos are rendered at once per process, so a crawler
+can't keep every CPU busy.
+"""
+import collections
+import os
+import threading
+
+import db_utils.thumbnails as thumbnails
+import db_utils.urls as urls
+
+DEFAULT_MAX_RENDERS = 2
+DEFAULT_TIMEOUT_SECONDS = 30
+RETRY_AFTER_SECONDS = 5
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+class ThumbnailRenderer(object):
+    def __init__(self, max_renders=DEFAULT_MAX_RENDERS,
+                 timeout=DEFAULT_TIMEOUT_SECONDS, formats=()):
+        """
+        :param max_renders: max number of photos rendered at once
+        :param timeout: max seconds a request waits for a render slot, or
+            for the render of the same photo by another request
+        :param formats: extra thumbnails.FORMATS to render thumbnails in
+        """
+        self.max_renders = max_renders
+        self.timeout = timeout
+        self.formats = formats
+        self.render_slots = threading.BoundedSemaphore(max_renders)
+        self.lock = threading.Lock()
+        # source -> threading.Event set once its render is done
+        self.in_flight = {}
+        self.metrics = collections.Counter()
+
+    def ensure(self, thumb_file, format_name=None):
+        """
+        Renders thumb_file if it's a missing thumbnail of a photo that
+        exists. Returns once it's on disk, or if it can't be rendered.
+        :param thumb_file: path on disk of the requested file, which may not
+            be a thumbnail at all
+        :param format_name: if given, render the thumbnail in this extra
+            format (one of self.formats) if it's missing instead
+        :raise RenderTimeout: if it couldn't be rendered within timeout
+            seconds
+        """
+        wanted_file = thumb_file
+        if format_name is not None:
+            wanted_file = thumbnails.get_variant_file(thumb_file, format_name)
+        if os.path.exists(wanted_file):
+            return
+        source = get_thumb_source(thumb_file)
+        if source is None or not os.path.isfile(source):
+            return
+
+        with self.lock:
+            done = self.in_flight.get(source)
+            if done is None:
+                done = self.in_flight[source] = threading.Event()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            self.metrics['waits'] += 1
+            if not done.wait(self.timeout):
+                self.metrics['timeouts'] += 1
+                raise RenderTimeout('Thumbnail still rendering after '
+                                    '{}s'.format(self.timeout))
+            return
+
+        try:
+            self._render(source)
+        finally:
+            with self.lock:
+                del self.in_flight[source]
+            done.set()
+
+    def _render(self, source):
+        if not self.render_slots.acquire(timeout=self.timeout):
+            self.metrics['timeouts'] += 1
+            raise RenderTimeout('No thumbnail render slot available after '
+                                '{}s'.format(self.timeout))
+        try:
+            dirpath, filename = os.path.split(source)
+            thumbnails.make_thumbnails(source, dirpath, filename,
+                                       formats=self.formats)
+            self.metrics['rendered'] += 1
+        except (OSError, SyntaxError) as e:
+            # Pillow raises SyntaxError for some broken files
+            self.metrics['errors'] += 1
+            print("Couldn't create thumbnails for {}: {}".format(source, e))
+        finally:
+            self.render_slots.release()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.metrics)
+            stats.update({
+                'rendering': len(self.in_flight),
+                'max_renders': self.max_renders,
+            })
+        return stats
+
+
+def get_thumb_source(thumb_file):
+    """
+    Gets the photo a thumbnail is made from, or None if thumb_file isn't
+    the path of a thumbnail of a photo. Directory icons aren't made from a
+    photo with the same name, so they can't be rendered on demand.
+
+    For example:
+    >>> get_thumb_source('/albums/2017/_thumbnail/250/foo.jpg')
+    '/albums/2017/foo.jpg'
+    """
+    parsed = thumbnails.parse_thumb_file(thumb_file)
+    if parsed is None:
+        return None
+    dirpath, size, name = parsed
+    if name == urls.ICON_FILE:
+        return None
+    return os.path.join(dirpath, name)
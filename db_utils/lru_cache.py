@@ -0,0 +1,66 @@
+"""
+Thread-safe LRU cache with a max size, a TTL and generation-based
+invalidation, used by the web app to keep serialized query results.
+"""
+import collections
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL_SECONDS = 3600
+
+
+class LRUCache(object):
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 ttl=DEFAULT_TTL_SECONDS):
+        """
+        :param max_entries: max number of values kept. 0 disables the cache.
+        :param ttl: max age in seconds of a value
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expiry, gen, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        """
+        Returns the value cached for key, or None if there is none, it
+        expired or it was cached for another generation.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expiry, entry_generation, value = entry
+            if expiry < now or entry_generation != generation:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, generation, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, generation, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
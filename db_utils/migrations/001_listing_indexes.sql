@@ -0,0 +1,9 @@
+-- Updates a database created with an older create_tables.sql.
+--
+-- The photos of a dir are listed from the primary key (user_path, filename),
+-- which already serves lookups by user_path, and dirs_by_user_path duplicated
+-- the primary key of dirs. Subdirectories are listed by parent_user_path and
+-- sorted by name, which had no index at all.
+DROP INDEX photos_by_user_path ON photos;
+DROP INDEX dirs_by_user_path ON dirs;
+CREATE INDEX dirs_by_parent_user_path ON dirs(`parent_user_path`, `name`);
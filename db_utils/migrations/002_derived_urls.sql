@@ -0,0 +1,18 @@
+-- Updates a database created with an older create_tables.sql.
+--
+-- Photo, thumbnail and dir URLs are now derived from user_path and filename
+-- when dirs are listed (see db_utils/urls.py) instead of being stored. The
+-- indexer and the web app no longer read or write these columns, so they can
+-- be dropped at any time after upgrading.
+ALTER TABLE photos
+    DROP COLUMN url,
+    DROP COLUMN thumb_20_url,
+    DROP COLUMN thumb_100_url,
+    DROP COLUMN thumb_250_url,
+    DROP COLUMN thumb_500_url;
+ALTER TABLE dirs
+    DROP COLUMN url,
+    DROP COLUMN thumb_20_url,
+    DROP COLUMN thumb_100_url,
+    DROP COLUMN thumb_250_url,
+    DROP COLUMN thumb_500_url;
@@ -0,0 +1,44 @@
+-- Updates a database created with an older create_tables.sql.
+--
+-- Dirs now store recursive aggregates of the photos in their subtree, which
+-- the indexer and sync keep up to date incrementally (see
+-- db_utils/aggregates.py). This adds the columns and computes them once for
+-- the existing rows, along with num_photos and num_subdirs, which sync never
+-- used to update. The UPDATEs can be run again at any time to rebuild all the
+-- aggregates from scratch.
+ALTER TABLE dirs
+    ADD COLUMN total_photos INT NOT NULL DEFAULT 0,
+    ADD COLUMN total_size BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN min_created_time DATETIME,
+    ADD COLUMN max_created_time DATETIME,
+    ADD COLUMN max_modified_time DATETIME;
+
+UPDATE dirs d
+    LEFT JOIN (SELECT user_path, COUNT(*) AS n FROM photos
+               GROUP BY user_path) p ON p.user_path = d.user_path
+    LEFT JOIN (SELECT parent_user_path, COUNT(*) AS n FROM dirs
+               GROUP BY parent_user_path) c
+        ON c.parent_user_path = d.user_path
+SET d.num_photos = COALESCE(p.n, 0),
+    d.num_subdirs = COALESCE(c.n, 0);
+
+-- The photos in the subtree of a dir are those in the dir itself and those
+-- whose user_path starts with the dir's user_path and a slash
+UPDATE dirs d
+    JOIN (SELECT t.user_path, COUNT(p.filename) AS total_photos,
+                 COALESCE(SUM(p.size), 0) AS total_size,
+                 MIN(p.created_time) AS min_created_time,
+                 MAX(p.created_time) AS max_created_time,
+                 MAX(p.modified_time) AS max_modified_time
+          FROM dirs t
+              LEFT JOIN photos p
+                  ON t.user_path = '/'
+                  OR p.user_path = t.user_path
+                  OR LEFT(p.user_path, CHAR_LENGTH(t.user_path) + 1) =
+                     CONCAT(t.user_path, '/')
+          GROUP BY t.user_path) a ON a.user_path = d.user_path
+SET d.total_photos = a.total_photos,
+    d.total_size = a.total_size,
+    d.min_created_time = a.min_created_time,
+    d.max_created_time = a.max_created_time,
+    d.max_modified_time = a.max_modified_time;
@@ -0,0 +1,207 @@
+"""
+Instrumentation of the indexer and sync, to find where the time of a run
+goes and which files are the slowest to index.
+
+The stages of the pipeline (walking the tree, reading headers, exifread,
+Pillow, database round trips...) are timed into the module-level stats of
+each process, along with counters. Worker processes send theirs back to the
+writer process with take() and merge(). The slowest files are kept too, and
+a progress line with the rate and ETA is printed periodically.
+
+Stats may be updated from several threads, e.g. the walk runs in the task
+thread of the worker pool while the writer merges the workers' stats.
+
+The whole run can also be profiled with cProfile, see profile().
+"""
+import collections
+import contextlib
+import cProfile
+import datetime
+import heapq
+import pstats
+import threading
+import time
+
+DEFAULT_SLOWEST = 10
+PROGRESS_INTERVAL_SECONDS = 10
+# Functions listed after a cProfile run
+PROFILE_TOP_FUNCTIONS = 25
+
+
+class Stats(object):
+    def __init__(self, slowest=DEFAULT_SLOWEST):
+        """
+        :param slowest: number of slowest files kept
+        """
+        self.slowest = slowest
+        # stage -> cumulative seconds, and number of times it ran
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+        # Min-heap of (seconds, path) of the slowest files
+        self.slowest_files = []
+        self.progress_total = None
+        self.progress_interval = None
+        self.progress_start = None
+        self.last_progress = None
+        self.lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Times a block as a run of stage. Stages may be nested, e.g. exifread
+        within a photo, in which case both include the time.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def file_timer(self, path):
+        """
+        Times a block as the indexing of the file at path
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.add_time('photo', seconds)
+            self.add_file(path, seconds)
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def add_file(self, path, seconds):
+        """
+        Records the time it took to index a file
+        """
+        with self.lock:
+            self.counters['files'] += 1
+            if len(self.slowest_files) < self.slowest:
+                heapq.heappush(self.slowest_files, (seconds, path))
+            elif self.slowest_files and seconds > self.slowest_files[0][0]:
+                heapq.heapreplace(self.slowest_files, (seconds, path))
+            self.print_progress()
+
+    def take(self):
+        """
+        Returns the stats recorded since the last take, to be merged into
+        the stats of another process, and resets them
+        """
+        with self.lock:
+            taken = (dict(self.seconds), dict(self.calls),
+                     dict(self.counters), list(self.slowest_files))
+            self.seconds.clear()
+            self.calls.clear()
+            self.counters.clear()
+            self.slowest_files = []
+        return taken
+
+    def merge(self, taken):
+        """
+        Adds stats returned by take()
+        """
+        seconds, calls, counters, slowest_files = taken
+        with self.lock:
+            self.seconds.update(seconds)
+            self.calls.update(calls)
+            self.counters.update(counters)
+            # The slowest files are counted again by add_file
+            self.counters['files'] -= len(slowest_files)
+            for seconds, path in slowest_files:
+                self.add_file(path, seconds)
+            self.print_progress()
+
+    def start_progress(self, total=None,
+                       interval=PROGRESS_INTERVAL_SECONDS):
+        """
+        Prints a progress line every interval seconds from now on, as files
+        are added
+        :param total: the number of files expected, for the ETA
+        """
+        self.progress_total = total
+        self.progress_interval = interval
+        self.progress_start = self.last_progress = time.time()
+
+    def print_progress(self, force=False):
+        with self.lock:
+            if self.progress_start is None:
+                return
+            now = time.time()
+            if (not force and
+                    now - self.last_progress < self.progress_interval):
+                return
+            self.last_progress = now
+            done = self.counters['files']
+        elapsed = now - self.progress_start
+        rate = done / elapsed if elapsed > 0 else 0
+        line = 'Indexed {} files'.format(done)
+        if self.progress_total:
+            line = 'Indexed {}/{} files ({:.0%})'.format(
+                done, self.progress_total, done / self.progress_total)
+        line += ', {:.1f} files/s'.format(rate)
+        if self.progress_total and rate > 0:
+            remaining = max(0, self.progress_total - done) / rate
+            line += ', ETA {}'.format(
+                datetime.timedelta(seconds=int(remaining)))
+        print(line, flush=True)
+
+    def report(self):
+        """
+        :return: the lines of a summary of the stages, counters and slowest
+            files
+        """
+        with self.lock:
+            return self._report()
+
+    def _report(self):
+        lines = ['{:<28} {:>10} {:>12} {:>10}'.format(
+            'Stage', 'Calls', 'Total s', 'Mean ms')]
+        for stage, seconds in self.seconds.most_common():
+            calls = self.calls[stage]
+            lines.append('{:<28} {:>10} {:>12.3f} {:>10.3f}'.format(
+                stage, calls, seconds, 1000 * seconds / calls if calls else 0))
+        if self.counters:
+            lines.append('Counters: {}'.format(', '.join(
+                '{} {}'.format(name, n)
+                for name, n in sorted(self.counters.items()))))
+        if self.slowest_files:
+            lines.append('Slowest files:')
+            for seconds, path in sorted(self.slowest_files, reverse=True):
+                lines.append('{:>10.3f}s {}'.format(seconds, path))
+        return lines
+
+
+# The stats of this process
+stats = Stats()
+
+
+@contextlib.contextmanager
+def profile(filename):
+    """
+    Profiles a block with cProfile if filename isn't None, saving the
+    pstats data to filename and printing the functions with the highest
+    cumulative time. Only covers this process, not worker processes.
+    """
+    if filename is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+        print('Wrote profile to {}'.format(filename))
+        pstats.Stats(filename).sort_stats('cumulative').print_stats(
+            PROFILE_TOP_FUNCTIONS)
@@ -1,10 +1,13 @@
+import base64
+import json
 import os
 import pprint
 import sys
 
-import MySQLdb
-
+import db_utils.backends as backends
 import db_utils.record_types as record_types
+import db_utils.thumbnails as thumbnails
+import db_utils.urls as urls
 
 DIR_TYPE = 'dir'
 DIRS_TABLE = 'dirs'
@@ -12,38 +15,184 @@ IMAGE_TYPE = 'image'
 PHOTOS_TABLE = 'photos'
 
 
-QUERY_PHOTO_STATEMENT = """SELECT * FROM {} WHERE user_path = %s {{}}
+# Columns are listed explicitly, in the order of the record_types fields, so
+# that rows don't depend on the column order of the tables.
+PHOTO_COLUMNS = ', '.join(record_types.Photo._fields)
+DIR_COLUMNS = ', '.join(record_types.Dir._fields)
+
+# Served from the primary key, (user_path, filename)
+QUERY_PHOTO_STATEMENT = """SELECT {} FROM {} WHERE user_path = %s {{}}
+    """.format(PHOTO_COLUMNS, PHOTOS_TABLE)
+
+# Served from the dirs_by_parent_user_path index, (parent_user_path, name)
+QUERY_DIR_STATEMENT = """SELECT {} FROM {} WHERE parent_user_path = %s {{}}
+    """.format(DIR_COLUMNS, DIRS_TABLE)
+
+# Keyset pagination: the rows after the last one of the previous page, in
+# sort order. Formatted with the columns, the extra condition on the sort
+# key (if any) and the ORDER BY clause.
+QUERY_PHOTO_PAGE_STATEMENT = """SELECT {{}} FROM {} WHERE user_path = %s {{}}
+    {{}} LIMIT %s
     """.format(PHOTOS_TABLE)
 
-QUERY_DIR_STATEMENT = """SELECT * FROM {} WHERE parent_user_path = %s {{}}
+QUERY_DIR_PAGE_STATEMENT = """SELECT {{}} FROM {}
+    WHERE parent_user_path = %s {{}} {{}} LIMIT %s
     """.format(DIRS_TABLE)
 
+# The photos at a range of lightbox indexes. Formatted with the columns and
+# the ORDER BY clause.
+QUERY_PHOTO_RANGE_STATEMENT = """SELECT {{}} FROM {} WHERE user_path = %s
+    {{}} LIMIT %s OFFSET %s
+    """.format(PHOTOS_TABLE)
+
+# The columns needed for the grid and for photoswipe to display a photo.
+# The rest (EXIF, size, dates...) is loaded with get_lightbox_details.
+LEAN_PHOTO_COLUMNS = (
+    'user_path', 'filename', 'width', 'height', 'aspect_ratio',
+)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def connect(host, user, password, db_name):
+    """
+    Opens a new connection to the MySQL database
+    """
+    return backends.MySQLBackend(host, user, password, db_name).connect()
+
+
+def serialize_path_contents(path_contents):
+    """
+    Serializes the result of Querier.get_path_contents into the bytes sent
+    to the browser
+    """
+    return json.dumps(path_contents, separators=(',', ':'),
+                      sort_keys=True).encode('utf-8')
+
+
+def build_record(record_type, columns, row):
+    """
+    Builds a record_type from a row holding only the given columns. The
+    other fields are None.
+    """
+    values = dict(zip(columns, row))
+    return record_type(*[values.get(field) for field in record_type._fields])
+
+
+def format_date(value):
+    """
+    Formats a DATETIME column for the grid, e.g. '2018-01-02', or None
+    """
+    if value is None:
+        return None
+    return value.strftime('%Y-%m-%d')
+
+
+def encode_cursor(type_, last_key, lightbox_offset):
+    """
+    Encodes the position after a page of get_path_contents_page into an
+    opaque string
+    :param type_: DIR_TYPE or IMAGE_TYPE, the kind of the last item
+    :param last_key: the sort key (dir name or photo filename) of the last
+        item
+    :param lightbox_offset: the number of photos returned so far
+    """
+    data = json.dumps([type_, last_key, lightbox_offset]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor made by encode_cursor. Raises ValueError if it's
+    invalid.
+    """
+    try:
+        type_, last_key, lightbox_offset = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError('Invalid cursor: {}'.format(e))
+    if (type_ not in (DIR_TYPE, IMAGE_TYPE) or
+            not isinstance(last_key, str) or
+            not isinstance(lightbox_offset, int)):
+        raise ValueError('Invalid cursor')
+    return type_, last_key, lightbox_offset
+
 
 class Querier(object):
-    def __init__(self, host, user, password, db_name):
+    def __init__(self, host, user, password, db_name, pool=None, conn=None,
+                 thumb_formats=()):
+        """
+        :param pool: optional connection_pool.ConnectionPool to borrow the
+            connection from, instead of opening a new one
+        :param conn: optional connection that is already open, e.g. the
+            indexer's. close() leaves it open.
+        :param thumb_formats: the extra thumbnails.FORMATS thumbnails are
+            available in, advertised to the browser
+        """
         self.host = host
         self.user = user
         self.password = password
         self.db_name = db_name
+        self.pool = pool
+        self.shared_conn = conn
+        self.thumb_formats = thumb_formats
         self.db = None
         self.conn = None
+        if conn is not None:
+            self.conn = conn
+            self.db = conn.cursor()
 
     def connect(self):
         """
         Connect to the database
         """
-        self.conn = MySQLdb.connect(host=self.host, user=self.user,
-                                    passwd=self.password, db=self.db_name)
+        if self.pool is not None:
+            self.conn = self.pool.acquire()
+        else:
+            self.conn = connect(self.host, self.user, self.password,
+                                self.db_name)
         self.db = self.conn.cursor()
 
-    def close(self):
+    def close(self, broken=False):
         """
-        Close the connection to the database
+        Close the connection to the database, or return it to the pool
+        :param broken: if True, the connection is in an unknown state and
+            mustn't be reused
         """
-        if self.conn:
-            self.conn.commit()
+        if not self.conn:
+            return
+        try:
             self.db.close()
+        except backends.ERRORS:
+            broken = True
+        if self.pool is not None:
+            self.pool.release(self.conn, broken=broken)
+        elif self.conn is not self.shared_conn:
             self.conn.close()
+        self.conn = None
+        self.db = None
+
+    def reconnect(self):
+        """
+        Replaces the current connection, e.g. after the server dropped it
+        """
+        self.close(broken=True)
+        self.connect()
+
+    def execute(self, statement, args):
+        """
+        Runs a query and returns all its rows. If the connection came from
+        the pool and turns out to be dead, retries once on a new one.
+        """
+        try:
+            self.db.execute(statement, args)
+        except backends.OPERATIONAL_ERRORS:
+            if self.pool is None:
+                raise
+            self.reconnect()
+            self.db.execute(statement, args)
+        return self.db.fetchall()
 
     def get_path_contents(self, user_path):
         """
@@ -62,18 +211,22 @@ class Querier(object):
                 ],
                 'grid': [
                     # Content to display the thumbnail grid at a given path
-                ]
+                ],
+                'thumbnail_formats': [
+                    # Mimetypes the grid thumbnails are also available in,
+                    # served instead of the JPEG to browsers accepting them
+                ],
             }
         """
         photo_sort = self.get_photo_sort(user_path)
         photo_statement = QUERY_PHOTO_STATEMENT.format(photo_sort)
-        self.db.execute(photo_statement, (user_path,))
-        photos = [record_types.Photo(*p) for p in self.db.fetchall()]
+        photos = [record_types.Photo(*p)
+                  for p in self.execute(photo_statement, (user_path,))]
 
         dir_sort = self.get_dir_sort(user_path)
         dir_statement = QUERY_DIR_STATEMENT.format(dir_sort)
-        self.db.execute(dir_statement, (user_path,))
-        dirs = [record_types.Dir(*d) for d in self.db.fetchall()]
+        dirs = [record_types.Dir(*d)
+                for d in self.execute(dir_statement, (user_path,))]
 
         lightbox_info = self.get_lightbox_info(photos)
         grid_info = self.get_grid_info(photos, dirs)
@@ -82,22 +235,146 @@ class Querier(object):
             'user_path': user_path,
             'lightbox': lightbox_info,
             'grid': grid_info,
+            'thumbnail_formats': self.get_thumbnail_formats(),
+        }
+
+    def get_path_contents_page(self, user_path, cursor=None,
+                               limit=DEFAULT_PAGE_SIZE, lean=False):
+        """
+        Same as get_path_contents, but only returns up to limit grid items
+        (directories, then photos, in the same order), starting after the
+        position encoded in cursor. Each page is read with a keyset query,
+        so its cost doesn't depend on how far into the directory it is.
+
+        :param cursor: the next_cursor of the previous page, or None for
+            the first page
+        :param lean: if True, only read and return what the grid and
+            photoswipe need. See get_lightbox_info.
+        :return: dictionary of the format
+            {
+                'user_path': user_path,
+                'lightbox': [...],  # Lightbox items of the photos in grid
+                'lightbox_offset': 0,  # Lightbox index of the first one
+                'grid': [...],
+                'thumbnail_formats': [...],
+                'next_cursor': ...,  # None on the last page
+            }
+        """
+        type_, last_key, lightbox_offset = DIR_TYPE, None, 0
+        if cursor is not None:
+            type_, last_key, lightbox_offset = decode_cursor(cursor)
+
+        # One more row than needed is read, to know whether there is a next
+        # page without the browser having to load an empty one
+        dirs = []
+        if type_ == DIR_TYPE:
+            dirs = self.get_page(QUERY_DIR_PAGE_STATEMENT, user_path,
+                                 self.get_dir_sort_key(user_path), last_key,
+                                 limit + 1, record_types.Dir,
+                                 record_types.Dir._fields)
+            # The photos come after the last dir
+            last_key = None
+        photos = []
+        if len(dirs) <= limit:
+            photo_columns = (LEAN_PHOTO_COLUMNS if lean
+                             else record_types.Photo._fields)
+            photos = self.get_page(QUERY_PHOTO_PAGE_STATEMENT, user_path,
+                                   self.get_photo_sort_key(user_path),
+                                   last_key, limit - len(dirs) + 1,
+                                   record_types.Photo, photo_columns)
+
+        next_cursor = None
+        if len(dirs) + len(photos) > limit:
+            if len(dirs) >= limit:
+                dirs, photos = dirs[:limit], []
+                next_cursor = encode_cursor(DIR_TYPE, dirs[-1].name,
+                                            lightbox_offset)
+            else:
+                photos = photos[:limit - len(dirs)]
+                next_cursor = encode_cursor(IMAGE_TYPE, photos[-1].filename,
+                                            lightbox_offset + len(photos))
+
+        return {
+            'user_path': user_path,
+            'lightbox': self.get_lightbox_info(photos, details=not lean),
+            'lightbox_offset': lightbox_offset,
+            'grid': self.get_grid_info(photos, dirs,
+                                       lightbox_offset=lightbox_offset),
+            'thumbnail_formats': self.get_thumbnail_formats(),
+            'next_cursor': next_cursor,
+        }
+
+    def get_page(self, statement, user_path, sort_key, last_key, limit,
+                 record_type, columns):
+        """
+        Runs one of the QUERY_*_PAGE_STATEMENTs.
+        :param sort_key: (column, direction) as from get_dir_sort_key
+        :param last_key: the sort key value of the last row of the previous
+            page, or None to start from the first row
+        :param columns: the columns of record_type to read
+        """
+        column, direction = sort_key
+        args = [user_path]
+        condition = ''
+        if last_key is not None:
+            condition = 'AND {} {} %s'.format(
+                column, '>' if direction == 'ASC' else '<')
+            args.append(last_key)
+        args.append(limit)
+        order_by = 'ORDER BY {} {}'.format(column, direction)
+        statement = statement.format(', '.join(columns), condition, order_by)
+        return [build_record(record_type, columns, row)
+                for row in self.execute(statement, args)]
+
+    def get_lightbox_details(self, user_path, start, count):
+        """
+        Gets the full lightbox info of the photos at lightbox indexes
+        start to start + count - 1, for pages loaded with lean=True.
+        :return: dictionary of the format
+            {
+                'user_path': user_path,
+                'start': start,  # Lightbox index of the first photo
+                'lightbox': [...],
+            }
+        """
+        columns = record_types.Photo._fields
+        statement = QUERY_PHOTO_RANGE_STATEMENT.format(
+            ', '.join(columns), self.get_photo_sort(user_path))
+        photos = [build_record(record_types.Photo, columns, row)
+                  for row in self.execute(statement,
+                                          (user_path, count, start))]
+        return {
+            'user_path': user_path,
+            'start': start,
+            'lightbox': self.get_lightbox_info(photos),
         }
 
     @staticmethod
-    def get_lightbox_info(photos):
+    def get_lightbox_info(photos, details=True):
         """
         Builds a JSON list of photo info, to be passed to a lightbox app
         such as photoswipe
+        :param details: if False, only include what photoswipe needs to
+            display the photos
         """
         lightbox_info = []
         for photo in photos:
+            src = urls.get_dir_urls(photo.user_path).image(photo.filename)
+            if not details:
+                lightbox_info.append({
+                    'src': src,
+                    'w': photo.width,
+                    'h': photo.height,
+                    'pid': photo.filename,
+                    'title': photo.filename,
+                })
+                continue
             if photo.created_time is not None:
                 date_str = photo.created_time.strftime('%b %m %Y %H:%M:%S')
             else:
                 date_str = "No date available"
             info = {
-                'src': photo.url,  # required for photoswipe
+                'src': src,  # required for photoswipe
                 'w': photo.width,  # required for photoswipe
                 'h': photo.height,  # required for photoswipe
                 'pid': photo.filename,  # used for direct URL to image
@@ -119,42 +396,41 @@ class Querier(object):
         return lightbox_info
 
     @staticmethod
-    def get_grid_info(photos, dirs):
+    def get_grid_info(photos, dirs, lightbox_offset=0):
         """
         Builds a JSON object containing information about photos and
         directories at a path, so they can be rendered into a grid view.
+        :param lightbox_offset: the lightbox index of the first photo
         """
         info = []
 
         # Show directories first
         for dir_ in dirs:
             dir_info = {
-                'imageSizes': {
-                    20: dir_.thumb_20_url,
-                    100: dir_.thumb_100_url,
-                    250: dir_.thumb_250_url,
-                    500: dir_.thumb_500_url,
-                },
+                'imageSizes': urls.get_dir_urls(dir_.user_path).thumbs(
+                    urls.ICON_FILE),
                 'aspectRatio': dir_.aspect_ratio,
                 'metadata': {
                     'name': dir_.name,
-                    'url': dir_.url,
+                    'url': urls.get_dir_url(dir_.user_path),
                     'type': DIR_TYPE,
                     'num_photos': dir_.num_photos,
                     'num_subdirs': dir_.num_subdirs,
+                    # Recursive, over all the photos below the dir
+                    'total_photos': dir_.total_photos,
+                    'total_size': dir_.total_size,
+                    'first_photo_date': format_date(dir_.min_created_time),
+                    'last_photo_date': format_date(dir_.max_created_time),
+                    'last_updated': format_date(dir_.max_modified_time),
                 }
             }
             info.append(dir_info)
 
         # Show photos after directories
-        for photo_index, photo in enumerate(photos):
+        for photo_index, photo in enumerate(photos, lightbox_offset):
             photo_info = {
-                'imageSizes': {
-                    20: photo.thumb_20_url,
-                    100: photo.thumb_100_url,
-                    250: photo.thumb_250_url,
-                    500: photo.thumb_500_url,
-                },
+                'imageSizes': urls.get_dir_urls(photo.user_path).thumbs(
+                    photo.filename),
                 'aspectRatio': photo.aspect_ratio,
                 'metadata': {
                     'name': photo.filename,
@@ -166,29 +442,60 @@ class Querier(object):
 
         return info
 
+    def get_thumbnail_formats(self):
+        """
+        Gets the mimetypes of the extra formats the thumbnails in the grid
+        are available in, in order of preference. The thumbnail URLs don't
+        change: the format is picked from the browser's Accept header.
+        """
+        return [thumbnails.FORMATS[name].mimetype
+                for name in self.thumb_formats]
+
     def get_photo_sort(self, user_path):
         """
         Gets a string that can be passed to an ORDER BY clause in SQL to
         control the sort order for photos for a given path.
         """
-        # Always sort by filename
-        return "ORDER BY filename ASC"
+        return "ORDER BY {} {}".format(*self.get_photo_sort_key(user_path))
 
     def get_dir_sort(self, user_path):
         """
         Gets a string that can be passed to an ORDER BY clause in SQL to
         control the sort order for directories for a given path.
         """
+        return "ORDER BY {} {}".format(*self.get_dir_sort_key(user_path))
+
+    def get_photo_sort_key(self, user_path):
+        """
+        Gets the (column, direction) photos are sorted by for a given path.
+        The column must be unique among the photos of a path.
+        """
+        # Always sort by filename
+        return 'filename', 'ASC'
+
+    def get_dir_sort_key(self, user_path):
+        """
+        Gets the (column, direction) directories are sorted by for a given
+        path. The column must be unique among the directories of a path.
+        """
         if user_path == "/":
-            return "ORDER BY name ASC"
+            return 'name', 'ASC'
         else:
-            return "ORDER BY name DESC"
+            return 'name', 'DESC'
 
 
 def main():
     """
     For testing
     """
+    if 'PHOTOS_DB_PATH' in os.environ:
+        # An index in the sqlite backend
+        conn = backends.SQLiteBackend(os.environ['PHOTOS_DB_PATH']).connect(
+            read_only=True)
+        q = Querier(None, None, None, None, conn=conn)
+        pprint.pprint(q.get_path_contents(sys.argv[1]))
+        return
+
     # Let these generate KeyErrors if the env vars don't exist
     host = os.environ['PHOTOS_DB_HOST']
     user = os.environ['PHOTOS_DB_USER']
@@ -1,18 +1,18 @@
 import collections
 
+# URLs aren't stored, see db_utils.urls
 Photo = collections.namedtuple(
-    'Photo', ['user_path', 'filename', 'url', 'thumb_20_url',
-              'thumb_100_url', 'thumb_250_url', 'thumb_500_url',
-              'created_time', 'width', 'height', 'aspect_ratio', 'size',
-              'modified_time', 'exif_fstop', 'exif_focal_length', 'exif_iso',
-              'exif_shutter_speed', 'exif_camera', 'exif_lens', 'exif_gps_lat',
-              'exif_gps_lon', 'exif_gps_alt_ft'])
+    'Photo', ['user_path', 'filename', 'created_time', 'width', 'height',
+              'aspect_ratio', 'size', 'modified_time', 'exif_fstop',
+              'exif_focal_length', 'exif_iso', 'exif_shutter_speed',
+              'exif_camera', 'exif_lens', 'exif_gps_lat', 'exif_gps_lon',
+              'exif_gps_alt_ft'])
 
 Dir = collections.namedtuple(
-    'Dir', ['user_path', 'parent_user_path', 'name', 'url',
-            'thumb_20_url', 'thumb_100_url', 'thumb_250_url', 'thumb_500_url',
-            'width', 'height', 'aspect_ratio', 'created_time', 'modified_time',
-            'num_subdirs', 'num_photos'])
+    'Dir', ['user_path', 'parent_user_path', 'name', 'width', 'height',
+            'aspect_ratio', 'created_time', 'modified_time', 'num_subdirs',
+            'num_photos', 'total_photos', 'total_size', 'min_created_time',
+            'max_created_time', 'max_modified_time'])
 
 Exif = collections.namedtuple(
     'Exif', ['width', 'height', 'created', 'fstop', 'focal_length', 'iso',
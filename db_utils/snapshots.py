@@ -0,0 +1,130 @@
+"""
+Store of pre-serialized responses of the first page of each directory, as
+loaded by the grid (get_path_contents_page with lean=1 and the default
+limit), written by the indexer and sync after they commit, so the web app
+can serve them straight from disk. The following pages, if any, are read
+from the database.
+
+Each snapshot is stored as JSON and pre-compressed with each of the
+encodings in db_utils.compression. Files are replaced atomically, so the
+web app never serves a partially written snapshot. The snapshots of a dir
+are named after the hash of its user path, in a directory fanned out by
+the first two characters of the hash.
+"""
+import hashlib
+import os
+
+import db_utils.compression as compression
+import db_utils.query as query
+
+SNAPSHOTS_SUFFIX = 'snapshots'
+JSON_EXTENSION = '.json'
+# Snapshots are compressed once and served many times
+GZIP_LEVEL = 9
+
+DIR_EXISTS_STATEMENT = """
+    SELECT COUNT(*) FROM {} WHERE user_path = %s
+    """.format(query.DIRS_TABLE)
+
+
+def default_snapshot_dir(root):
+    """
+    Gets the default location of the snapshots for a photos root, which is
+    a hidden directory next to (not inside) the root, e.g.
+    "/photos/.albums.snapshots" for the root "/photos/albums"
+    """
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), '.{}.{}'.format(
+        os.path.basename(root), SNAPSHOTS_SUFFIX))
+
+
+class SnapshotStore(object):
+    def __init__(self, directory, compress=True, thumb_formats=()):
+        """
+        :param directory: where snapshots are stored, created if needed
+        :param compress: whether to also write pre-compressed copies
+        :param thumb_formats: the extra thumbnail formats advertised in the
+            snapshots, see query.Querier
+        """
+        self.directory = directory
+        self.compress = compress
+        self.thumb_formats = thumb_formats
+
+    def get_filename(self, user_path, encoding=None):
+        """
+        Gets the file holding the snapshot of user_path, compressed with
+        encoding (a Content-Encoding) if given
+        """
+        digest = hashlib.sha1(
+            user_path.encode('utf-8', 'surrogateescape')).hexdigest()
+        filename = os.path.join(self.directory, digest[:2],
+                                digest + JSON_EXTENSION)
+        if encoding is not None:
+            filename += compression.EXTENSIONS[encoding]
+        return filename
+
+    def write(self, user_path, data):
+        """
+        Stores data, the serialized first page of user_path
+        """
+        _write_atomically(self.get_filename(user_path), data)
+        if not self.compress:
+            return
+        for encoding in compression.available_encodings():
+            _write_atomically(
+                self.get_filename(user_path, encoding),
+                compression.compress(data, encoding, level=GZIP_LEVEL))
+
+    def delete(self, user_path):
+        for encoding in [None] + list(compression.EXTENSIONS):
+            try:
+                os.remove(self.get_filename(user_path, encoding))
+            except FileNotFoundError:
+                pass
+
+    def find(self, user_path, encoding=None):
+        """
+        Finds the snapshot of user_path to serve.
+        :param encoding: the preferred Content-Encoding
+        :return: (filename, encoding), encoding being None for the
+            uncompressed snapshot, or None if there is no snapshot
+        """
+        if encoding is not None:
+            filename = self.get_filename(user_path, encoding)
+            if os.path.exists(filename):
+                return filename, encoding
+        filename = self.get_filename(user_path)
+        if os.path.exists(filename):
+            return filename, None
+        return None
+
+
+def write_snapshots(conn, store, user_paths):
+    """
+    Rebuilds the snapshots of user_paths from the database, and deletes
+    those of dirs that no longer exist. Should be called after the changes
+    to these dirs were committed.
+    :param conn: an open connection to the database
+    """
+    querier = query.Querier(None, None, None, None, conn=conn,
+                            thumb_formats=store.thumb_formats)
+    try:
+        for user_path in sorted(user_paths):
+            querier.db.execute(DIR_EXISTS_STATEMENT, (user_path,))
+            if not querier.db.fetchone()[0]:
+                store.delete(user_path)
+                continue
+            store.write(user_path, query.serialize_path_contents(
+                querier.get_path_contents_page(user_path, lean=True)))
+    finally:
+        querier.close()
+    print("Wrote snapshots of {} dirs".format(len(user_paths)))
+
+
+def _write_atomically(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Per process, as the indexer and a sync may write the same snapshot
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
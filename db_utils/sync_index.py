@@ -1,12 +1,19 @@
 import argparse
-import getpass
 import pprint
 import os
 import os.path
-
-import MySQLdb
+import time
 
 import db_utils.indexer as indexer
+import db_utils.inotify as inotify
+import db_utils.profiling as profiling
+import db_utils.sync_manifest as sync_manifest
+import db_utils.thumbnails as thumbnails
+
+DEFAULT_DEBOUNCE_SECONDS = 5.0
+# Sync a batch of changes at the latest this long after its first event,
+# even if events keep coming
+MAX_BATCH_DELAY_SECONDS = 60.0
 
 
 def parse_args():
@@ -15,116 +22,383 @@ def parse_args():
                         required=True)
     parser.add_argument('--root', help='The root of all photos. Will be '
                                        'excluded from the path', required=True)
-    parser.add_argument('--db-host', help='mysql host', required=True)
-    parser.add_argument('--db-user', help='mysql user', required=True)
-    parser.add_argument('--db-name', help='mysql database name', required=True)
+    indexer.add_db_args(parser)
     parser.add_argument('--force', action='store_true',
                         help="If specified, don't check for an "
-                             'existing entry in the database, always index')
+                             'existing entry in the EXIF cache')
     parser.add_argument('--for-real', action='store_true',
                         help="Serious this time")
+    parser.add_argument('--full', action='store_true',
+                        help='Walk and compare every directory, even those '
+                             'the manifest says are unchanged')
+    parser.add_argument('--manifest', help='Path of the sync manifest file. '
+                                           'Defaults to a hidden file next '
+                                           'to --root')
+    parser.add_argument('--no-manifest', action='store_true',
+                        help="Don't read or write the sync manifest")
+    parser.add_argument('--watch', action='store_true',
+                        help='After syncing, keep running and sync the '
+                             'directories that change, using inotify')
+    parser.add_argument('--debounce', type=float,
+                        default=DEFAULT_DEBOUNCE_SECONDS,
+                        help='In --watch mode, wait until no changes '
+                             'happened for this many seconds before syncing')
+    indexer.add_writer_args(parser)
+    indexer.add_exif_cache_args(parser)
+    indexer.add_snapshot_args(parser)
+    indexer.add_thumbnail_args(parser)
+    indexer.add_profiling_args(parser)
     return parser.parse_args()
 
 
-def walk_local_dirs(path, root):
+def walk_local_dirs(path, root, manifest=None, rescan_dirs=()):
+    """
+    Walks the local tree below path with os.scandir, stat'ing each photo
+    once.
+
+    With a manifest, dirs that haven't changed since the last sync aren't
+    listed at all: their subdirectories come from the manifest and their
+    filenames and photo_stats are None. The manifest is updated with the
+    fingerprints of the dirs that were listed.
+    :param rescan_dirs: dirpaths listed even if their mtime is unchanged,
+        e.g. dirs in which a photo was modified in place
+    :return: a mapping of dir user path to a tuple of
+        (dirpath, dirnames, filenames, photo_stats), where photo_stats maps
+        the filename of each photo to its os.stat_result
+    """
     path_files = {}
-    for dirpath, dirnames, filenames in os.walk(path, topdown=True,
-                                                followlinks=True):
-        dirnames[:] = [d for d in dirnames if d not in indexer.EXCLUDE_DIRS]
+    pending = [path]
+    while pending:
+        dirpath = pending.pop()
         user_path = indexer.get_user_path(dirpath, root)
-
-        filtered_files = set(
-            f for f in filenames if f != indexer.ICON_FILE)
-        path_files[user_path] = (dirpath, dirnames, filtered_files)
+        with profiling.stats.timer('scan'):
+            if manifest is None:
+                dirnames, filenames, photo_stats = scan_dir(dirpath)
+            else:
+                dirnames, filenames, photo_stats = scan_dir_with_manifest(
+                    dirpath, user_path, manifest,
+                    rescan=dirpath in rescan_dirs)
+        path_files[user_path] = (dirpath, dirnames, filenames, photo_stats)
+        pending.extend(os.path.join(dirpath, d) for d in dirnames)
     return path_files
 
 
-def sync(db, path, root, for_real):
+def scan_dir(dirpath):
+    """
+    Lists a single dir.
+    :return: (dirnames, filenames, photo_stats)
+    """
+    dirnames = []
+    filenames = set()
+    photo_stats = {}
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name not in indexer.EXCLUDE_DIRS:
+                    dirnames.append(entry.name)
+            elif entry.name != indexer.ICON_FILE:
+                filenames.add(entry.name)
+                if indexer.is_photo_file(entry.name):
+                    try:
+                        photo_stats[entry.name] = entry.stat()
+                    except OSError:
+                        # e.g. a broken symlink
+                        pass
+    return dirnames, filenames, photo_stats
+
+
+def scan_dir_with_manifest(dirpath, user_path, manifest, rescan=False):
+    """
+    Same as scan_dir, but returns None for filenames and photo_stats if the
+    dir is unchanged according to its fingerprint in the manifest.
+    :param rescan: if True, list the dir even if its mtime is unchanged, so
+        that photos modified in place are noticed through the hash
+    """
+    # Stat before listing, so a change made during the listing shows up as
+    # a changed mtime next time.
+    mtime_ns = os.stat(dirpath).st_mtime_ns
+    previous = manifest.get(user_path)
+    if (previous is not None and previous['mtime_ns'] == mtime_ns and
+            not rescan):
+        return previous['dirnames'], None, None
+
+    dirnames, filenames, photo_stats = scan_dir(dirpath)
+    manifest.update(user_path, mtime_ns, dirnames, filenames, photo_stats)
+    if (previous is not None and
+            previous['hash'] == manifest.dirs[user_path]['hash']):
+        return dirnames, None, None
+    return dirnames, filenames, photo_stats
+
+
+def sync(writer, path, root, for_real, exif_cache=None, manifest=None,
+         thumb_formats=None, rescan_dirs=()):
     # Get a mapping of dir user path to tuple of
-    # (dirpath, dirnames, filenames)
-    path_info = walk_local_dirs(path, root)
+    # (dirpath, dirnames, filenames, photo_stats)
+    path_info = walk_local_dirs(path, root, manifest=manifest,
+                                rescan_dirs=rescan_dirs)
+    unchanged_dirs = set(user_path for user_path, info in path_info.items()
+                         if info[3] is None)
+
+    # Load everything the DB has for the subtree up front: one query for
+    # the dirs and one (streamed) query for the photos, or only the photos
+    # of the dirs that changed when most of them didn't.
+    dir_user_path = indexer.get_user_path(path, root)
+    dirs_in_db = set(indexer.get_dirs_for_sync(writer.db, dir_user_path))
+    if unchanged_dirs:
+        photos_in_db = indexer.get_photos_in_dirs(
+            writer.conn, set(path_info) - unchanged_dirs)
+    else:
+        photos_in_db = indexer.get_photos_for_sync(writer.conn, dir_user_path)
 
     # Add any dirs (and all their photos) that exist locally but not
     # in the DB.
     # Delete any dirs (and all their photos) in the DB that don't
     # exist locally.
-    sync_dirs(db, path, root, path_info, for_real)
+    added_dirs, removed_dirs = sync_dirs(writer, root, path_info, dirs_in_db,
+                                         for_real, exif_cache=exif_cache,
+                                         thumb_formats=thumb_formats)
 
     # At this point all of the dirs have been synced, all of the photos
     # in removed dirs have been removed from the DB, and all of the
     # photos in the added dirs have been added to the DB.
     # Now we want to handle changes in the photos whose dirs haven't
     # changed.
-    for user_path, info in path_info.items():
-        dirpath, dirnames, filenames = info
-        sync_photos(db, dirpath, user_path, filenames, for_real)
+    sync_photos(writer, path_info, photos_in_db,
+                added_dirs | removed_dirs | unchanged_dirs,
+                for_real, exif_cache=exif_cache, thumb_formats=thumb_formats)
 
+    if manifest is not None:
+        manifest.prune(dir_user_path, path_info)
 
-def sync_dirs(db, path, root, path_info, for_real):
-    local_user_paths = set(path_info.keys())
 
-    # Get the set of dir user paths in the DB matching the user path of
-    # the passed-in local path.
-    dir_user_path = indexer.get_user_path(path, root)
-    paths_in_db = set(indexer.get_dirs_for_sync(db, dir_user_path))
+def sync_dirs(writer, root, path_info, dirs_in_db, for_real,
+              exif_cache=None, thumb_formats=None):
+    """
+    :param dirs_in_db: the set of dir user paths in the DB below the synced
+        path
+    :return: the sets of dir user paths that were added and removed, with
+        all their photos.
+    """
+    local_user_paths = set(path_info.keys())
 
-    dirs_to_add = local_user_paths - paths_in_db
-    dirs_to_remove = paths_in_db - local_user_paths
+    dirs_to_add = local_user_paths - dirs_in_db
+    dirs_to_remove = dirs_in_db - local_user_paths
 
-    for user_path in dirs_to_add:
+    for user_path in sorted(dirs_to_add):
         info = path_info[user_path]
-        dirpath, dirnames, filenames = info
-        indexer.index_dir(db, root, dirpath, dirnames, filenames, for_real)
+        dirpath, dirnames, filenames, photo_stats = info
+        if filenames is None:
+            # Unchanged since the last sync, but missing from the DB
+            dirnames, filenames, photo_stats = scan_dir(dirpath)
+        indexer.index_dir(writer, root, dirpath, dirnames, filenames,
+                          for_real, exif_cache=exif_cache,
+                          thumb_formats=thumb_formats)
 
-    for user_path in dirs_to_remove:
-        indexer.delete_dir(db, user_path, for_real)
-        indexer.delete_photos_in_dir(db, user_path, for_real)
+    # Only the top of each removed subtree needs deleting, which also
+    # deletes everything below it
+    subtrees = group_subtrees(dirs_to_remove)
+    for user_path in sorted(subtrees):
+        indexer.delete_subtree(writer, user_path, for_real,
+                               removed_dirs=subtrees[user_path])
 
+    return dirs_to_add, dirs_to_remove
+
+
+def group_subtrees(user_paths):
+    """
+    Groups user paths by the highest of them above each one.
+    :return: dict of each user path that isn't below another one of them
+        -> sorted list of the user paths below it
+
+    For example:
+    >>> sorted(group_subtrees({'/2017', '/2017/a', '/2017/a/b', '/2017b'}
+    ...                       ).items())
+    [('/2017', ['/2017/a', '/2017/a/b']), ('/2017b', [])]
+    """
+    subtrees = {}
+    for user_path in sorted(user_paths):
+        top = None
+        parent = indexer.get_parent_dir(user_path)
+        while parent is not None:
+            if parent in user_paths:
+                top = parent
+            parent = indexer.get_parent_dir(parent)
+        if top is None:
+            subtrees.setdefault(user_path, [])
+        else:
+            subtrees.setdefault(top, []).append(user_path)
+    return subtrees
+
+
+def sync_photos(writer, path_info, photos_in_db, skip_dirs, for_real,
+                exif_cache=None, thumb_formats=None):
+    """
+    Diffs the photos found locally against photos_in_db, as loaded by
+    indexer.get_photos_for_sync, and indexes or deletes the differences.
+    Photos in skip_dirs are ignored, since those dirs were added or removed
+    as a whole.
+    """
+    local_photos = {}
+    for user_path, info in path_info.items():
+        if user_path in skip_dirs:
+            continue
+        dirpath, dirnames, filenames, photo_stats = info
+        for filename, stat in photo_stats.items():
+            local_photos[(user_path, filename)] = stat
 
-def sync_photos(db, dirpath, user_path, filenames, for_real):
-    photos_to_add = set()
-    photos_to_remove = set()
-    photos_in_db = indexer.get_photos_for_sync(db, user_path)
     # Add files that are local but not in the DB.
     # Also add files that are in the DB but the local one has
-    # a different timestamp.
-    for local_file in filenames:
-        if local_file not in photos_in_db:
-            photos_to_add.add(local_file)
-        else:
-            db_mtime = photos_in_db[local_file]
-            local_mtime = os.path.getmtime(os.path.join(dirpath, local_file))
-            if db_mtime != local_mtime:
-                photos_to_add.add(local_file)
+    # a different timestamp or size.
+    photos_to_add = set()
+    for key, stat in local_photos.items():
+        db_info = photos_in_db.get(key)
+        if db_info is None or indexer.is_photo_changed(stat, *db_info):
+            photos_to_add.add(key)
     # Remove files that are in the DB but not local
-    for db_file in photos_in_db:
-        if db_file not in filenames:
-            photos_to_remove.add(db_file)
+    photos_to_remove = set(
+        key for key in photos_in_db
+        if key[0] not in skip_dirs and key not in local_photos)
     # Assert that we're not removing and adding the same photos
     assert not photos_to_remove & photos_to_add
 
-    for filename in photos_to_add:
-        indexer.index_photo(db, user_path, dirpath, filename, for_real)
-    for filename in photos_to_remove:
-        indexer.delete_photo(db, user_path, filename, for_real)
-    # TODO: Need to update num_subdirs and num_photos for the dir
+    # dirpath -> filename -> thumbnail dimensions
+    thumb_dims = {}
+    for user_path, filename in sorted(photos_to_add):
+        dirpath = path_info[user_path][0]
+        if for_real and (user_path, filename) in photos_in_db:
+            # The old row's size and dates can't be subtracted as a delta.
+            # Recorded before the row is queued, see indexer.write_photo.
+            writer.aggregates.invalidate(user_path)
+        dims = indexer.index_photo(writer, user_path, dirpath, filename,
+                                   for_real, exif_cache=exif_cache,
+                                   stat=local_photos[(user_path, filename)],
+                                   thumb_formats=thumb_formats)
+        if dims:
+            thumb_dims.setdefault(dirpath, {})[filename] = dims
+    for dirpath, dims in thumb_dims.items():
+        thumbnails.record_dimensions(dirpath, dims)
+    for user_path, filename in sorted(photos_to_remove):
+        indexer.delete_photo(writer, user_path, filename, for_real)
+
+
+def watch(writer, path, root, for_real, exif_cache=None, manifest=None,
+          debounce=DEFAULT_DEBOUNCE_SECONDS, thumb_formats=None):
+    """
+    Syncs path, then keeps watching it with inotify and syncs the dirs
+    that change. Bursts of events (e.g. from rsync) are batched: a batch is
+    synced once no event arrived for debounce seconds, or at the latest
+    MAX_BATCH_DELAY_SECONDS after its first event. Runs until interrupted.
+
+    The dirs reported by inotify are listed even if the manifest says they
+    are unchanged, as writing a file in place (IN_CLOSE_WRITE) doesn't
+    change the mtime of its dir.
+    """
+    # Start watching before the initial sync, so that nothing is missed
+    watcher = inotify.TreeWatcher(path, exclude=indexer.EXCLUDE_DIRS)
+    try:
+        sync_batch(writer, [path], root, for_real, exif_cache, manifest,
+                   thumb_formats)
+        print("Watching {}".format(path))
+        changed = set()
+        first_event = last_event = None
+        while True:
+            timeout = None
+            if changed:
+                deadline = min(last_event + debounce,
+                               first_event + MAX_BATCH_DELAY_SECONDS)
+                timeout = max(0, deadline - time.time())
+            dirs = watcher.read_changed_dirs(timeout)
+            now = time.time()
+            if dirs:
+                if not changed:
+                    first_event = now
+                changed |= dirs
+                last_event = now
+            if changed and (now - last_event >= debounce or
+                            now - first_event >= MAX_BATCH_DELAY_SECONDS):
+                sync_batch(writer, collapse_dirs(changed, path), root,
+                           for_real, exif_cache, manifest, thumb_formats,
+                           rescan_dirs=changed)
+                changed = set()
+    finally:
+        watcher.close()
+
+
+def sync_batch(writer, dirpaths, root, for_real, exif_cache, manifest,
+               thumb_formats=None, rescan_dirs=()):
+    """
+    Syncs the subtrees at dirpaths and commits everything, which publishes
+    the changes through the writer's on_commit hook (see
+    indexer.open_writer)
+    :param rescan_dirs: see walk_local_dirs
+    """
+    for dirpath in dirpaths:
+        print("Syncing {}".format(dirpath))
+        sync(writer, dirpath, root, for_real, exif_cache=exif_cache,
+             manifest=manifest, thumb_formats=thumb_formats,
+             rescan_dirs=rescan_dirs)
+    writer.commit()
+    if exif_cache is not None:
+        exif_cache.commit()
+    if manifest is not None and for_real:
+        manifest.save()
+
+
+def collapse_dirs(dirpaths, path):
+    """
+    Reduces a set of changed dirs to the smallest list of subtrees covering
+    them. Dirs that no longer exist are replaced by their closest existing
+    ancestor, up to path.
+    """
+    existing = set()
+    for dirpath in dirpaths:
+        while dirpath != path and not os.path.isdir(dirpath):
+            dirpath = os.path.dirname(dirpath)
+        existing.add(dirpath)
+    subtrees = []
+    for dirpath in sorted(existing):
+        if not any(dirpath.startswith(s.rstrip('/') + '/') for s in subtrees):
+            subtrees.append(dirpath)
+    return subtrees
 
 
 def main():
     args = parse_args()
-    passwd = getpass.getpass(
-        'mysql password for user {}: '.format(args.db_user))
-    conn = MySQLdb.connect(host=args.db_host, user=args.db_user,
-                           passwd=passwd, db=args.db_name)
-    db = conn.cursor()
+    conn = indexer.open_db(args)
+    writer = indexer.open_writer(conn, args,
+                                 indexer.open_snapshot_store(args))
     path = os.path.abspath(args.path)
     root = os.path.abspath(args.root)
+    exif_cache = indexer.open_exif_cache(args)
+    manifest = None
+    if not args.no_manifest:
+        manifest = sync_manifest.SyncManifest(
+            args.manifest or sync_manifest.default_manifest_path(root),
+            refresh=args.full)
+    thumb_formats = indexer.get_thumb_formats(args)
+    # Only the photos that changed are indexed, and which ones isn't known
+    # up front, so there's no ETA
+    indexer.start_profiling(args)
     try:
-        sync(db, path, root, args.for_real)
+        with profiling.profile(args.profile):
+            if args.watch:
+                watch(writer, path, root, args.for_real,
+                      exif_cache=exif_cache, manifest=manifest,
+                      debounce=args.debounce, thumb_formats=thumb_formats)
+            else:
+                sync(writer, path, root, args.for_real,
+                     exif_cache=exif_cache, manifest=manifest,
+                     thumb_formats=thumb_formats)
+                writer.commit()
     finally:
-        conn.commit()
-        db.close()
+        writer.close()
         conn.close()
+        if exif_cache is not None:
+            exif_cache.close()
+        indexer.print_stats()
+    # Only remember what was synced once it has all been committed
+    if manifest is not None and args.for_real:
+        manifest.save()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+"""
+Manifest of directory fingerprints recorded by sync_index, so the next sync
+can skip directories that haven't changed since.
+
+For each directory the manifest stores its mtime, its number of entries,
+a hash of the names, sizes and mtimes of its photos and the names of its
+subdirectories. On the next sync:
+
+- if the directory's mtime is unchanged, it isn't even listed: its
+  subdirectories are taken from the manifest and its photos are assumed to
+  be unchanged. Adding, removing or renaming a file (which is how rsync
+  updates a file) always changes the mtime of its directory.
+- if the mtime changed, the directory is listed again and its photos are
+  only compared against the database if the hash of its contents changed.
+
+Photos modified in place without renaming aren't noticed, which is what
+sync_index.py --full is for.
+"""
+import hashlib
+import json
+import os
+
+MANIFEST_SUFFIX = 'sync_manifest.json'
+
+
+def default_manifest_path(root):
+    """
+    Gets the default location of the manifest for a photos root, which is a
+    hidden file next to (not inside) the root, e.g.
+    "/photos/.albums.sync_manifest.json" for the root "/photos/albums"
+    """
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), '.{}.{}'.format(
+        os.path.basename(root), MANIFEST_SUFFIX))
+
+
+def content_hash(dirnames, filenames, photo_stats):
+    """
+    Hashes the entries of a directory and the size and mtime of its photos
+    """
+    h = hashlib.sha1()
+    for name in sorted(dirnames):
+        h.update('d {}\n'.format(name).encode('utf-8', 'surrogateescape'))
+    for name in sorted(filenames):
+        stat = photo_stats.get(name)
+        if stat is not None:
+            line = 'p {} {} {}\n'.format(name, stat.st_size, stat.st_mtime_ns)
+        else:
+            line = 'f {}\n'.format(name)
+        h.update(line.encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+class SyncManifest(object):
+    def __init__(self, filename, refresh=False):
+        """
+        :param filename: the JSON file holding the manifest
+        :param refresh: if True, treat every directory as changed, but
+            still record fresh fingerprints
+        """
+        self.filename = filename
+        self.refresh = refresh
+        self.dirs = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.dirs = json.load(f)
+
+    def get(self, user_path):
+        """
+        Returns the recorded fingerprint of a dir as a dict with the keys
+        mtime_ns, entries, hash and dirnames, or None.
+        """
+        if self.refresh:
+            return None
+        return self.dirs.get(user_path)
+
+    def update(self, user_path, mtime_ns, dirnames, filenames, photo_stats):
+        self.dirs[user_path] = {
+            'mtime_ns': mtime_ns,
+            'entries': len(dirnames) + len(filenames),
+            'hash': content_hash(dirnames, filenames, photo_stats),
+            'dirnames': sorted(dirnames),
+        }
+
+    def prune(self, subtree_user_path, existing_user_paths):
+        """
+        Forgets the dirs at or below subtree_user_path that aren't in
+        existing_user_paths.
+        """
+        prefix = subtree_user_path.rstrip('/') + '/'
+        for user_path in list(self.dirs):
+            in_subtree = (user_path == subtree_user_path or
+                          user_path.startswith(prefix))
+            if in_subtree and user_path not in existing_user_paths:
+                del self.dirs[user_path]
+
+    def save(self):
+        """
+        Atomically replaces the manifest file. The temporary file is per
+        process, in case a sync and a watch save the same manifest at once.
+        """
+        tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.dirs, f, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
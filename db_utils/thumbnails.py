@@ -0,0 +1,289 @@
+"""
+Pillow-based thumbnail engine.
+
+Each original is decoded once, at a reduced scale when it's a JPEG (using
+the DCT scaling of Image.draft), and all the thumbnail sizes are produced in
+a cascade from the largest to the smallest, each one resized from the
+previous one. Like the ImageMagick command it replaces, each thumbnail fits
+in a size x size box, is slightly sharpened and saved as a quality 45 JPEG
+keeping the EXIF and ICC profile of the original. Originals are never
+enlarged.
+
+Thumbnails are written atomically, and those at least as recent as their
+original are left alone. The dimensions of the thumbnails written are
+recorded in a DIMENSIONS_FILE in the _thumbnail dir, so they never need to
+be read back from the thumbnails themselves.
+
+Thumbnails can also be written in more compact FORMATS, next to the JPEG,
+e.g. "_thumbnail/250/foo.jpg.webp" for "_thumbnail/250/foo.jpg". They're
+served instead of the JPEG to browsers that accept them. Which ones can be
+written depends on how Pillow was built: AVIF needs Pillow 11.2 or later, or
+the pillow-avif-plugin package.
+"""
+import argparse
+import collections
+import json
+import os
+import threading
+
+from PIL import Image, ImageFilter
+
+try:
+    # Registers an AVIF plugin with Pillows that don't have their own
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pillow_avif = None
+
+import db_utils.urls as urls
+
+SIZES = tuple(int(size) for size in urls.THUMB_SIZES)
+QUALITY = 45
+# Roughly ImageMagick's -sharpen 1x1
+SHARPEN_FILTER = ImageFilter.UnsharpMask(radius=1, percent=80, threshold=0)
+RESAMPLE = Image.LANCZOS
+DIMENSIONS_FILE = 'dimensions.json'
+
+ThumbFormat = collections.namedtuple('ThumbFormat', [
+    'pillow_format', 'extension', 'mimetype', 'quality', 'requirement'])
+
+# Extra formats thumbnails can be written in, in order of preference.
+# Qualities are picked to look about the same as the JPEG at QUALITY.
+FORMATS = collections.OrderedDict([
+    ('avif', ThumbFormat('AVIF', '.avif', 'image/avif', 40,
+                         'Pillow 11.2 or later, or the pillow-avif-plugin '
+                         'package')),
+    ('webp', ThumbFormat('WEBP', '.webp', 'image/webp', 50,
+                         'a Pillow built with libwebp')),
+])
+
+
+def get_thumb_file(dirpath, size, name):
+    """
+    Gets the path of the thumbnail of a given size for a photo (or, with
+    name=urls.ICON_FILE, for a directory) in dirpath
+    """
+    return os.path.join(dirpath, urls.THUMBS_DIR, str(size), name)
+
+
+def get_variant_file(thumb_file, format_name):
+    """
+    Gets the path of the thumbnail thumb_file written in an extra format
+    """
+    return thumb_file + FORMATS[format_name].extension
+
+
+def available_formats():
+    """
+    Gets the extra formats the installed Pillow can write
+    """
+    Image.init()
+    return [name for name, thumb_format in FORMATS.items()
+            if thumb_format.pillow_format in Image.SAVE]
+
+
+def parse_formats(value):
+    """
+    Parses a comma-separated list of extra formats, e.g. "webp,avif", given
+    on the command line. See check_formats.
+    :raise argparse.ArgumentTypeError: so the reason is shown in the usage
+        error
+    """
+    try:
+        return check_formats(value.split(','))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def check_formats(names):
+    """
+    Checks a list of extra format names.
+    :return: the formats, in order of preference
+    :raise ValueError: for unknown formats, or those Pillow can't write
+    """
+    formats = [name.strip().lower() for name in names if name.strip()]
+    available = available_formats()
+    for name in formats:
+        if name not in FORMATS:
+            raise ValueError('Unknown thumbnail format {}'.format(name))
+        if name not in available:
+            raise ValueError("This Pillow can't write {} images, they need "
+                             "{}".format(name, FORMATS[name].requirement))
+    # In order of preference
+    return [name for name in FORMATS if name in formats]
+
+
+def negotiate_format(accept_mimetypes, formats):
+    """
+    Picks the preferred extra format the client accepts. Formats have to be
+    listed explicitly: a wildcard like */* doesn't count, since clients
+    sending only that may not be able to decode the newer formats.
+    :param accept_mimetypes: (mimetype, quality) pairs, such as the
+        request's werkzeug Accept object for the Accept header
+    :param formats: the extra formats available
+    :return: a format name, or None for the JPEG
+    """
+    accepted = set(mimetype for mimetype, quality in accept_mimetypes
+                   if quality > 0)
+    for name in formats:
+        if FORMATS[name].mimetype in accepted:
+            return name
+    return None
+
+
+def parse_thumb_file(thumb_file):
+    """
+    Splits the path of a JPEG thumbnail into (dirpath, size, name), or
+    returns None if it isn't one.
+
+    For example:
+    >>> parse_thumb_file('/albums/2017/_thumbnail/250/foo.jpg')
+    ('/albums/2017', 250, 'foo.jpg')
+    >>> parse_thumb_file('/albums/2017/_thumbnail/42/foo.jpg') is None
+    True
+    """
+    size_dir, name = os.path.split(thumb_file)
+    thumbs_dir, size = os.path.split(size_dir)
+    dirpath, thumbs_dir_name = os.path.split(thumbs_dir)
+    if thumbs_dir_name != urls.THUMBS_DIR or size not in urls.THUMB_SIZES:
+        return None
+    return dirpath, int(size), name
+
+
+def is_up_to_date(dest, source_mtime):
+    try:
+        return os.stat(dest).st_mtime >= source_mtime
+    except FileNotFoundError:
+        return False
+
+
+def get_outdated_sizes(dest_dir, name, source_mtime, sizes=SIZES,
+                       formats=()):
+    """
+    Gets the sizes whose thumbnail, in JPEG or any of the extra formats, is
+    missing or older than source_mtime
+    """
+    outdated = []
+    for size in sizes:
+        thumb_file = get_thumb_file(dest_dir, size, name)
+        thumb_files = [thumb_file] + [get_variant_file(thumb_file, f)
+                                      for f in formats]
+        if not all(is_up_to_date(f, source_mtime) for f in thumb_files):
+            outdated.append(size)
+    return outdated
+
+
+def make_thumbnails(source, dest_dir, name, sizes=SIZES, overwrite=False,
+                    formats=()):
+    """
+    Writes the thumbnails of source that are missing or older than it.
+    :param dest_dir: the dir holding the _thumbnail dir, usually the dir of
+        source
+    :param name: the filename of the thumbnails, usually the filename of
+        source, or urls.ICON_FILE for a directory icon
+    :param overwrite: if True, write all the thumbnails even if they're up to
+        date
+    :param formats: extra FORMATS to also write each thumbnail in
+    :return: dict of size -> (width, height) of the thumbnails written
+    """
+    if overwrite:
+        todo = sizes
+    else:
+        todo = get_outdated_sizes(dest_dir, name, os.stat(source).st_mtime,
+                                  sizes, formats)
+    if not todo:
+        return {}
+    with Image.open(source) as image:
+        return render_thumbnails(image, dest_dir, name, todo, formats)
+
+
+def render_thumbnails(image, dest_dir, name, sizes=SIZES, formats=()):
+    """
+    Writes the thumbnails of an open image, see make_thumbnails.
+    :return: dict of size -> (width, height) of the thumbnails written
+    """
+    sizes = sorted(sizes, reverse=True)
+    # Only decode the JPEG at the smallest scale still big enough for the
+    # largest thumbnail
+    image.draft('RGB', (sizes[0], sizes[0]))
+    save_args = {'format': 'JPEG', 'quality': QUALITY}
+    for key in ('exif', 'icc_profile'):
+        if image.info.get(key):
+            save_args[key] = image.info[key]
+
+    current = image
+    if current.mode not in ('RGB', 'L'):
+        current = current.convert('RGB')
+        # e.g. a CMYK profile would no longer match the pixels
+        save_args.pop('icc_profile', None)
+    written = {}
+    for size in sizes:
+        if current is image:
+            current = current.copy()
+        current.thumbnail((size, size), RESAMPLE)
+        thumb = current.filter(SHARPEN_FILTER)
+        thumb_file = get_thumb_file(dest_dir, size, name)
+        write_image(thumb, thumb_file, save_args)
+        for format_name in formats:
+            thumb_format = FORMATS[format_name]
+            write_image(thumb, get_variant_file(thumb_file, format_name),
+                        dict(save_args, format=thumb_format.pillow_format,
+                             quality=thumb_format.quality))
+        written[size] = thumb.size
+    return written
+
+
+def write_image(image, dest, save_args):
+    """
+    Atomically writes an image, creating its directory if needed. Several
+    processes and threads may write the same image at once, e.g. the web
+    app rendering it lazily while the indexer writes it, so each one writes
+    its own temporary file.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_dest = os.path.join(os.path.dirname(dest), '.{}.{}.{}.tmp'.format(
+        os.path.basename(dest), os.getpid(), threading.get_ident()))
+    try:
+        image.save(tmp_dest, **save_args)
+        os.replace(tmp_dest, dest)
+    except BaseException:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+
+
+def get_dimensions_file(dirpath):
+    return os.path.join(dirpath, urls.THUMBS_DIR, DIMENSIONS_FILE)
+
+
+def read_dimensions(dirpath):
+    """
+    Reads the dimensions recorded for the thumbnails in dirpath.
+    :return: dict of name -> dict of size -> (width, height), empty if
+        nothing was recorded
+    """
+    try:
+        with open(get_dimensions_file(dirpath)) as f:
+            recorded = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {name: {int(size): tuple(dims) for size, dims in sizes.items()}
+            for name, sizes in recorded.items()}
+
+
+def record_dimensions(dirpath, dimensions):
+    """
+    Adds the dimensions of thumbnails written in dirpath to those already
+    recorded. Not safe to call from several processes at once for the same
+    dirpath.
+    :param dimensions: dict of name -> dict of size -> (width, height), as
+        returned by make_thumbnails for each name
+    """
+    recorded = read_dimensions(dirpath)
+    for name, sizes in dimensions.items():
+        recorded.setdefault(name, {}).update(sizes)
+    filename = get_dimensions_file(dirpath)
+    tmp_filename = '{}.tmp'.format(filename)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(tmp_filename, 'w') as f:
+        json.dump(recorded, f, sort_keys=True)
+    os.replace(tmp_filename, filename)
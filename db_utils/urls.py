@@ -0,0 +1,63 @@
+"""
+URLs of photos, thumbnails and directories. They aren't stored in the
+database: they're derived from the user path and filename when a directory
+is listed.
+"""
+import functools
+import os
+
+ICON_FILE = '_icon.jpg'
+THUMBS_DIR = '_thumbnail'
+THUMB_SIZES = ('20', '100', '250', '500')
+PHOTO_URL_ROOT = '/photo'
+DIR_URL_ROOT = '/photos'
+
+
+def get_image_url(user_path, filename):
+    """
+    Gets the URL for a full-sized image
+    """
+    return os.path.join(PHOTO_URL_ROOT, user_path.lstrip('/'), filename)
+
+
+def get_dir_url(user_path):
+    """
+    Gets the URL for a directory
+    """
+    return os.path.join(DIR_URL_ROOT, user_path.lstrip('/'))
+
+
+def get_thumb_url(user_path, filename, size):
+    """
+    Gets a URL for the thumbnail of a given photo filename and size
+    """
+    return os.path.join(PHOTO_URL_ROOT, user_path.lstrip('/'), THUMBS_DIR,
+                        str(size), filename)
+
+
+class DirUrls(object):
+    """
+    Builds the URLs of the photos of a directory by appending their filename
+    to prefixes computed once for the directory. Gives the same URLs as
+    get_image_url and get_thumb_url.
+    """
+
+    def __init__(self, user_path):
+        self.image_prefix = get_image_url(user_path, '')
+        self.thumb_prefixes = [(int(size), get_thumb_url(user_path, '', size))
+                               for size in THUMB_SIZES]
+
+    def image(self, filename):
+        return self.image_prefix + filename
+
+    def thumbs(self, filename):
+        """
+        Gets a dict of thumbnail size -> URL
+        """
+        return {size: prefix + filename
+                for size, prefix in self.thumb_prefixes}
+
+
+@functools.lru_cache(maxsize=1024)
+def get_dir_urls(user_path):
+    return DirUrls(user_path)
@@ -6,6 +6,13 @@ interp = os.path.join(os.environ['HOME'], 'venv', 'bin', 'python')
 # This is the path containing the photos and directories served by the app
 photos_root = os.path.join(os.environ['HOME'], 'mikeroburst.com', 'pics', 'albums')  # noqa
 
+# Database the index is stored in: 'mysql' (the default), or 'sqlite' for a
+# local file written by the indexer and sync with --db-backend sqlite
+# --db-path, which is faster to query and needs no server. The db_host,
+# db_user, db_password and db_name settings are only needed for mysql.
+db_backend = 'mysql'
+# db_path = os.path.join(os.environ['HOME'], 'mikeroburst.com', 'pics', '.albums.sqlite')  # noqa
+
 # Mysql database host
 db_host = 'mysql.mikeroburst.com'
 
@@ -17,3 +24,63 @@ db_password = 'my_password'
 
 # Mysql database name
 db_name = 'mikeroburst_photos'
+
+# Optional settings
+
+# File holding the index generation, bumped by the indexer and sync after
+# they commit changes. Defaults to a hidden file next to photos_root.
+# index_generation_file = os.path.join(os.environ['HOME'], 'mikeroburst.com', 'pics', '.albums.index_generation')  # noqa
+
+# Number of get_path_contents responses cached per process, and for how many
+# seconds
+path_contents_cache_size = 1000
+path_contents_cache_ttl = 3600
+
+# Serve the first page of each dir from the JSON snapshots written by the
+# indexer and sync, instead of querying the database. The snapshots are in a
+# hidden directory next to photos_root unless snapshot_dir is set.
+serve_snapshots = False
+# snapshot_dir = os.path.join(os.environ['HOME'], 'mikeroburst.com', 'pics', '.albums.snapshots')  # noqa
+
+# Max number of database connections kept open per process, seconds after
+# which idle connections are closed, seconds a request waits for a free
+# connection, and seconds a connection may stay idle before it is checked
+# with a ping when it is reused
+db_pool_size = 4
+db_pool_max_idle = 300
+db_pool_timeout = 10
+db_pool_health_check_interval = 30
+
+# Extra formats the thumbnails were written in besides JPEG, with the
+# --thumbnail-formats option of the indexer or --formats of createThumbnails,
+# among 'avif' and 'webp'. Browsers that accept them get them instead of the
+# JPEG. AVIF needs Pillow 11.2 or later, or the pillow-avif-plugin package;
+# the app refuses to start if Pillow can't write one of them.
+thumbnail_formats = []
+
+# Render thumbnails that are missing on disk when they're first requested,
+# instead of returning 404 until the thumbnail scripts are run. At most
+# lazy_thumbnail_max_renders photos are rendered at once per process, and a
+# request waits at most lazy_thumbnail_timeout seconds for its thumbnail
+# before getting a 503. They're also rendered in the thumbnail_formats.
+lazy_thumbnails = False
+lazy_thumbnail_max_renders = 2
+lazy_thumbnail_timeout = 30
+
+# Seconds browsers may cache thumbnails and full-size photos for, after which
+# they revalidate them. Thumbnails are rewritten under the same URLs when
+# their photo changes, so keep thumbnail_max_age short.
+thumbnail_max_age = 3600
+photo_max_age = 24 * 3600
+
+# Let the front server send photos and thumbnails instead of the app:
+# 'X-Sendfile' for Apache's mod_xsendfile, or 'X-Accel-Redirect' for nginx,
+# with x_accel_redirect_prefix being an internal location aliased to
+# photos_root, e.g.
+#     location /internal_photos/ { internal; alias /path/to/albums/; }
+sendfile_header = None
+# x_accel_redirect_prefix = '/internal_photos'
+
+# Serve database pool, cache and thumbnail renderer metrics as JSON at
+# /stats
+stats_enabled = False
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Benchmarks indexing, sync, queries, serialization and thumbnail generation
+on a synthetic album tree, using the sqlite backend as the database, so
+nothing else needs to be running.
+
+The tree holds small JPEGs with EXIF, fanout subdirectories per dir down to
+depth levels, and photos_per_dir photos in each dir. It's generated from a
+seed, so runs with the same options work on the same tree. Results are
+printed and saved as JSON. Pass the JSON of an earlier run as --baseline to
+compare with it.
+
+Run from the top of the repository:
+python -m scripts.benchmark --depth 2 --fanout 8 --photos-per-dir 20 \
+    --output results.json
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+from PIL.TiffImagePlugin import IFDRational
+
+import db_utils.backends as backends
+import db_utils.batch_writer as batch_writer
+import db_utils.exif_cache as exif_cache_lib
+import db_utils.indexer as indexer
+import db_utils.query as query
+import db_utils.sync_index as sync_index
+import db_utils.thumbnails as thumbnails
+
+DEFAULT_DEPTH = 2
+DEFAULT_FANOUT = 5
+DEFAULT_PHOTOS_PER_DIR = 20
+DEFAULT_PHOTO_SIZE = 640
+DEFAULT_QUERY_ROUNDS = 20
+DEFAULT_THUMBNAIL_PHOTOS = 50
+DEFAULT_SEED = 1
+# Share of the photos rewritten before the sync benchmark
+CHANGED_FRACTION = 0.05
+PERCENTILES = (50, 90, 99)
+
+# EXIF tags, see https://exiftool.org/TagNames/EXIF.html
+EXIF_IFD = 0x8769
+MAKE = 0x010F
+MODEL = 0x0110
+EXPOSURE_TIME = 0x829A
+F_NUMBER = 0x829D
+ISO = 0x8827
+DATE_TIME_ORIGINAL = 0x9003
+FOCAL_LENGTH = 0x920A
+LENS_MODEL = 0xA434
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='Where to generate the tree and the '
+                        'database. Defaults to a temporary dir, deleted '
+                        'afterwards')
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH,
+                        help='Levels of dirs below the root')
+    parser.add_argument('--fanout', type=int, default=DEFAULT_FANOUT,
+                        help='Subdirectories per dir')
+    parser.add_argument('--photos-per-dir', type=int,
+                        default=DEFAULT_PHOTOS_PER_DIR,
+                        help='Photos in each dir, root included')
+    parser.add_argument('--photo-size', type=int, default=DEFAULT_PHOTO_SIZE,
+                        help='Width of the photos, in pixels')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help='Seed the tree is generated from')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes used by the indexer')
+    parser.add_argument('--query-rounds', type=int,
+                        default=DEFAULT_QUERY_ROUNDS,
+                        help='Times each dir is queried')
+    parser.add_argument('--thumbnail-photos', type=int,
+                        default=DEFAULT_THUMBNAIL_PHOTOS,
+                        help='Photos to make thumbnails of. 0 skips the '
+                        'thumbnail benchmark')
+    parser.add_argument('--output', help='File to save the results in, as '
+                        'JSON')
+    parser.add_argument('--baseline', help='Results of an earlier run, as '
+                        'saved with --output, to compare with')
+    return parser.parse_args()
+
+
+def generate_tree(root, depth, fanout, photos_per_dir, photo_size, seed):
+    """
+    Generates the album tree, unless it's already there
+    :return: the number of photos in the tree
+    """
+    rng = random.Random(seed)
+    num_photos = 0
+    pending = [(root, 0)]
+    while pending:
+        dirpath, level = pending.pop()
+        os.makedirs(dirpath, exist_ok=True)
+        for i in range(photos_per_dir):
+            path = os.path.join(dirpath, 'IMG_{:04d}.jpg'.format(i))
+            if not os.path.exists(path):
+                write_photo(path, photo_size, rng)
+            num_photos += 1
+        if level < depth:
+            for i in range(fanout):
+                pending.append((os.path.join(
+                    dirpath, 'album {:02d}'.format(i)), level + 1))
+    return num_photos
+
+
+def write_photo(path, width, rng):
+    """
+    Writes a JPEG of a few random shapes, with the EXIF of a camera
+    """
+    height = width * 2 // 3
+    image = Image.new('RGB', (width, height), _random_color(rng))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.ellipse((x, y, x + rng.randrange(1, width // 2),
+                      y + rng.randrange(1, height // 2)),
+                     fill=_random_color(rng))
+
+    exif = Image.Exif()
+    exif[MAKE] = 'Benchmark'
+    exif[MODEL] = 'Camera {}'.format(rng.randrange(3))
+    exif_ifd = exif.get_ifd(EXIF_IFD)
+    exif_ifd[DATE_TIME_ORIGINAL] = '{:04d}:{:02d}:{:02d} {:02d}:{:02d}:00'\
+        .format(rng.randrange(2000, 2020), rng.randrange(1, 13),
+                rng.randrange(1, 29), rng.randrange(24), rng.randrange(60))
+    exif_ifd[EXPOSURE_TIME] = IFDRational(1, rng.choice((60, 125, 250, 500)))
+    exif_ifd[F_NUMBER] = IFDRational(rng.choice((18, 28, 40, 56, 80)), 10)
+    exif_ifd[ISO] = rng.choice((100, 200, 400, 800))
+    exif_ifd[FOCAL_LENGTH] = IFDRational(rng.choice((24, 35, 50, 85)), 1)
+    exif_ifd[LENS_MODEL] = 'Lens {}'.format(rng.randrange(3))
+    image.save(path, quality=85, exif=exif)
+
+
+def _random_color(rng):
+    return rng.randrange(256), rng.randrange(256), rng.randrange(256)
+
+
+def list_photos(root):
+    return [os.path.join(dirpath, filename)
+            for dirpath, dirnames, filenames in indexer.walk_dirs(root)
+            for filename in filenames if indexer.is_photo_file(filename)]
+
+
+class Stopwatch(object):
+    """
+    Times a block
+    """
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+
+
+def peak_rss_kb():
+    """
+    Peak RSS, in KB, of this process and of its largest waited-for child
+    (e.g. an indexer worker)
+    """
+    rss = [resource.getrusage(who).ru_maxrss
+           for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    if sys.platform == 'darwin':
+        # In bytes there
+        rss = [r // 1024 for r in rss]
+    return {'self': rss[0], 'children': rss[1]}
+
+
+def latency_stats(latencies):
+    """
+    :param latencies: list of durations, in seconds
+    :return: dict of the count, mean and percentiles, in milliseconds
+    """
+    latencies = sorted(latencies)
+    stats = {
+        'count': len(latencies),
+        'mean_ms': 1000 * sum(latencies) / len(latencies),
+        'max_ms': 1000 * latencies[-1],
+    }
+    for p in PERCENTILES:
+        index = min(len(latencies) - 1, int(len(latencies) * p / 100))
+        stats['p{}_ms'.format(p)] = 1000 * latencies[index]
+    return stats
+
+
+def throughput(num_photos, seconds):
+    return {
+        'photos': num_photos,
+        'seconds': seconds,
+        'photos_per_s': num_photos / seconds if seconds else None,
+    }
+
+
+def bench_index(db_path, root, num_photos, workers, cache_file=None):
+    """
+    Indexes the whole tree into a fresh database, with the EXIF cache in
+    cache_file if given
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = backends.SQLiteBackend(db_path).connect()
+    writer = batch_writer.BatchWriter(conn)
+    exif_cache = None
+    if cache_file is not None:
+        exif_cache = exif_cache_lib.ExifCache(cache_file)
+    try:
+        # Silences the "Indexing ..." line of every dir and the progress. The
+        # rows written are only printed by verbose writers, unlike these.
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), Stopwatch() as watch:
+            indexer.walk_path(writer, root, root, True, workers=workers,
+                              exif_cache=exif_cache)
+            writer.commit()
+    finally:
+        writer.close()
+        conn.close()
+        if exif_cache is not None:
+            exif_cache.close()
+    return throughput(num_photos, watch.seconds)
+
+
+def bench_sync(db_path, root, num_photos, rng):
+    """
+    Syncs the indexed tree after touching CHANGED_FRACTION of its photos,
+    then once more with nothing to do. The photos keep their contents.
+    """
+    photos = list_photos(root)
+    changed = rng.sample(photos, max(1, int(len(photos) * CHANGED_FRACTION)))
+    for path in changed:
+        # The database only keeps whole seconds
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+    conn = backends.SQLiteBackend(db_path).connect()
+    writer = batch_writer.BatchWriter(conn)
+    results = {}
+    try:
+        for name in ('changed', 'unchanged'):
+            # Silences the "Indexing ..." line of every changed dir and the
+            # progress
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull), Stopwatch() as watch:
+                sync_index.sync(writer, root, root, True)
+                writer.commit()
+            results[name] = throughput(num_photos, watch.seconds)
+        results['changed']['changed_photos'] = len(changed)
+    finally:
+        writer.close()
+        conn.close()
+    return results
+
+
+def bench_queries(db_path, rounds):
+    """
+    Queries the contents of every dir rounds times, in full and as the
+    first lean page, the way the web app does, and serializes them
+    """
+    conn = backends.SQLiteBackend(db_path).connect(read_only=True)
+    querier = query.Querier(None, None, None, None, conn=conn)
+    try:
+        querier.db.execute('SELECT user_path FROM dirs', ())
+        user_paths = [user_path for user_path, in querier.db.fetchall()]
+        latencies = {'get_path_contents': [], 'get_path_contents_page': [],
+                     'serialize_path_contents': []}
+        response_bytes = []
+        for _ in range(rounds):
+            for user_path in user_paths:
+                start = time.perf_counter()
+                contents = querier.get_path_contents(user_path)
+                latencies['get_path_contents'].append(
+                    time.perf_counter() - start)
+
+                start = time.perf_counter()
+                querier.get_path_contents_page(user_path, lean=True)
+                latencies['get_path_contents_page'].append(
+                    time.perf_counter() - start)
+
+                start = time.perf_counter()
+                data = query.serialize_path_contents(contents)
+                latencies['serialize_path_contents'].append(
+                    time.perf_counter() - start)
+                response_bytes.append(len(data))
+    finally:
+        querier.close()
+        conn.close()
+    results = {name: latency_stats(values)
+               for name, values in latencies.items()}
+    results['serialize_path_contents']['mean_bytes'] = (
+        sum(response_bytes) / len(response_bytes))
+    return results
+
+
+def bench_thumbnails(root, count, rng):
+    """
+    Makes the thumbnails of count photos from scratch
+    """
+    photos = sorted(rng.sample(list_photos(root), count))
+    latencies = []
+    with Stopwatch() as watch:
+        for path in photos:
+            start = time.perf_counter()
+            dirpath, filename = os.path.split(path)
+            thumbnails.make_thumbnails(path, dirpath, filename,
+                                       overwrite=True)
+            latencies.append(time.perf_counter() - start)
+    results = throughput(len(photos), watch.seconds)
+    results['latency'] = latency_stats(latencies)
+    return results
+
+
+def compare(results, baseline, prefix=''):
+    """
+    Prints the metrics that are in both results, with their ratio to the
+    baseline
+    """
+    for key in sorted(results):
+        value, old = results[key], baseline.get(key)
+        name = prefix + key
+        if isinstance(value, dict) and isinstance(old, dict):
+            compare(value, old, name + '.')
+        elif (isinstance(value, (int, float)) and
+                isinstance(old, (int, float)) and old):
+            print('{:60} {:>12.3f} {:>12.3f} {:>7.2f}x'.format(
+                name, old, value, value / old))
+
+
+def print_results(results, prefix=''):
+    for key in sorted(results):
+        value = results[key]
+        if isinstance(value, dict):
+            print_results(value, prefix + key + '.')
+        elif isinstance(value, float):
+            print('{:60} {:>12.3f}'.format(prefix + key, value))
+        else:
+            print('{:60} {:>12}'.format(prefix + key, str(value)))
+
+
+def main():
+    args = parse_args()
+    work_dir = args.dir or tempfile.mkdtemp(prefix='photos_benchmark_')
+    root = os.path.join(work_dir, 'albums')
+    db_path = os.path.join(work_dir, 'index.sqlite')
+    cache_file = os.path.join(work_dir, 'exif_cache.sqlite')
+    rng = random.Random(args.seed)
+
+    run = {
+        'options': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'results': {},
+    }
+    results = run['results']
+    try:
+        with Stopwatch() as watch:
+            num_photos = generate_tree(root, args.depth, args.fanout,
+                                       args.photos_per_dir, args.photo_size,
+                                       args.seed)
+        print('Tree of {} photos in {} ready in {:.1f}s'.format(
+            num_photos, root, watch.seconds))
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+
+        results['index'] = bench_index(db_path, root, num_photos,
+                                       args.workers)
+        # First to fill the cache, then to use it
+        bench_index(db_path, root, num_photos, args.workers, cache_file)
+        results['index_exif_cached'] = bench_index(
+            db_path, root, num_photos, args.workers, cache_file)
+        results['sync'] = bench_sync(db_path, root, num_photos, rng)
+        results['queries'] = bench_queries(db_path, args.query_rounds)
+        if args.thumbnail_photos:
+            results['thumbnails'] = bench_thumbnails(
+                root, min(args.thumbnail_photos, num_photos), rng)
+        results['peak_rss_kb'] = peak_rss_kb()
+    finally:
+        if not args.dir:
+            shutil.rmtree(work_dir)
+
+    print_results(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print('\nCompared with {} (baseline, this run, ratio):'.format(
+            args.baseline))
+        compare(results, baseline['results'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,64 @@
 #!/usr/bin/env python
+"""
+Creates the thumbnails of a photo, or of all the photos below a directory.
+
+Run from the top of the repository:
+python -m scripts.createThumbnails /path/to/photos/2018 --workers 8
+"""
 import argparse
+import multiprocessing
 import os
-import shlex
-import subprocess
 
-import convert_icon_files
+import db_utils.thumbnails as thumbnails
+import scripts.convert_icon_files as convert_icon_files
 
-CONVERT_CMD = ('convert -limit memory 2048gb -resize "{height}x{height}" '
-               '-sharpen 1x1 -compress JPEG -quality 45 '
-               '"{source}" "{dest}"')
-ICON_FILE = '_icon.jpg'
-SIZES = (20, 100, 250, 500,)
-THUMB_DIR = '_thumbnail'
+ICON_FILE = thumbnails.urls.ICON_FILE
+SIZES = thumbnails.SIZES
+THUMB_DIR = thumbnails.urls.THUMBS_DIR
+# Number of photos handed to a worker at a time
+CHUNK_SIZE = 4
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename', help='image file to create icons for')
+    parser.add_argument('filename', help='image file to create icons for, or '
+                        'a directory to create the thumbnails of all the '
+                        'images below it')
     parser.add_argument('--use-existing-icon', help='when passing in an '
                         'old-style _icon.jpg file, attempt to find the '
                         'original image and use it to create new-style iconds',
                         action='store_true')
     parser.add_argument('--use-as-icon', help='use this as the icon '
                         'file for a directory', action='store_true')
-    parser.add_argument('--overwrite', help='overwrite existing thumbnails',
+    parser.add_argument('--overwrite', help='overwrite existing thumbnails. '
+                        'By default only missing thumbnails and those older '
+                        'than their image are written',
                         action='store_true')
     parser.add_argument('--dest-path', help='destination path for '
                         'thumbnails/icons. Defaults to the path of the '
                         'input image')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of processes creating thumbnails when '
+                        'given a directory. Defaults to the number of CPUs')
+    parser.add_argument('--formats', type=thumbnails.parse_formats,
+                        default=[],
+                        help='Comma-separated extra formats to write the '
+                        'thumbnails in besides JPEG, among {}'.format(
+                            ', '.join(thumbnails.FORMATS)))
     return parser.parse_args()
 
 
-def make_thumbnail(source, dest, height):
-    cmd = CONVERT_CMD.format(height=height, source=source, dest=dest)
-    print(cmd)
-    subprocess.check_call(shlex.split(cmd))
-
-
-def get_thumb_path(filename, height, dirname=None):
-    if dirname is None:
-        dirname = os.path.dirname(filename)
-    thumb_path = os.path.join(dirname, THUMB_DIR, str(height))
-    if not os.path.isdir(thumb_path):
-        print("mkdir {}".format(thumb_path))
-        os.makedirs(thumb_path, exist_ok=True)
-    return thumb_path
+def make_thumbnails(source, dest_path, name, overwrite=False, formats=()):
+    """
+    :return: dict of size -> (width, height) of the thumbnails written
+    """
+    written = thumbnails.make_thumbnails(source, dest_path, name,
+                                         overwrite=overwrite, formats=formats)
+    if written:
+        print("{} -> {}".format(source, ', '.join(
+            '{}x{}'.format(*written[size]) for size in sorted(written))))
+    return written
 
 
 def is_valid_image(name_only):
@@ -56,30 +70,85 @@ def is_valid_image(name_only):
         return True
 
 
-def use_existing_icon(filename, dest_path, overwrite=False):
+def use_existing_icon(filename, dest_path, overwrite=False, formats=()):
     original = convert_icon_files.find_original(filename)
     if original and os.path.exists(original):
-        for height in SIZES:
-            thumb_path = get_thumb_path(filename, height, dirname=dest_path)
-            dest = os.path.join(thumb_path,  ICON_FILE)
-            if overwrite or not os.path.exists(dest):
-                make_thumbnail(original, dest, height)
+        written = make_thumbnails(original, dest_path, ICON_FILE,
+                                  overwrite=overwrite, formats=formats)
+        record_dimensions(dest_path, ICON_FILE, written)
     else:
         raise ValueError("No original image found for {}".format(filename))
 
 
-def process_image(filename, dest_path, use_as_icon=False, overwrite=False):
+def process_image(filename, dest_path, use_as_icon=False, overwrite=False,
+                  formats=()):
+    """
+    :return: (name, written): the name of the thumbnails and the dict of
+        size -> (width, height) of those written, to be recorded with
+        record_dimensions
+    """
     name_only = os.path.basename(filename)
     if not is_valid_image(name_only):
-        return
-    for height in SIZES:
-        thumb_path = get_thumb_path(filename, height, dirname=dest_path)
-        if use_as_icon:
-            dest = os.path.join(thumb_path, ICON_FILE)
-        else:
-            dest = os.path.join(thumb_path, name_only)
-        if overwrite or not os.path.exists(dest):
-            make_thumbnail(filename, dest, height)
+        return name_only, {}
+    name = ICON_FILE if use_as_icon else name_only
+    return name, make_thumbnails(filename, dest_path, name,
+                                 overwrite=overwrite, formats=formats)
+
+
+def record_dimensions(dest_path, name, written):
+    if written:
+        thumbnails.record_dimensions(dest_path, {name: written})
+
+
+def find_images(path):
+    """
+    Yields the images below path, skipping thumbnail directories
+    """
+    for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        dirnames[:] = sorted(d for d in dirnames if d != THUMB_DIR)
+        for filename in sorted(filenames):
+            if is_valid_image(filename):
+                yield os.path.join(dirpath, filename)
+
+
+def process_tree(path, workers, overwrite=False, formats=()):
+    """
+    Creates the thumbnails of all the images below path, next to each image,
+    in a pool of worker processes. Their dimensions are recorded by this
+    process, once per directory.
+    """
+    tasks = ((filename, overwrite, formats)
+             for filename in find_images(path))
+    # Results come back in the order of find_images, one dir after the other
+    current_dir = None
+    dimensions = {}
+    with multiprocessing.Pool(processes=workers) as pool:
+        for dirpath, name, written in pool.imap(
+                _process_tree_image, tasks, chunksize=CHUNK_SIZE):
+            if dirpath != current_dir:
+                if dimensions:
+                    thumbnails.record_dimensions(current_dir, dimensions)
+                current_dir = dirpath
+                dimensions = {}
+            if written:
+                dimensions[name] = written
+    if dimensions:
+        thumbnails.record_dimensions(current_dir, dimensions)
+
+
+def _process_tree_image(task):
+    """Runs in a worker process. Returns (dirpath, name, written)"""
+    filename, overwrite, formats = task
+    dirpath = os.path.dirname(filename)
+    try:
+        name, written = process_image(filename, dirpath, overwrite=overwrite,
+                                      formats=formats)
+    except (OSError, SyntaxError) as e:
+        # Pillow raises SyntaxError for some broken files. Don't let one
+        # image stop the whole tree.
+        print("Couldn't create thumbnails for {}: {}".format(filename, e))
+        return dirpath, None, {}
+    return dirpath, name, written
 
 
 def main():
@@ -88,16 +157,25 @@ def main():
     if not os.path.exists(args.filename):
         raise OSError("No such file {}".format(args.filename))
 
+    if os.path.isdir(args.filename):
+        process_tree(args.filename, args.workers, overwrite=args.overwrite,
+                     formats=args.formats)
+        return
+
     if args.dest_path:
         dest_path = args.dest_path
     else:
         dest_path = os.path.dirname(args.filename)
 
     if args.use_existing_icon:
-        use_existing_icon(args.filename, dest_path, overwrite=args.overwrite)
+        use_existing_icon(args.filename, dest_path, overwrite=args.overwrite,
+                          formats=args.formats)
     else:
-        process_image(args.filename, dest_path, use_as_icon=args.use_as_icon,
-                      overwrite=args.overwrite)
+        name, written = process_image(args.filename, dest_path,
+                                      use_as_icon=args.use_as_icon,
+                                      overwrite=args.overwrite,
+                                      formats=args.formats)
+        record_dimensions(dest_path, name, written)
 
 
 if __name__ == '__main__':
@@ -37,10 +37,10 @@ function photoswipeParseHash() {
 
 /**
  * Get the numeric index of the photo with the given pid. pid is usually the
- * filename of the image.
+ * filename of the image. Returns -1 if there is no such photo.
  */
 function getIndexOfPid(pswpItems, pid) {
-    var index = 0;
+    var index = -1;
     for (var j = 0; j < pswpItems.length; j++) {
         if (pswpItems[j].pid == pid) {
             index = j;
@@ -63,6 +63,130 @@ function getPathContents(url) {
 }
 
 
+/**
+ * Loads the JSON object containing lightbox and grid info for the given
+ * get_path_contents_page URL one page at a time, without blocking the page.
+ * onPage is called with each page once it has been loaded.
+ */
+function PathContentsLoader(url, onPage) {
+    this.url = url;
+    this.onPage = onPage;
+    this.nextCursor = null;
+    this.loading = false;
+    this.done = false;
+}
+
+
+/**
+ * Requests the next page, unless a request is already in flight or all the
+ * pages have been loaded.
+ */
+PathContentsLoader.prototype.loadNext = function() {
+    if (this.loading || this.done) {
+        return;
+    }
+    this.loading = true;
+    var pageUrl = this.url;
+    if (this.nextCursor !== null) {
+        pageUrl += (pageUrl.indexOf("?") == -1 ? "?" : "&") +
+            "cursor=" + encodeURIComponent(this.nextCursor);
+    }
+    var loader = this;
+    var xhttp = new XMLHttpRequest();
+    xhttp.open("GET", pageUrl, true);
+    xhttp.onload = function() {
+        loader.loading = false;
+        if (xhttp.status != 200) {
+            console.error("Failed to load " + pageUrl + ": " + xhttp.status);
+            return;
+        }
+        var page = JSON.parse(xhttp.responseText);
+        loader.nextCursor = page.next_cursor;
+        loader.done = (page.next_cursor === null);
+        loader.onPage(page);
+    };
+    xhttp.onerror = function() {
+        loader.loading = false;
+        console.error("Failed to load " + pageUrl);
+    };
+    xhttp.send();
+};
+
+
+/**
+ * Loads the full lightbox info (EXIF, size, date...) of the photos of a path
+ * whose pages were loaded with lean=1, in blocks of photos around the ones
+ * being viewed. url is the get_lightbox_details URL of the path.
+ */
+function LightboxDetailsLoader(url) {
+    this.url = url;
+    this.blockSize = 50;
+    // Number of photos before and after the current one to have details for
+    this.prefetchCount = 5;
+    this.details = {};  // lightbox index -> details
+    this.requestedBlocks = {};
+}
+
+
+/**
+ * Copies the details of the photo at index into its photoswipe item, if
+ * they have been loaded.
+ */
+LightboxDetailsLoader.prototype.apply = function(index, item) {
+    var details = this.details[index];
+    if (details === undefined) {
+        return;
+    }
+    for (var key in details) {
+        item[key] = details[key];
+    }
+};
+
+
+/**
+ * Loads the details of the photos around index, if they haven't been
+ * requested already. onLoad is called with the first index and the number
+ * of photos of each block once it has been loaded.
+ */
+LightboxDetailsLoader.prototype.prefetch = function(index, onLoad) {
+    var first = Math.max(0, index - this.prefetchCount);
+    var last = index + this.prefetchCount;
+    for (var block = Math.floor(first / this.blockSize);
+            block <= Math.floor(last / this.blockSize); block++) {
+        if (!this.requestedBlocks[block]) {
+            this.requestedBlocks[block] = true;
+            this._loadBlock(block, onLoad);
+        }
+    }
+};
+
+
+LightboxDetailsLoader.prototype._loadBlock = function(block, onLoad) {
+    var loader = this;
+    var blockUrl = this.url + "?start=" + (block * this.blockSize) +
+        "&count=" + this.blockSize;
+    var xhttp = new XMLHttpRequest();
+    xhttp.open("GET", blockUrl, true);
+    xhttp.onload = function() {
+        if (xhttp.status != 200) {
+            console.error("Failed to load " + blockUrl + ": " + xhttp.status);
+            loader.requestedBlocks[block] = false;
+            return;
+        }
+        var res = JSON.parse(xhttp.responseText);
+        for (var i = 0; i < res.lightbox.length; i++) {
+            loader.details[res.start + i] = res.lightbox[i];
+        }
+        onLoad(res.start, res.lightbox.length);
+    };
+    xhttp.onerror = function() {
+        console.error("Failed to load " + blockUrl);
+        loader.requestedBlocks[block] = false;
+    };
+    xhttp.send();
+};
+
+
 /**
  * Generate breadcrumb links for a path by splitting it on forward slashes.\
  * Puts the breadcrumbs in the supplied UL element.
@@ -306,7 +306,24 @@
         else if (lastWindowWidth <= 1920)
           return 250;
         return 500;
-      }
+      },
+
+      /**
+       * Type: function | null
+       * Default: null
+       * Description: Called when the bottom image buffer reaches the end of
+       *   the grid, e.g. to load more images and pass them to `addImages`.
+       *   May be called again before those images have been added.
+       */
+      onNearEnd: null,
+
+      /**
+       * Type: function | null
+       * Default: null
+       * Description: Called with the PhotoSwipe instance when an image is
+       *   clicked, before the lightbox is initialized, e.g. to add listeners.
+       */
+      onLightboxOpen: null
     };
 
     // We extend the default settings with the provided overrides.
@@ -608,6 +625,11 @@
         image.load();
       }
     }.bind(this));
+
+    // Ask for more images once the bottom buffer reaches the end of the grid
+    if (this.settings.onNearEnd && maxTranslateY >= this.totalHeight) {
+      this.settings.onNearEnd();
+    }
   };
 
   /**
@@ -674,6 +696,26 @@
     return this;
   };
 
+  /**
+   * Append images to the end of the grid, and lay out the grid again.
+   *
+   * @param {array} imageData - An array of metadata about each image to
+   *                            add, in the same format as for the
+   *                            constructor.
+   *
+   * @returns {object} The Pig instance.
+   */
+  Pig.prototype.addImages = function(imageData) {
+    var offset = this.images.length;
+    imageData.forEach(function(image, index) {
+      this.images.push(new ProgressiveImage(image, offset + index, this));
+    }.bind(this));
+
+    this._computeLayout();
+    this._doLayout();
+    return this;
+  };
+
   /**
    * Remove all scroll and resize listeners.
    *
@@ -910,6 +952,14 @@
       tileInfoTextDiv.appendChild(tileInfoTextP);
       tileInfoDiv.appendChild(tileInfoTextDiv);
 
+      if (this.metadata.type == "dir" && this.metadata.total_photos) {
+          var summary = this.metadata.total_photos + " photos";
+          if (this.metadata.last_updated) {
+              summary += ", last updated " + this.metadata.last_updated;
+          }
+          tileInfoDiv.title = summary;
+      }
+
       figure.appendChild(tileInfoDiv);
 
       this.caption = tileInfoDiv;
@@ -953,9 +1003,13 @@
         var pswpElement = this.pig.pswpElement;
         var pswpUI = this.pig.pswpUI;
         var pswpItems = this.pig.pswpItems;
+        var onLightboxOpen = this.pig.settings.onLightboxOpen;
 
         this.getElement().addEventListener('click', function() {
             var lightbox = new PhotoSwipe(pswpElement, pswpUI, pswpItems, options);
+            if (onLightboxOpen) {
+                onLightboxOpen(lightbox);
+            }
             lightbox.init();
         });
     }
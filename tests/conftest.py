@@ -0,0 +1,36 @@
+import importlib
+import sys
+import types
+
+import pytest
+
+import db_utils.backends as backends
+
+
+@pytest.fixture
+def load_url_handler(tmp_path, monkeypatch):
+    """
+    Imports the web app with a config.py made of the given settings, on
+    top of a photos root and a SQLite database in tmp_path
+    """
+    loaded = []
+
+    def load(**settings):
+        config = types.ModuleType('config')
+        config.photos_root = str(tmp_path / 'photos')
+        config.db_backend = backends.SQLITE_BACKEND
+        config.db_path = str(tmp_path / 'index.sqlite')
+        config.index_generation_file = str(tmp_path / 'generation')
+        for name, value in settings.items():
+            setattr(config, name, value)
+        monkeypatch.setitem(sys.modules, 'config', config)
+        # The settings are read when the app is imported
+        monkeypatch.delitem(sys.modules, 'url_handler', raising=False)
+        url_handler = importlib.import_module('url_handler')
+        loaded.append(url_handler)
+        return url_handler
+
+    yield load
+    for url_handler in loaded:
+        url_handler.db_pool.close()
+    sys.modules.pop('url_handler', None)
@@ -0,0 +1,230 @@
+import contextlib
+import io
+import os
+import shutil
+import sqlite3
+
+import pytest
+from PIL import Image
+
+import db_utils.backends as backends
+import db_utils.batch_writer as batch_writer
+import db_utils.indexer as indexer
+import db_utils.sync_index as sync_index
+
+# Small enough that batches fill and commits happen in the middle of
+# every dir
+BATCH_SIZE = 1
+COMMIT_EVERY = 2
+
+PHOTOS = [
+    'a/1.jpg',
+    'a/2.jpg',
+    'a/b/3.jpg',
+    'c/4.jpg',
+    'c/5.jpg',
+    'c/d/e/6.jpg',
+    'f/7.jpg',
+]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def add_photo(root, path, size=(40, 30), mtime=None):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGB', size).save(path)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = str(tmp_path / 'photos')
+    for i, path in enumerate(PHOTOS):
+        # Distinct sizes and dates, so each extreme comes from one photo
+        add_photo(root, path, size=(40 + i, 30), mtime=1500000000 + i * 3600)
+    return root
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'index.sqlite')
+
+
+def open_writer(db_path):
+    conn = backends.SQLiteBackend(db_path).connect()
+    return conn, batch_writer.BatchWriter(conn, batch_size=BATCH_SIZE,
+                                          commit_every=COMMIT_EVERY)
+
+
+def index(db_path, root):
+    conn, writer = open_writer(db_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.walk_path(writer, root, root, True)
+        writer.close()
+    conn.close()
+
+
+def sync(db_path, path, root):
+    conn, writer = open_writer(db_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sync_index.sync(writer, path, root, True)
+        writer.close()
+    conn.close()
+
+
+def abandon(conn, writer):
+    """
+    Closes the connection without committing, like a killed run: whatever
+    wasn't committed is lost
+    """
+    # Otherwise the cursor's statements keep the connection open
+    writer.db.close()
+    conn.close()
+
+
+def check_aggregates(db_path, complete=True):
+    """
+    Compares the committed aggregates of every dir against a recompute
+    from its own photos and the aggregates of its subdirectories, and if
+    complete, against a recompute from all the photos in its subtree
+    :param complete: False if the run was interrupted, in which case the
+        photos of a dir whose row wasn't written yet are in no aggregates
+    :return: the number of dirs
+    """
+    db = sqlite3.connect(db_path)
+    dirs = db.execute("""
+        SELECT user_path, num_photos, num_subdirs, total_photos, total_size,
+               min_created_time, max_created_time, max_modified_time
+        FROM dirs""").fetchall()
+    for row in dirs:
+        user_path = row[0]
+        own = db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created_time),
+                   MAX(created_time), MAX(modified_time)
+            FROM photos WHERE user_path = ?""", (user_path,)).fetchone()
+        subdirs = db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(total_photos), 0),
+                   COALESCE(SUM(total_size), 0), MIN(min_created_time),
+                   MAX(max_created_time), MAX(max_modified_time)
+            FROM dirs WHERE parent_user_path = ?""", (user_path,)).fetchone()
+        expected = (user_path, own[0], subdirs[0], own[0] + subdirs[1],
+                    own[1] + subdirs[2],
+                    min_value(own[2], subdirs[3]),
+                    max_value(own[3], subdirs[4]),
+                    max_value(own[4], subdirs[5]))
+        assert tuple(map(str, row)) == tuple(map(str, expected))
+        if not complete:
+            continue
+        prefix = user_path.rstrip('/') + '/'
+        totals = db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created_time),
+                   MAX(created_time), MAX(modified_time)
+            FROM photos
+            WHERE user_path = ? OR substr(user_path, 1, ?) = ?""",
+            (user_path, len(prefix), prefix)).fetchone()
+        assert tuple(map(str, row[3:])) == tuple(map(str, totals))
+    db.close()
+    return len(dirs)
+
+
+def min_value(*values):
+    values = [value for value in values if value is not None]
+    return min(values) if values else None
+
+
+def max_value(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def test_index(db_path, root):
+    index(db_path, root)
+    assert check_aggregates(db_path) == 7
+    # Reindexing replaces every row
+    index(db_path, root)
+    assert check_aggregates(db_path) == 7
+
+
+def test_sync_add_delete_and_move(db_path, root):
+    index(db_path, root)
+
+    add_photo(root, 'a/b/8.jpg', mtime=1400000000)
+    add_photo(root, 'g/h/9.jpg', mtime=1600000000)
+    sync(db_path, root, root)
+    assert check_aggregates(db_path) == 9
+
+    # The photos holding the extreme dates of their ancestors
+    os.remove(os.path.join(root, 'a/b/8.jpg'))
+    shutil.rmtree(os.path.join(root, 'g'))
+    sync(db_path, root, root)
+    assert check_aggregates(db_path) == 7
+
+    # A photo replaced by a bigger one
+    add_photo(root, 'c/4.jpg', size=(400, 300), mtime=1550000000)
+    sync(db_path, root, root)
+    assert check_aggregates(db_path) == 7
+
+    os.rename(os.path.join(root, 'c/d'), os.path.join(root, 'a/d'))
+    sync(db_path, root, root)
+    assert check_aggregates(db_path) == 7
+
+
+def test_sync_subtree(db_path, root):
+    index(db_path, root)
+    add_photo(root, 'c/d/10.jpg', mtime=1300000000)
+    os.remove(os.path.join(root, 'c/5.jpg'))
+    # Only the subtree is synced, but its ancestors' aggregates change too
+    sync(db_path, os.path.join(root, 'c'), root)
+    assert check_aggregates(db_path) == 7
+
+
+@pytest.mark.parametrize('photos_read', range(1, len(PHOTOS)))
+def test_interrupted_index(db_path, root, monkeypatch, photos_read):
+    read_photo = indexer.read_photo
+    calls = []
+
+    def interrupting_read_photo(*args, **kwargs):
+        if len(calls) == photos_read:
+            raise Interrupted()
+        calls.append(args)
+        return read_photo(*args, **kwargs)
+
+    monkeypatch.setattr(indexer, 'read_photo', interrupting_read_photo)
+    conn, writer = open_writer(db_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        with pytest.raises(Interrupted):
+            indexer.walk_path(writer, root, root, True)
+    abandon(conn, writer)
+    check_aggregates(db_path, complete=False)
+    monkeypatch.undo()
+    index(db_path, root)
+    assert check_aggregates(db_path) == 7
+
+
+def test_interrupted_sync(db_path, root, monkeypatch):
+    index(db_path, root)
+    for i in range(4):
+        add_photo(root, 'c/d/new{}.jpg'.format(i), mtime=1200000000 + i)
+    read_photo = indexer.read_photo
+    calls = []
+
+    def interrupting_read_photo(*args, **kwargs):
+        if len(calls) == 3:
+            raise Interrupted()
+        calls.append(args)
+        return read_photo(*args, **kwargs)
+
+    monkeypatch.setattr(indexer, 'read_photo', interrupting_read_photo)
+    conn, writer = open_writer(db_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        with pytest.raises(Interrupted):
+            sync_index.sync(writer, root, root, True)
+    abandon(conn, writer)
+    check_aggregates(db_path, complete=False)
+    monkeypatch.undo()
+    sync(db_path, root, root)
+    assert check_aggregates(db_path) == 7
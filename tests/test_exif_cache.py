@@ -0,0 +1,98 @@
+import os
+import sqlite3
+
+import pytest
+
+import db_utils.exif_cache as exif_cache
+import db_utils.record_types as record_types
+
+EXIF = record_types.Exif(
+    4000, 3000, '2017-08-19 12:00:00', 2.8, 50.0, 400, '1/250',
+    'Canon EOS 5D', 'EF50mm f/1.4 USM', 37.734, -119.601, 3966.0)
+
+
+@pytest.fixture
+def photo(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    path.write_bytes(b'\xff\xd8 not really a photo')
+    return str(path)
+
+
+@pytest.fixture
+def cache_filename(tmp_path):
+    return str(tmp_path / exif_cache.CACHE_SUFFIX)
+
+
+def put(cache_filename, photo):
+    cache = exif_cache.ExifCache(cache_filename)
+    cache.put(photo, os.stat(photo), EXIF)
+    cache.close()
+
+
+def test_hit(cache_filename, photo):
+    put(cache_filename, photo)
+    cache = exif_cache.ExifCache(cache_filename)
+    assert cache.get(photo, os.stat(photo)) == EXIF
+    assert (cache.hits, cache.misses) == (1, 0)
+    cache.close()
+
+
+def test_miss_when_the_file_changed(cache_filename, photo):
+    put(cache_filename, photo)
+    stat = os.stat(photo)
+    os.utime(photo, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    cache = exif_cache.ExifCache(cache_filename)
+    assert cache.get(photo, os.stat(photo)) is None
+    with open(photo, 'ab') as f:
+        f.write(b'more')
+    assert cache.get(photo, os.stat(photo)) is None
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.close()
+
+
+def test_refresh(cache_filename, photo):
+    put(cache_filename, photo)
+    cache = exif_cache.ExifCache(cache_filename, refresh=True)
+    assert cache.get(photo, os.stat(photo)) is None
+    cache.close()
+
+
+def test_version_bump_drops_old_entries(cache_filename, photo,
+                                        monkeypatch):
+    put(cache_filename, photo)
+    monkeypatch.setattr(exif_cache, 'CACHE_VERSION',
+                        exif_cache.CACHE_VERSION + 1)
+    cache = exif_cache.ExifCache(cache_filename)
+    assert cache.get(photo, os.stat(photo)) is None
+    cache.put(photo, os.stat(photo), EXIF)
+    cache.close()
+    # Reopening with the same version keeps the new entries
+    cache = exif_cache.ExifCache(cache_filename)
+    assert cache.get(photo, os.stat(photo)) == EXIF
+    cache.close()
+
+
+def test_unversioned_cache_is_cleared(cache_filename, photo):
+    put(cache_filename, photo)
+    conn = sqlite3.connect(cache_filename)
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
+    conn.close()
+    cache = exif_cache.ExifCache(cache_filename)
+    assert cache.get(photo, os.stat(photo)) is None
+    cache.close()
+
+
+def test_evicts_least_recently_used(cache_filename, tmp_path):
+    cache = exif_cache.ExifCache(cache_filename, max_entries=2)
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        cache.now = ord(name)
+        cache.put(str(path), os.stat(str(path)), EXIF)
+    cache.close()
+    conn = sqlite3.connect(cache_filename)
+    paths = [os.path.basename(path) for path, in conn.execute(
+        'SELECT path FROM exif ORDER BY path')]
+    conn.close()
+    assert paths == ['b', 'c']
@@ -0,0 +1,203 @@
+import fractions
+import struct
+
+import pytest
+
+import db_utils.image_header as image_header
+
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+# Not a TIFF type, entries of this type are skipped
+UNKNOWN_TYPE = 99
+
+TIFF_HEADER_SIZE = 8
+
+
+def build_ifd(order, entries, offset):
+    """
+    Builds an IFD starting at offset, followed by the values that don't fit
+    in its entries.
+    :param entries: list of (tag, field type, values)
+    """
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack(order + 'H', len(entries))
+    values_data = b''
+    for tag, field_type, values in entries:
+        if field_type == ASCII:
+            raw = values.encode('utf-8') + b'\x00'
+            count = len(raw)
+        elif field_type == RATIONAL:
+            raw = b''.join(struct.pack(order + 'LL', *value)
+                           for value in values)
+            count = len(values)
+        else:
+            value_format = 'H' if field_type == SHORT else 'L'
+            raw = b''.join(struct.pack(order + value_format, value)
+                           for value in values)
+            count = len(values)
+        if len(raw) <= 4:
+            field = raw.ljust(4, b'\x00')
+        else:
+            field = struct.pack(order + 'L', data_offset + len(values_data))
+            values_data += raw
+        ifd += struct.pack(order + 'HHL', tag, field_type, count) + field
+    # No next IFD
+    ifd += struct.pack(order + 'L', 0)
+    return ifd + values_data
+
+
+def build_tiff(order, ifd0, exif=(), gps=()):
+    """
+    Builds a TIFF structure with an IFD0 and optional EXIF and GPS IFDs,
+    pointed to from IFD0.
+    :param order: '<' or '>'
+    """
+    header = (image_header.TIFF_LITTLE_ENDIAN if order == '<'
+              else image_header.TIFF_BIG_ENDIAN)
+    header += struct.pack(order + 'L', TIFF_HEADER_SIZE)
+    pointers = []
+    if exif:
+        pointers.append(0x8769)
+    if gps:
+        pointers.append(0x8825)
+
+    def build_ifd0(pointer_offsets):
+        return build_ifd(order, list(ifd0) + [
+            (tag, LONG, [pointer_offset])
+            for tag, pointer_offset in zip(pointers, pointer_offsets)],
+            TIFF_HEADER_SIZE)
+
+    # The size of IFD0 doesn't depend on the pointers' values
+    offset = TIFF_HEADER_SIZE + len(build_ifd0([0] * len(pointers)))
+    sub_ifds = b''
+    pointer_offsets = []
+    for entries in (exif, gps):
+        if entries:
+            pointer_offsets.append(offset + len(sub_ifds))
+            sub_ifds += build_ifd(order, entries, offset + len(sub_ifds))
+    return header + build_ifd0(pointer_offsets) + sub_ifds
+
+
+def build_jpeg(tiff, width=640, height=480):
+    """
+    Builds the start of a JPEG with an EXIF APP1 segment and a SOF0 frame
+    """
+    app1 = image_header.EXIF_HEADER + tiff
+    sof = struct.pack('>BHHB', 8, height, width, 3) + b'\x00' * 9
+    return (image_header.JPEG_SOI +
+            b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 +
+            b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof +
+            b'\xff\xda')
+
+
+IFD0 = [
+    (0x0100, LONG, [4000]),
+    (0x0101, SHORT, [3000]),
+    (0x010F, ASCII, 'Canon'),
+    (0x0110, ASCII, 'Canon EOS 5D'),
+]
+EXIF = [
+    (0x829A, RATIONAL, [(1, 250)]),
+    (0x829D, RATIONAL, [(28, 10)]),
+    (0x8827, SHORT, [400]),
+    (0x9003, ASCII, '2017:08:19 12:00:00'),
+    # Unknown focal length
+    (0x920A, RATIONAL, [(0, 0)]),
+]
+GPS = [
+    (0x0001, ASCII, 'N'),
+    (0x0002, RATIONAL, [(37, 1), (44, 1), (3012, 100)]),
+]
+
+
+@pytest.mark.parametrize('order', ['<', '>'])
+def test_parse_tiff(order):
+    width, height, tags = image_header.read_header_bytes(
+        build_tiff(order, IFD0, EXIF, GPS))
+    assert (width, height) == (4000, 3000)
+    assert tags == {
+        'Image Make': 'Canon',
+        'Image Model': 'Canon EOS 5D',
+        'EXIF ExposureTime': [fractions.Fraction(1, 250)],
+        'EXIF FNumber': [fractions.Fraction(28, 10)],
+        'EXIF ISOSpeedRatings': [400],
+        'EXIF DateTimeOriginal': '2017:08:19 12:00:00',
+        'EXIF FocalLength': [None],
+        'GPS GPSLatitudeRef': 'N',
+        'GPS GPSLatitude': [fractions.Fraction(37), fractions.Fraction(44),
+                            fractions.Fraction(3012, 100)],
+    }
+
+
+@pytest.mark.parametrize('order', ['<', '>'])
+def test_parse_jpeg(order):
+    tiff = build_tiff(order, IFD0[2:], EXIF)
+    width, height, tags = image_header.read_header_bytes(build_jpeg(tiff))
+    assert (width, height) == (640, 480)
+    assert tags['Image Model'] == 'Canon EOS 5D'
+    assert tags['EXIF FNumber'] == [fractions.Fraction(28, 10)]
+    assert image_header.EXIF_IFD_POINTER not in tags
+
+
+def test_jpeg_without_exif():
+    sof = struct.pack('>BHHB', 8, 20, 30, 3) + b'\x00' * 9
+    data = (image_header.JPEG_SOI +
+            b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof)
+    assert image_header.read_header_bytes(data) == (30, 20, {})
+
+
+def test_skips_unknown_field_types():
+    tiff = build_tiff('<', IFD0 + [(0x0131, UNKNOWN_TYPE, [1])])
+    width, height, tags = image_header.read_header_bytes(tiff)
+    assert (width, height) == (4000, 3000)
+
+
+@pytest.mark.parametrize('order', ['<', '>'])
+def test_truncated_tiff(order):
+    tiff = build_tiff(order, IFD0, EXIF, GPS)
+    # Cut in the middle of the GPS values, the last thing in the file
+    assert image_header.read_header_bytes(tiff[:-4]) is None
+    # Cut in the middle of IFD0
+    assert image_header.read_header_bytes(
+        tiff[:TIFF_HEADER_SIZE + 10]) is None
+
+
+def test_truncated_jpeg():
+    data = build_jpeg(build_tiff('<', IFD0[2:], EXIF))
+    # Cut before the SOF marker, within the APP1 segment
+    assert image_header.read_header_bytes(data[:60]) is None
+
+
+def test_ifd0_offset_past_the_end():
+    tiff = image_header.TIFF_LITTLE_ENDIAN + struct.pack('<L', 1000)
+    assert image_header.read_header_bytes(tiff) is None
+
+
+def test_value_offset_past_the_end():
+    tiff = bytearray(build_tiff('>', IFD0))
+    # Point the Make value, the first one stored out of line, past the end
+    entry_offset = TIFF_HEADER_SIZE + 2 + 12 * 2
+    struct.pack_into('>L', tiff, entry_offset + 8, 10 ** 6)
+    assert image_header.read_header_bytes(bytes(tiff)) is None
+
+
+def test_garbage_ifd():
+    tiff = build_tiff('<', IFD0)
+    # Claims many more entries than there are
+    garbage = (tiff[:TIFF_HEADER_SIZE] + struct.pack('<H', 0xFFFF) +
+               tiff[TIFF_HEADER_SIZE + 2:])
+    assert image_header.read_header_bytes(garbage) is None
+    assert image_header.read_header_bytes(
+        image_header.TIFF_BIG_ENDIAN + b'\xff' * 64) is None
+
+
+def test_missing_dimensions():
+    # A TIFF needs its dimensions in IFD0
+    assert image_header.read_header_bytes(build_tiff('<', IFD0[2:])) is None
+
+
+def test_unsupported_format():
+    assert image_header.read_header_bytes(b'GIF89a' + b'\x00' * 32) is None
+    assert image_header.read_header_bytes(b'') is None
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+THUMBNAIL = '2017/_thumbnail/250/foo.jpg'
+PHOTO = '2017/foo.jpg'
+
+
+@pytest.fixture
+def client(tmp_path, load_url_handler):
+    for filename in (THUMBNAIL, PHOTO):
+        path = tmp_path / 'photos' / filename
+        os.makedirs(str(path.parent), exist_ok=True)
+        path.write_bytes(b'\xff\xd8 not really a JPEG')
+    return load_url_handler().app.test_client()
+
+
+def test_thumbnails_are_revalidated(client, tmp_path):
+    res = client.get('/photo/' + THUMBNAIL)
+    assert res.status_code == 200
+    assert not res.cache_control.immutable
+    assert res.cache_control.max_age == 3600
+    etag, _ = res.get_etag()
+    assert etag is not None and res.last_modified is not None
+
+    res = client.get('/photo/' + THUMBNAIL,
+                     headers={'If-None-Match': '"{}"'.format(etag)})
+    assert res.status_code == 304
+
+    # Rewritten in place, e.g. because the photo changed
+    path = tmp_path / 'photos' / THUMBNAIL
+    path.write_bytes(b'\xff\xd8 another thumbnail')
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    res = client.get('/photo/' + THUMBNAIL,
+                     headers={'If-None-Match': '"{}"'.format(etag)})
+    assert res.status_code == 200
+    assert res.get_data() == b'\xff\xd8 another thumbnail'
+
+
+def test_photo_max_age(client):
+    res = client.get('/photo/' + PHOTO)
+    assert res.status_code == 200
+    assert not res.cache_control.immutable
+    assert res.cache_control.max_age == 24 * 3600
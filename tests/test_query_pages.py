@@ -0,0 +1,217 @@
+import base64
+import contextlib
+import gzip
+import io
+import json
+
+import pytest
+
+import db_utils.backends as backends
+import db_utils.batch_writer as batch_writer
+import db_utils.generation as generation
+import db_utils.indexer as indexer
+import db_utils.query as query
+import db_utils.record_types as record_types
+import db_utils.snapshots as snapshots
+
+USER_PATH = '/2017'
+NUM_DIRS = 5
+# More than a page, so the first page (and its snapshot) has a next page
+NUM_PHOTOS = query.DEFAULT_PAGE_SIZE + 7
+# Every photo has the same dates, so pages can only be told apart by the
+# sort key, the names, which are unique within a dir
+TIMESTAMP = '2017-08-19 12:00:00'
+
+
+def build_record(record_type, **values):
+    return record_type(*[values.get(field)
+                         for field in record_type._fields])
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / 'index.sqlite')
+    conn = backends.SQLiteBackend(db_path).connect()
+    writer = batch_writer.BatchWriter(conn)
+    dirs = [('/', None, '')] + [(USER_PATH, '/', USER_PATH[1:])] + [
+        ('{}/d{:02d}'.format(USER_PATH, i), USER_PATH, 'd{:02d}'.format(i))
+        for i in range(NUM_DIRS)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for user_path, parent, name in dirs:
+            indexer.write_dir(writer, build_record(
+                record_types.Dir, user_path=user_path,
+                parent_user_path=parent, name=name, width=4, height=3,
+                aspect_ratio=4 / 3, created_time=TIMESTAMP,
+                modified_time=TIMESTAMP, num_subdirs=0, num_photos=0,
+                total_photos=0, total_size=0), True)
+        for i in range(NUM_PHOTOS):
+            indexer.write_photo(writer, build_record(
+                record_types.Photo, user_path=USER_PATH,
+                filename='p{:03d}.jpg'.format(i), created_time=TIMESTAMP,
+                width=4, height=3, aspect_ratio=4 / 3, size=1000,
+                modified_time=TIMESTAMP), True)
+        writer.close()
+    conn.close()
+    return db_path
+
+
+@pytest.fixture
+def querier(db_path):
+    conn = backends.SQLiteBackend(db_path).connect(read_only=True)
+    querier = query.Querier(None, None, None, None, conn=conn)
+    yield querier
+    conn.close()
+
+
+def get_all_pages(querier, limit, lean=False):
+    """
+    :return: the grid and lightbox items of all the pages of USER_PATH
+    """
+    grid, lightbox = [], []
+    cursor = None
+    while True:
+        page = querier.get_path_contents_page(USER_PATH, cursor=cursor,
+                                              limit=limit, lean=lean)
+        assert len(page['grid']) <= limit
+        assert page['lightbox_offset'] == len(lightbox)
+        grid.extend(page['grid'])
+        lightbox.extend(page['lightbox'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return grid, lightbox
+
+
+def test_cursor_roundtrip():
+    for cursor in [(query.DIR_TYPE, 'd01', 0),
+                   (query.IMAGE_TYPE, 'été 2017/p?&=.jpg', 42)]:
+        encoded = query.encode_cursor(*cursor)
+        # Safe in a query string as is
+        assert set(encoded) <= set(
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+            '0123456789-_=')
+        assert query.decode_cursor(encoded) == cursor
+
+
+def encode_json(value):
+    return base64.urlsafe_b64encode(
+        json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+INVALID_CURSORS = [
+    '',
+    'not a cursor',
+    base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'),
+    base64.urlsafe_b64encode(b'{"not": "json"').decode('ascii'),
+    encode_json({'type': 'image'}),
+    encode_json(['image', 'p01.jpg']),
+    encode_json(['file', 'p01.jpg', 1]),
+    encode_json(['image', 1, 1]),
+    encode_json(['image', 'p01.jpg', '1']),
+]
+
+
+@pytest.mark.parametrize('cursor', INVALID_CURSORS)
+def test_invalid_cursor(querier, cursor):
+    with pytest.raises(ValueError):
+        query.decode_cursor(cursor)
+    with pytest.raises(ValueError):
+        querier.get_path_contents_page(USER_PATH, cursor=cursor)
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 4, NUM_DIRS, NUM_DIRS + 1,
+                                   NUM_DIRS + NUM_PHOTOS - 1,
+                                   NUM_DIRS + NUM_PHOTOS])
+@pytest.mark.parametrize('lean', [False, True])
+def test_pages_match_the_whole_listing(querier, limit, lean):
+    whole = querier.get_path_contents_page(
+        USER_PATH, limit=query.MAX_PAGE_SIZE, lean=lean)
+    assert whole['next_cursor'] is None
+    names = [item['metadata']['name'] for item in whole['grid']]
+    # Dirs first, then photos, each in their sort order
+    assert names == (
+        ['d{:02d}'.format(i) for i in reversed(range(NUM_DIRS))] +
+        ['p{:03d}.jpg'.format(i) for i in range(NUM_PHOTOS)])
+
+    # Each item exactly once, whether a page ends among the dirs, right
+    # after the last one or among photos with the same dates
+    assert get_all_pages(querier, limit, lean=lean) == (
+        whole['grid'], whole['lightbox'])
+
+
+def test_last_page_has_no_cursor(querier):
+    page = querier.get_path_contents_page(
+        USER_PATH, limit=NUM_DIRS + NUM_PHOTOS)
+    assert page['next_cursor'] is None
+    page = querier.get_path_contents_page(
+        USER_PATH, cursor=query.encode_cursor(
+            query.IMAGE_TYPE, 'p{:03d}.jpg'.format(NUM_PHOTOS - 1),
+            NUM_PHOTOS))
+    assert page['grid'] == [] and page['next_cursor'] is None
+
+
+@pytest.fixture
+def url_handler(tmp_path, db_path, load_url_handler):
+    """
+    The web app, configured to serve snapshots from a fresh store
+    """
+    snapshot_dir = str(tmp_path / 'snapshots')
+    url_handler = load_url_handler(serve_snapshots=True,
+                                   snapshot_dir=snapshot_dir)
+    conn = backends.SQLiteBackend(db_path).connect()
+    with contextlib.redirect_stdout(io.StringIO()):
+        snapshots.write_snapshots(conn, snapshots.SnapshotStore(snapshot_dir),
+                                  [USER_PATH])
+    conn.close()
+    generation.bump_generation(url_handler.app.config['INDEX_GENERATION_FILE'])
+    return url_handler
+
+
+def get_page(client, **params):
+    res = client.get('/get_path_contents_page{}'.format(USER_PATH),
+                     query_string=params)
+    assert res.status_code == 200
+    body = res.get_data()
+    if res.headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    return res, body
+
+
+def test_snapshot_is_the_live_first_page(url_handler, querier):
+    client = url_handler.app.test_client()
+    live = query.serialize_path_contents(
+        querier.get_path_contents_page(USER_PATH, lean=True))
+    for encoding in ('identity', 'gzip'):
+        client.environ_base['HTTP_ACCEPT_ENCODING'] = encoding
+        res, body = get_page(client, lean=1)
+        # Sent from the file, not serialized for the request
+        assert res.last_modified is not None
+        assert body == live
+
+    # Following its cursor gives the same pages as the live query
+    grid = json.loads(body)['grid']
+    cursor = json.loads(body)['next_cursor']
+    assert cursor is not None
+    while cursor is not None:
+        res, body = get_page(client, lean=1, cursor=cursor)
+        assert res.last_modified is None
+        page = json.loads(body)
+        grid.extend(page['grid'])
+        cursor = page['next_cursor']
+    expected, _ = get_all_pages(querier, query.DEFAULT_PAGE_SIZE, lean=True)
+    assert grid == json.loads(json.dumps(expected))
+
+
+def test_other_pages_are_not_snapshots(url_handler, querier):
+    client = url_handler.app.test_client()
+    res, body = get_page(client, lean=1, limit=3)
+    assert res.last_modified is None
+    assert body == query.serialize_path_contents(
+        querier.get_path_contents_page(USER_PATH, limit=3, lean=True))
+
+
+@pytest.mark.parametrize('cursor', INVALID_CURSORS[1:])
+def test_invalid_cursor_is_a_bad_request(url_handler, cursor):
+    client = url_handler.app.test_client()
+    res = client.get('/get_path_contents_page{}'.format(USER_PATH),
+                     query_string={'lean': 1, 'cursor': cursor})
+    assert res.status_code == 400
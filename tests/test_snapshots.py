@@ -0,0 +1,57 @@
+import contextlib
+import io
+import os
+
+from PIL import Image
+
+import db_utils.backends as backends
+import db_utils.batch_writer as batch_writer
+import db_utils.generation as generation
+import db_utils.indexer as indexer
+import db_utils.query as query
+import db_utils.snapshots as snapshots
+
+PHOTOS = [
+    'a/1.jpg',
+    'a/2.jpg',
+    'a/b/3.jpg',
+    'c/4.jpg',
+    'c/5.jpg',
+]
+
+
+def test_publish_on_each_commit(tmp_path):
+    root = str(tmp_path / 'photos')
+    for i, path in enumerate(PHOTOS):
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.new('RGB', (40 + i, 30)).save(path)
+    store = snapshots.SnapshotStore(str(tmp_path / 'snapshots'))
+    generation_file = str(tmp_path / 'generation')
+    conn = backends.SQLiteBackend(str(tmp_path / 'index.sqlite')).connect()
+    querier = query.Querier(None, None, None, None, conn=conn)
+    generations = []
+
+    def on_commit(writer):
+        indexer.publish_changes(writer, store, generation_file)
+        generations.append(generation.read_generation(generation_file))
+        # Every committed dir is served as it is in the database
+        querier.db.execute('SELECT user_path FROM dirs')
+        for user_path, in querier.db.fetchall():
+            with open(store.get_filename(user_path), 'rb') as f:
+                assert f.read() == query.serialize_path_contents(
+                    querier.get_path_contents_page(user_path, lean=True))
+
+    writer = batch_writer.BatchWriter(conn, batch_size=1, commit_every=2,
+                                      on_commit=on_commit)
+    with contextlib.redirect_stdout(io.StringIO()):
+        indexer.walk_path(writer, root, root, True)
+        periodic = len(generations)
+        writer.close()
+    conn.close()
+
+    # Published before the end of the run, not only once at the end
+    assert periodic > 1
+    # Bumped once per commit that changed anything
+    assert generations == sorted(generations)
+    assert generations[-1] == len(set(generations))
@@ -0,0 +1,59 @@
+import os
+
+import db_utils.sync_index as sync_index
+import db_utils.sync_manifest as sync_manifest
+
+
+def modify_in_place(dirpath, filename, data):
+    """
+    Rewrites a file without changing the mtime of its dir, like an editor
+    saving a photo in place
+    """
+    dir_stat = os.stat(dirpath)
+    path = os.path.join(dirpath, filename)
+    stat = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.utime(dirpath, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+
+def test_rescan_notices_photos_modified_in_place(tmp_path):
+    dirpath = str(tmp_path)
+    (tmp_path / 'a.jpg').write_bytes(b'a')
+    manifest = sync_manifest.SyncManifest(str(tmp_path / 'manifest.json'))
+    dirnames, filenames, photo_stats = sync_index.scan_dir_with_manifest(
+        dirpath, '/', manifest)
+    assert filenames == {'a.jpg'}
+
+    modify_in_place(dirpath, 'a.jpg', b'edited')
+    # The dir's mtime didn't change, so it isn't listed
+    assert sync_index.scan_dir_with_manifest(
+        dirpath, '/', manifest) == ([], None, None)
+    # As a dir reported by the watcher, it is, and the photo's new
+    # size and mtime change its hash
+    dirnames, filenames, photo_stats = sync_index.scan_dir_with_manifest(
+        dirpath, '/', manifest, rescan=True)
+    assert photo_stats['a.jpg'].st_size == len(b'edited')
+    # Once recorded, listing it again finds nothing new
+    assert sync_index.scan_dir_with_manifest(
+        dirpath, '/', manifest, rescan=True) == ([], None, None)
+
+
+def test_walk_rescans_only_the_given_dirs(tmp_path):
+    for name in ('x', 'y'):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / 'a.jpg').write_bytes(b'a')
+    root = str(tmp_path)
+    manifest = sync_manifest.SyncManifest(str(tmp_path / 'manifest.json'))
+    sync_index.walk_local_dirs(root, root, manifest=manifest)
+    for name in ('x', 'y'):
+        modify_in_place(str(tmp_path / name), 'a.jpg', b'edited')
+
+    path_info = sync_index.walk_local_dirs(
+        root, root, manifest=manifest,
+        rescan_dirs={str(tmp_path / 'x')})
+    photo_stats = {user_path: info[3]
+                   for user_path, info in path_info.items()}
+    assert photo_stats['/x']['a.jpg'].st_size == len(b'edited')
+    assert photo_stats['/y'] is None
@@ -0,0 +1,37 @@
+import argparse
+
+import pytest
+from PIL import Image
+
+import db_utils.thumbnails as thumbnails
+
+
+@pytest.fixture
+def without_avif(monkeypatch):
+    """
+    Makes the installed Pillow look like one that can't write AVIF
+    """
+    Image.init()
+    monkeypatch.setattr(Image, 'SAVE', {
+        pillow_format: save for pillow_format, save in Image.SAVE.items()
+        if pillow_format != 'AVIF'})
+
+
+def test_check_formats(without_avif):
+    # In order of preference, whatever the order they were given in
+    assert thumbnails.check_formats([' WebP', '']) == ['webp']
+    assert thumbnails.available_formats() == ['webp']
+    with pytest.raises(ValueError, match='Unknown'):
+        thumbnails.check_formats(['gif'])
+    with pytest.raises(ValueError, match='pillow-avif-plugin'):
+        thumbnails.check_formats(['webp', 'avif'])
+
+
+def test_parse_formats_usage_error(without_avif, capsys):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--formats', type=thumbnails.parse_formats)
+    assert parser.parse_args(['--formats', 'webp']).formats == ['webp']
+    # Refused when the arguments are parsed, not when rendering
+    with pytest.raises(SystemExit):
+        parser.parse_args(['--formats', 'avif,webp'])
+    assert 'Pillow 11.2' in capsys.readouterr().err
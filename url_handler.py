@@ -1,18 +1,128 @@
+import functools
 import json
+import mimetypes
+import os
 import urllib.parse
 
-from flask import Flask, Response, g, render_template, send_from_directory
-from werkzeug.exceptions import NotFound
+from flask import (Flask, Response, g, render_template, request, send_file,
+                   send_from_directory)
+from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.security import safe_join
 
+import db_utils.backends as backends
+import db_utils.compression as compression
+import db_utils.connection_pool as connection_pool
+import db_utils.generation as generation
+import db_utils.lazy_thumbnails as lazy_thumbnails
+import db_utils.lru_cache as lru_cache
 import db_utils.query as query
+import db_utils.snapshots as snapshots
+import db_utils.thumbnails as thumbnails
 try:
-    from config import photos_root, db_host, db_user, db_name, db_password
+    from config import photos_root
 except ImportError:
-    raise ValueError("photos_root, db_host, db_user, db_name, db_password "
-                     "must all be defined in a local file named config.py")
+    raise ValueError("photos_root must be defined in a local file named "
+                     "config.py")
+import config
+
+# Only needed for the mysql backend
+db_host = getattr(config, 'db_host', None)
+db_user = getattr(config, 'db_user', None)
+db_name = getattr(config, 'db_name', None)
+db_password = getattr(config, 'db_password', None)
+
+# Headers telling the front server to send a file itself, see sendfile_header
+# in example_config.py
+X_SENDFILE = 'X-Sendfile'
+X_ACCEL_REDIRECT = 'X-Accel-Redirect'
+# Thumbnails are rewritten in place when their photo changes, under the same
+# URL, so browsers revalidate them (with their ETag) once they're this old
+DEFAULT_THUMBNAIL_MAX_AGE = 3600
+DEFAULT_PHOTO_MAX_AGE = 24 * 3600
 
 app = Flask(__name__)
 app.config['PHOTOS_ROOT'] = photos_root
+# Optional settings
+app.config['INDEX_GENERATION_FILE'] = getattr(
+    config, 'index_generation_file',
+    generation.default_generation_path(photos_root))
+app.config['DB_BACKEND'] = getattr(config, 'db_backend',
+                                   backends.DEFAULT_BACKEND)
+app.config['DB_PATH'] = getattr(config, 'db_path', None)
+if app.config['DB_BACKEND'] == backends.SQLITE_BACKEND:
+    if not app.config['DB_PATH']:
+        raise ValueError('db_path must be defined in config.py to use the '
+                         'sqlite backend')
+    db_backend = backends.SQLiteBackend(app.config['DB_PATH'])
+elif app.config['DB_BACKEND'] == backends.MYSQL_BACKEND:
+    if None in (db_host, db_user, db_name, db_password):
+        raise ValueError('db_host, db_user, db_name, db_password must all be '
+                         'defined in config.py to use the mysql backend')
+    db_backend = backends.MySQLBackend(db_host, db_user, db_password, db_name)
+else:
+    raise ValueError('db_backend must be one of {}'.format(
+        ', '.join(backends.BACKENDS)))
+app.config['PATH_CONTENTS_CACHE_SIZE'] = getattr(
+    config, 'path_contents_cache_size', lru_cache.DEFAULT_MAX_ENTRIES)
+app.config['PATH_CONTENTS_CACHE_TTL'] = getattr(
+    config, 'path_contents_cache_ttl', lru_cache.DEFAULT_TTL_SECONDS)
+app.config['DB_POOL_SIZE'] = getattr(
+    config, 'db_pool_size', connection_pool.DEFAULT_MAX_SIZE)
+app.config['DB_POOL_MAX_IDLE'] = getattr(
+    config, 'db_pool_max_idle', connection_pool.DEFAULT_MAX_IDLE_SECONDS)
+app.config['DB_POOL_TIMEOUT'] = getattr(
+    config, 'db_pool_timeout', connection_pool.DEFAULT_TIMEOUT_SECONDS)
+app.config['DB_POOL_HEALTH_CHECK_INTERVAL'] = getattr(
+    config, 'db_pool_health_check_interval',
+    connection_pool.DEFAULT_HEALTH_CHECK_INTERVAL_SECONDS)
+app.config['STATS_ENABLED'] = getattr(config, 'stats_enabled', False)
+app.config['SERVE_SNAPSHOTS'] = getattr(config, 'serve_snapshots', False)
+app.config['SNAPSHOT_DIR'] = getattr(
+    config, 'snapshot_dir', snapshots.default_snapshot_dir(photos_root))
+app.config['THUMBNAIL_FORMATS'] = thumbnails.check_formats(
+    getattr(config, 'thumbnail_formats', []))
+app.config['LAZY_THUMBNAILS'] = getattr(config, 'lazy_thumbnails', False)
+app.config['LAZY_THUMBNAIL_MAX_RENDERS'] = getattr(
+    config, 'lazy_thumbnail_max_renders', lazy_thumbnails.DEFAULT_MAX_RENDERS)
+app.config['LAZY_THUMBNAIL_TIMEOUT'] = getattr(
+    config, 'lazy_thumbnail_timeout', lazy_thumbnails.DEFAULT_TIMEOUT_SECONDS)
+app.config['THUMBNAIL_MAX_AGE'] = getattr(
+    config, 'thumbnail_max_age', DEFAULT_THUMBNAIL_MAX_AGE)
+app.config['PHOTO_MAX_AGE'] = getattr(
+    config, 'photo_max_age', DEFAULT_PHOTO_MAX_AGE)
+app.config['SENDFILE_HEADER'] = getattr(config, 'sendfile_header', None)
+if app.config['SENDFILE_HEADER'] not in (None, X_SENDFILE, X_ACCEL_REDIRECT):
+    raise ValueError("sendfile_header must be None, '{}' or '{}'".format(
+        X_SENDFILE, X_ACCEL_REDIRECT))
+app.config['USE_X_SENDFILE'] = app.config['SENDFILE_HEADER'] == X_SENDFILE
+app.config['X_ACCEL_REDIRECT_PREFIX'] = getattr(
+    config, 'x_accel_redirect_prefix', None)
+if (app.config['SENDFILE_HEADER'] == X_ACCEL_REDIRECT and
+        not app.config['X_ACCEL_REDIRECT_PREFIX']):
+    raise ValueError('x_accel_redirect_prefix must be defined in config.py '
+                     'to use X-Accel-Redirect')
+
+# Serialized get_path_contents responses, keyed by user path
+path_contents_cache = lru_cache.LRUCache(
+    max_entries=app.config['PATH_CONTENTS_CACHE_SIZE'],
+    ttl=app.config['PATH_CONTENTS_CACHE_TTL'])
+
+# Database connections shared by the requests handled by this process
+db_pool = connection_pool.ConnectionPool(
+    functools.partial(db_backend.connect, read_only=True),
+    max_size=app.config['DB_POOL_SIZE'],
+    max_idle=app.config['DB_POOL_MAX_IDLE'],
+    timeout=app.config['DB_POOL_TIMEOUT'],
+    health_check_interval=app.config['DB_POOL_HEALTH_CHECK_INTERVAL'])
+
+# get_path_contents responses written by the indexer
+snapshot_store = snapshots.SnapshotStore(app.config['SNAPSHOT_DIR'])
+
+# Renders the thumbnails missing on disk, if lazy_thumbnails is set
+thumbnail_renderer = lazy_thumbnails.ThumbnailRenderer(
+    max_renders=app.config['LAZY_THUMBNAIL_MAX_RENDERS'],
+    timeout=app.config['LAZY_THUMBNAIL_TIMEOUT'],
+    formats=app.config['THUMBNAIL_FORMATS'])
 
 
 @app.route('/photos', strict_slashes=False)
@@ -42,10 +152,167 @@ def get_path_contents(user_path=None):
     if user_path is None:
         user_path = '/'
     user_path = format_user_path(user_path, leading_slash=True)
-    querier = get_querier()
-    res = json.dumps(querier.get_path_contents(user_path),
-                     indent=4, sort_keys=True)
-    return Response(res, mimetype='application/json')
+    return send_cached_json(
+        user_path, lambda querier: querier.get_path_contents(user_path))
+
+
+@app.route('/get_path_contents_page', strict_slashes=False)
+@app.route('/get_path_contents_page/<path:user_path>', strict_slashes=False)
+def get_path_contents_page(user_path=None):
+    """
+    This returns one page of the JSON returned by get_path_contents, as
+    described in Querier.get_path_contents_page, so that the first photos
+    of a big directory can be shown before all of them have been loaded.
+
+    Query parameters:
+    cursor: the next_cursor of the previous page. Omitted for the first one.
+    limit: the max number of grid items in the page
+    lean: if 1, the lightbox items only hold what photoswipe needs, and the
+        rest is loaded with get_lightbox_details
+
+    If serve_snapshots is set, the first page the grid loads (lean, with the
+    default limit) is the snapshot written by the indexer, served as is.
+    Otherwise, or if there is no snapshot, see send_cached_json.
+    """
+    if user_path is None:
+        user_path = '/'
+    user_path = format_user_path(user_path, leading_slash=True)
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            query.decode_cursor(cursor)
+        except ValueError as e:
+            raise BadRequest(str(e))
+    limit = request.args.get('limit', query.DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, query.MAX_PAGE_SIZE))
+    lean = bool(request.args.get('lean', 0, type=int))
+    if (app.config['SERVE_SNAPSHOTS'] and cursor is None and lean and
+            limit == query.DEFAULT_PAGE_SIZE):
+        res = send_snapshot(user_path,
+                            compression.negotiate(request.accept_encodings))
+        if res is not None:
+            return res
+    return send_cached_json(
+        ('page', user_path, cursor, limit, lean),
+        lambda querier: querier.get_path_contents_page(
+            user_path, cursor=cursor, limit=limit, lean=lean))
+
+
+@app.route('/get_lightbox_details', strict_slashes=False)
+@app.route('/get_lightbox_details/<path:user_path>', strict_slashes=False)
+def get_lightbox_details(user_path=None):
+    """
+    This returns the full lightbox info (EXIF, size, date...) of a range of
+    photos at a given path, as described in Querier.get_lightbox_details.
+
+    Query parameters:
+    start: the lightbox index of the first photo
+    count: the number of photos
+    """
+    if user_path is None:
+        user_path = '/'
+    user_path = format_user_path(user_path, leading_slash=True)
+    start = max(0, request.args.get('start', 0, type=int))
+    count = request.args.get('count', query.DEFAULT_PAGE_SIZE, type=int)
+    count = max(1, min(count, query.MAX_PAGE_SIZE))
+    return send_cached_json(
+        ('details', user_path, start, count),
+        lambda querier: querier.get_lightbox_details(user_path, start, count))
+
+
+def send_cached_json(cache_key, get_contents):
+    """
+    Sends the JSON of get_contents(querier), compressed if the browser
+    accepts it. The serialized JSON is cached under cache_key until the
+    indexer bumps the index generation, which is also the ETag of the
+    response: a browser that already has the current version gets a 304
+    without the database being queried.
+    """
+    encoding = compression.negotiate(request.accept_encodings)
+    index_generation = generation.read_generation(
+        app.config['INDEX_GENERATION_FILE'])
+    etag = get_path_contents_etag(index_generation, encoding)
+    # Small responses are sent uncompressed, with the identity ETag
+    identity_etag = get_path_contents_etag(index_generation, None)
+    for cached_etag in (etag, identity_etag):
+        if cached_etag is not None and request.if_none_match.contains(
+                cached_etag):
+            return json_response(None, None, cached_etag, status=304)
+
+    # Cached as a dict of encoding -> body, filled as encodings are needed
+    bodies = path_contents_cache.get(cache_key, index_generation)
+    if bodies is None:
+        bodies = {None: query.serialize_path_contents(
+            get_contents(get_querier()))}
+        path_contents_cache.put(cache_key, index_generation, bodies)
+    if len(bodies[None]) < compression.MIN_SIZE:
+        encoding = None
+        etag = identity_etag
+    if encoding not in bodies:
+        bodies[encoding] = compression.compress(bodies[None], encoding)
+    return json_response(bodies[encoding], encoding, etag)
+
+
+def get_path_contents_etag(index_generation, encoding):
+    """
+    Gets the ETag of a get_path_contents response, or None if the index
+    generation is unknown (the indexer never bumped it), since the contents
+    could then change without the ETag changing.
+    """
+    if not index_generation:
+        return None
+    return '{}-{}'.format(index_generation, encoding or 'identity')
+
+
+def json_response(body, encoding=None, etag=None, status=200):
+    """
+    Builds a JSON response that browsers must revalidate before reusing
+    :param body: the JSON, already compressed with encoding if given
+    """
+    res = Response(body, status=status, mimetype='application/json')
+    if encoding is not None:
+        res.headers['Content-Encoding'] = encoding
+    res.vary.add('Accept-Encoding')
+    if etag is not None:
+        res.set_etag(etag)
+    res.cache_control.no_cache = True
+    return res
+
+
+def send_snapshot(user_path, encoding=None):
+    """
+    Sends the snapshot of user_path, pre-compressed with encoding if there
+    is such a snapshot, with an ETag so that unchanged snapshots aren't sent
+    again. Returns None if there is no snapshot of user_path.
+    """
+    found = snapshot_store.find(user_path, encoding)
+    if found is None:
+        return None
+    filename, encoding = found
+    res = send_file(filename, mimetype='application/json', conditional=True)
+    if encoding is not None:
+        res.headers['Content-Encoding'] = encoding
+    res.vary.add('Accept-Encoding')
+    res.cache_control.no_cache = True
+    return res
+
+
+@app.route('/stats')
+def stats():
+    """
+    Returns the database pool, response cache and thumbnail renderer
+    metrics of this process.
+    Disabled unless stats_enabled is set in config.py.
+    """
+    if not app.config['STATS_ENABLED']:
+        raise NotFound()
+    res = {
+        'db_pool': db_pool.stats(),
+        'path_contents_cache': path_contents_cache.stats(),
+        'thumbnail_renderer': thumbnail_renderer.stats(),
+    }
+    return Response(json.dumps(res, indent=4, sort_keys=True),
+                    mimetype='application/json')
 
 
 @app.route('/photo/<path:filename>')
@@ -57,9 +324,72 @@ def photo(filename):
     /photo/2017/foo.jpg
     to the defined location of photos on the server, like
     webpics/albums/2017/foo.jpg
+
+    See send_photo_file for how files are sent. Thumbnails are cached for
+    a shorter time than photos by default, since a photo that changes gets
+    new thumbnails under the same URLs.
+
+    If thumbnail_formats is set, thumbnails are sent in the preferred of
+    these formats the browser accepts, if it exists on disk.
+
+    If lazy_thumbnails is set, thumbnails that don't exist yet are rendered
+    first, see lazy_thumbnails.ThumbnailRenderer.
     """
     filename = urllib.parse.unquote(filename)
-    return send_from_directory(app.config['PHOTOS_ROOT'], filename)
+    path = safe_join(app.config['PHOTOS_ROOT'], filename)
+    if path is None or thumbnails.parse_thumb_file(path) is None:
+        return send_photo_file(filename, app.config['PHOTO_MAX_AGE'])
+
+    format_name = thumbnails.negotiate_format(
+        request.accept_mimetypes, app.config['THUMBNAIL_FORMATS'])
+    if app.config['LAZY_THUMBNAILS']:
+        thumbnail_renderer.ensure(path, format_name)
+    if (format_name is not None and
+            os.path.exists(thumbnails.get_variant_file(path, format_name))):
+        res = send_photo_file(
+            thumbnails.get_variant_file(filename, format_name),
+            app.config['THUMBNAIL_MAX_AGE'],
+            mimetype=thumbnails.FORMATS[format_name].mimetype)
+    else:
+        res = send_photo_file(filename, app.config['THUMBNAIL_MAX_AGE'])
+    if app.config['THUMBNAIL_FORMATS']:
+        res.vary.add('Accept')
+    return res
+
+
+def send_photo_file(filename, max_age, mimetype=None):
+    """
+    Sends a file below photos_root, with an ETag made of its size and mtime
+    and a Last-Modified date, answering conditional and Range requests.
+
+    The file is sent by the WSGI server's file wrapper (sendfile where it's
+    supported), unless sendfile_header is set, in which case the front
+    server is told to send it with X-Sendfile or X-Accel-Redirect.
+    :param filename: the path of the file relative to photos_root
+    :param max_age: seconds browsers may cache the file for before
+        revalidating it
+    """
+    path = safe_join(app.config['PHOTOS_ROOT'], filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+    stat = os.stat(path)
+    etag = '{:x}-{:x}'.format(stat.st_mtime_ns, stat.st_size)
+    if app.config['SENDFILE_HEADER'] == X_ACCEL_REDIRECT:
+        # The front server handles Range requests itself
+        res = Response(mimetype=mimetype or mimetypes.guess_type(filename)[0]
+                       or 'application/octet-stream')
+        res.headers[X_ACCEL_REDIRECT] = urllib.parse.quote('{}/{}'.format(
+            app.config['X_ACCEL_REDIRECT_PREFIX'].rstrip('/'), filename))
+        res.set_etag(etag)
+        res.last_modified = stat.st_mtime
+        res.make_conditional(request)
+    else:
+        res = send_from_directory(app.config['PHOTOS_ROOT'], filename,
+                                  mimetype=mimetype, etag=etag,
+                                  max_age=max_age, conditional=True)
+    res.cache_control.public = True
+    res.cache_control.max_age = max_age
+    return res
 
 
 def format_user_path(user_path, leading_slash=True):
@@ -80,7 +410,9 @@ def format_user_path(user_path, leading_slash=True):
 
 def get_querier():
     if not hasattr(g, 'querier'):
-        querier = query.Querier(db_host, db_user, db_password, db_name)
+        querier = query.Querier(db_host, db_user, db_password, db_name,
+                                pool=db_pool,
+                                thumb_formats=app.config['THUMBNAIL_FORMATS'])
         querier.connect()
         g.querier = querier
         return querier
@@ -90,9 +422,21 @@ def get_querier():
 
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
+    """
+    Returns the database connection to the pool at the end of the request.
+    If the request failed, the connection may be in a bad state, so it is
+    closed instead.
+    """
     if hasattr(g, 'querier'):
-        g.querier.close()
+        g.querier.close(broken=error is not None)
+
+
+@app.errorhandler(BadRequest)
+def bad_request_handler(error):
+    """
+    Exception handler for 400 bad request, e.g. an invalid query parameter.
+    """
+    return str(error), 400
 
 
 @app.errorhandler(NotFound)
@@ -105,6 +449,16 @@ def all_exception_handler(error):
     return str(error), 404
 
 
+@app.errorhandler(lazy_thumbnails.RenderTimeout)
+def render_timeout_handler(error):
+    """
+    Exception handler for thumbnails that couldn't be rendered in time
+    because the server is busy rendering others.
+    """
+    return str(error), 503, {
+        'Retry-After': str(lazy_thumbnails.RETRY_AFTER_SECONDS)}
+
+
 @app.errorhandler(Exception)
 def all_exception_handler(error):
     """